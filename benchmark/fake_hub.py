@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+#
+# Local stand-in for the Black Duck server endpoints used by import_yocto_build_manifest.py
+#
+# Serves a synthetic KB of components pkg0 ... pkg<size-1> (plus busybox and zlib) each with a number of versions,
+# and keeps projects, versions and BOMs in memory. Used by run_benchmark.py, and can be run on its own to test the
+# script without a Black Duck server by pointing .restconfig.json at it:
+#
+#   python3 benchmark/fake_hub.py --port 8765 --size 1000 --latency 0.01
+#   {"baseurl": "http://127.0.0.1:8765", "api_token": "any", "insecure": true, "debug": false}
+#
+# Request counts and response bytes per endpoint are returned by GET /_stats and cleared by POST /_reset
+# --throttle returns 429 responses (with Retry-After) for the given fraction of requests
+#
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeKB:
+    #
+    # Synthetic KB - component and version IDs are derived from the names so they are the same for every run
+    def __init__(self, size, versions, seed=1):
+        rnd = random.Random(seed)
+        self.components = {}    # id -> dict(name, url, versions [(id, name)])
+        self.byname = {}        # lower name -> [ids]
+        for i in range(size):
+            name = "pkg{}".format(i)
+            self.add_component(name, ["{}.{}.{}".format(rnd.randint(0, 5), j // 10, j % 10) for j in range(versions)])
+
+    def add_component(self, name, versions):
+        cid = str(uuid.uuid5(uuid.NAMESPACE_URL, "comp/" + name))
+        self.components[cid] = {
+            'name': name,
+            'url': "https://example.org/" + name,
+            'versions': [(str(uuid.uuid5(uuid.NAMESPACE_URL, "ver/{}/{}".format(name, v))), v) for v in versions],
+        }
+        self.byname.setdefault(name.lower(), []).append(cid)
+        return cid
+
+
+class FakeHub:
+    #
+    # Server state - KB, projects (each with versions and BOM components) and request statistics
+    def __init__(self, kb, latency=0.0, throttle=0.0):
+        self.kb = kb
+        self.latency = latency
+        self.throttle = throttle
+        self.throttle_prefix = "/api/"
+        self.throttle_methods = ("GET", "POST", "DELETE")
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.projects = {}      # pid -> dict(name, versions {vid: dict(name, bom {bomid: comp})})
+
+    def count(self, key, nbytes=0):
+        with self.lock:
+            entry = self.stats.setdefault(key, [0, 0])
+            entry[0] += 1
+            entry[1] += nbytes
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def base(self):
+            return "http://{}".format(self.headers.get('Host'))
+
+        def send_json(self, code, data, headers={}):
+            body = json.dumps(data).encode() if data is not None else b""
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+            return len(body)
+
+        def read_body(self):
+            try:
+                return json.loads(self.body) if self.body else {}
+            except ValueError:
+                return {}
+
+        def page(self, items, query):
+            offset = int(query.get('offset', ['0'])[0])
+            limit = int(query.get('limit', ['10'])[0])
+            return {'totalCount': len(items), 'items': items[offset:offset + limit]}
+
+        def handle_any(self, method):
+            url = urlparse(self.path)
+            path = url.path
+            query = parse_qs(url.query)
+            length = int(self.headers.get('Content-Length', 0))
+            self.body = self.rfile.read(length) if length else b""
+            if fake.latency:
+                time.sleep(fake.latency)
+            if fake.throttle and random.random() < fake.throttle and path.startswith(fake.throttle_prefix) and method in fake.throttle_methods and path != "/api/tokens/authenticate":
+                fake.count(method + " throttled")
+                return self.send_json(429, {'errorMessage': 'Too many requests'}, {'Retry-After': '1'})
+            key, code, data, headers = self.route(method, path, query)
+            nbytes = self.send_json(code, data, headers)
+            fake.count(key, nbytes)
+
+        def route(self, method, path, query):
+            base = self.base()
+            kb = fake.kb
+            if path == "/_stats":
+                return "stats", 200, fake.stats, {}
+            if path == "/_reset" and method == "POST":
+                fake.stats = {}
+                return "reset", 200, {}, {}
+            if path == "/api/tokens/authenticate" and method == "POST":
+                return "auth", 200, {'bearerToken': uuid.uuid4().hex, 'expiresInMilliseconds': 7200000}, {'X-CSRF-TOKEN': 'csrf'}
+            if path == "/api/current-version":
+                return "version", 200, {'version': '2023.1.0'}, {}
+            if path == "/api/search/components":
+                q = query.get('q', [''])[0]
+                name = q[5:] if q.startswith("name:") else q
+                ids = kb.byname.get(name.replace("+", " ").lower(), []) + kb.byname.get(name.lower(), [])
+                hits = [{'component': "{}/api/components/{}".format(base, cid)} for cid in dict.fromkeys(ids)]
+                return "search", 200, {'items': [{'searchResultStatistics': {'numResultsInThisPage': len(hits)}, 'hits': hits}]}, {}
+            m = re.match(r"^/api/components/([^/]+)(/versions)?$", path)
+            if m and method == "GET":
+                comp = kb.components.get(m.group(1))
+                if not comp:
+                    return "component", 404, {'errorMessage': 'Not found'}, {}
+                compurl = "{}/api/components/{}".format(base, m.group(1))
+                if m.group(2):
+                    items = [{'versionName': vname, '_meta': {'href': "{}/versions/{}".format(compurl, vid)}} for vid, vname in comp['versions']]
+                    return "versions", 200, self.page(items, query), {}
+                return "component", 200, {'name': comp['name'], 'url': comp['url'], '_meta': {'href': compurl, 'links': [{'rel': 'versions', 'href': compurl + "/versions"}]}}, {}
+            if path == "/api/projects":
+                if method == "POST":
+                    body = self.read_body()
+                    pid = str(uuid.uuid4())
+                    vid = str(uuid.uuid4())
+                    fake.projects[pid] = {'name': body.get('name'), 'versions': {vid: {'name': body.get('versionRequest', {}).get('versionName'), 'bom': {}}}}
+                    return "project create", 201, None, {'Location': "{}/api/projects/{}".format(base, pid)}
+                q = query.get('q', [''])[0].split(":", 1)[-1]
+                items = [self.project_json(pid) for pid, p in fake.projects.items() if q in p['name']]
+                return "project", 200, {'totalCount': len(items), 'items': items}, {}
+            m = re.match(r"^/api/projects/([^/]+)/versions$", path)
+            if m:
+                project = fake.projects.get(m.group(1))
+                if project is None:
+                    return "version", 404, None, {}
+                if method == "POST":
+                    body = self.read_body()
+                    vid = str(uuid.uuid4())
+                    project['versions'][vid] = {'name': body.get('versionName'), 'bom': {}}
+                    return "version create", 201, None, {}
+                q = query.get('q', [''])[0].split(":", 1)[-1]
+                items = [self.version_json(m.group(1), vid) for vid, v in project['versions'].items() if q in v['name']]
+                return "version", 200, {'totalCount': len(items), 'items': items}, {}
+            m = re.match(r"^/api/projects/([^/]+)/versions/([^/]+)/components(?:/([^/]+))?$", path)
+            if m:
+                project = fake.projects.get(m.group(1))
+                version = project and project['versions'].get(m.group(2))
+                if not version:
+                    return "bom", 404, None, {}
+                bom = version['bom']
+                if method == "GET":
+                    items = list(bom.values())
+                    return "bom get", 200, self.page(items, query), {}
+                if method == "POST":
+                    body = self.read_body()
+                    verurl = body.get('component', '')
+                    if any(c['componentVersion'] == verurl for c in bom.values()):
+                        return "bom post", 412, {'errorMessage': 'Component already exists'}, {}
+                    vm = re.match(r".*/api/components/([^/]+)/versions/([^/]+)$", verurl)
+                    comp = vm and kb.components.get(vm.group(1))
+                    if not comp:
+                        return "bom post", 404, {'errorMessage': 'Unknown component'}, {}
+                    vname = dict(comp['versions']).get(vm.group(2), '')
+                    bomid = str(uuid.uuid4())
+                    bom[bomid] = {
+                        'componentName': comp['name'], 'componentVersionName': vname,
+                        'component': verurl.rsplit("/versions/", 1)[0], 'componentVersion': verurl,
+                        'matchTypes': ['MANUAL_BOM_COMPONENT'],
+                        '_meta': {'href': "{}/api/projects/{}/versions/{}/components/{}".format(base, m.group(1), m.group(2), bomid)},
+                    }
+                    return "bom post", 200, {}, {}
+                if method == "DELETE" and m.group(3):
+                    if bom.pop(m.group(3), None) is None:
+                        return "bom delete", 404, None, {}
+                    return "bom delete", 204, None, {}
+            return "unknown", 404, {'errorMessage': 'Unknown endpoint'}, {}
+
+        def project_json(self, pid):
+            href = "{}/api/projects/{}".format(self.base(), pid)
+            return {'name': fake.projects[pid]['name'], '_meta': {'href': href, 'links': [{'rel': 'versions', 'href': href + "/versions"}]}}
+
+        def version_json(self, pid, vid):
+            href = "{}/api/projects/{}/versions/{}".format(self.base(), pid, vid)
+            return {'versionName': fake.projects[pid]['versions'][vid]['name'], '_meta': {'href': href, 'links': []}}
+
+        def do_GET(self):
+            self.handle_any("GET")
+
+        def do_POST(self):
+            self.handle_any("POST")
+
+        def do_DELETE(self):
+            self.handle_any("DELETE")
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local stand-in for the Black Duck server endpoints used by import_yocto_build_manifest.py')
+    parser.add_argument('--port', help='Port to listen on (default 8765)', type=int, default=8765)
+    parser.add_argument('--size', help='Number of synthetic KB components (default 1000)', type=int, default=1000)
+    parser.add_argument('--versions', help='Number of versions of each KB component (default 20)', type=int, default=20)
+    parser.add_argument('--seed', help='Random seed for KB version names (default 1)', type=int, default=1)
+    parser.add_argument('--latency', help='Delay in seconds added to every response (default 0)', type=float, default=0.0)
+    parser.add_argument('--throttle', help='Fraction of requests to reject with 429 Too Many Requests (default 0)', type=float, default=0.0)
+    parser.add_argument('--throttle-prefix', help='Only throttle requests for paths starting with this string (default "/api/")', default="/api/")
+    parser.add_argument('--throttle-methods', help='Comma separated list of HTTP methods to throttle (default "GET,POST,DELETE")', default="GET,POST,DELETE")
+    args = parser.parse_args()
+    kb = FakeKB(args.size, args.versions, args.seed)
+    kb.add_component("busybox", ["1.29.3", "1.30.0", "v1.31"])
+    kb.add_component("zlib", ["1.2.11", "1.2.10"])
+    fake = FakeHub(kb, args.latency, args.throttle)
+    fake.throttle_prefix = args.throttle_prefix
+    fake.throttle_methods = args.throttle_methods.split(",")
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(fake))
+    print("Serving fake Black Duck server on http://127.0.0.1:{}".format(args.port), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
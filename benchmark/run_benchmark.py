@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#
+# Throughput benchmark for import_yocto_build_manifest.py using the local fake Black Duck server (fake_hub.py)
+#
+# For each manifest size a fake server is started with a synthetic KB and a build manifest is generated from it
+# (mostly matching component versions, plus unknown versions, components not in the KB and SKIPPED components).
+# The script is then run in kblookup mode followed by import mode into a new project version, reporting for each run:
+#   - elapsed time and manifest entries (packages) processed per second
+#   - HTTP requests made to the server, in total and per package
+#   - peak RSS of the script process
+#
+# Example:
+#   python3 benchmark/run_benchmark.py --sizes 1000 10000 50000 --latency 0.005
+#   python3 benchmark/run_benchmark.py --sizes 1000 --script-args "--async --max-inflight 50"
+#
+# Each run uses an empty KB response cache unless --warm is specified (which runs kblookup twice and reports the
+# second run)
+
+import argparse
+import json
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from fake_hub import FakeKB
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(BENCHDIR), "import_yocto_build_manifest.py")
+VERSIONS = 20       # Versions of each synthetic KB component
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_request(port, path, method="GET"):
+    request = urllib.request.Request("http://127.0.0.1:{}{}".format(port, path), method=method)
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read() or b"{}")
+
+
+def start_server(port, kbsize, latency):
+    server = subprocess.Popen([sys.executable, os.path.join(BENCHDIR, "fake_hub.py"), "--port", str(port),
+                               "--size", str(kbsize), "--versions", str(VERSIONS), "--latency", str(latency)],
+                              stdout=subprocess.DEVNULL)
+    start = time.time()
+    while time.time() - start < 120:
+        try:
+            server_request(port, "/api/current-version")
+            return server
+        except OSError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("Fake server failed to start")
+
+
+def write_manifest(filename, size, kbsize, seed=1):
+    #
+    # 80% KB component versions, 10% unknown versions of KB components, 5% components not in the KB and
+    # 5% kernel modules (SKIPPED by the replacement file) - all entries are distinct
+    kb = FakeKB(kbsize, VERSIONS)
+    names = [comp['name'] for comp in kb.components.values()]
+    versions = {comp['name']: [v for vid, v in comp['versions']] for comp in kb.components.values()}
+    rnd = random.Random(seed)
+    entries = set()
+    while len(entries) < size:
+        kind = rnd.random()
+        if kind < 0.8:
+            name = rnd.choice(names)
+            entries.add((name, rnd.choice(versions[name])))
+        elif kind < 0.9:
+            entries.add((rnd.choice(names), "9.{}.{}".format(rnd.randint(0, 99), rnd.randint(0, 99))))
+        elif kind < 0.95:
+            entries.add(("unknown{}".format(rnd.randint(0, size)), "1.0"))
+        else:
+            entries.add(("kernel-module-mod{}".format(rnd.randint(0, size)), "5.4.0"))
+    with open(filename, "w") as mfile:
+        for name, version in sorted(entries):
+            mfile.write("{} aarch64 {}\n".format(name, version))
+
+
+def run_script(workdir, args, logname):
+    #
+    # Run the script and return elapsed seconds, exit status and peak RSS (MB) of the process
+    start = time.time()
+    with open(os.path.join(workdir, logname), "w") as logfile:
+        process = subprocess.Popen([sys.executable, SCRIPT] + args, cwd=workdir, stdout=logfile, stderr=subprocess.STDOUT)
+        pid, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    returncode = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else status
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    maxrss = rusage.ru_maxrss / 1024 if sys.platform != "darwin" else rusage.ru_maxrss / (1024 * 1024)
+    return elapsed, returncode, maxrss
+
+
+def measure(port, workdir, mode, size, args, logname):
+    server_request(port, "/_reset", "POST")
+    elapsed, returncode, maxrss = run_script(workdir, args, logname)
+    stats = server_request(port, "/_stats")
+    calls = sum(count for key, (count, nbytes) in stats.items() if key not in ("stats", "reset"))
+    nbytes = sum(nbytes for key, (count, nbytes) in stats.items() if key not in ("stats", "reset"))
+    return {
+        'mode': mode,
+        'entries': size,
+        'seconds': round(elapsed, 2),
+        'packages_per_sec': round(size / elapsed, 1) if elapsed else 0,
+        'http_calls': calls,
+        'calls_per_package': round(calls / size, 2),
+        'response_mb': round(nbytes / (1024 * 1024), 2),
+        'peak_rss_mb': round(maxrss, 1),
+        'returncode': returncode,
+        'calls': {key: count for key, (count, nbytes) in sorted(stats.items()) if key not in ("stats", "reset")},
+    }
+
+
+def run_size(size, opts):
+    kbsize = max(size // 4, 100)
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix="yocto_bench_{}_".format(size), dir=opts.workdir)
+    with open(os.path.join(workdir, ".restconfig.json"), "w") as cfile:
+        json.dump({'baseurl': "http://127.0.0.1:{}".format(port), 'api_token': "benchmark", 'insecure': True, 'debug': False}, cfile)
+    with open(os.path.join(workdir, "replace.txt"), "w") as rfile:
+        rfile.write("kernel-module;SKIP\n")
+    write_manifest(os.path.join(workdir, "bench.manifest"), size, kbsize)
+
+    extra = shlex.split(opts.script_args)
+    cache = ["--cache-dir", os.path.join(workdir, "cache")]
+    results = []
+    server = start_server(port, kbsize, opts.latency)
+    try:
+        kblookup = ["kblookup", "-c", "bench.manifest", "-r", "replace.txt", "-o", "kblookup.out"] + cache + extra
+        results.append(measure(port, workdir, "kblookup", size, kblookup, "kblookup.log"))
+        if opts.warm:
+            os.remove(os.path.join(workdir, "kblookup.out"))
+            results.append(measure(port, workdir, "kblookup (warm)", size, kblookup, "kblookup_warm.log"))
+        if not opts.no_import:
+            importargs = ["import", "-c", "bench.manifest", "-k", "kblookup.out", "-p", "benchmark",
+                          "-v", "v{}".format(size)] + cache + extra
+            results.append(measure(port, workdir, "import", size, importargs, "import.log"))
+    finally:
+        server.terminate()
+        server.wait()
+    for result in results:
+        result['workdir'] = workdir
+    return results
+
+
+def print_results(results):
+    header = "{:<16} {:>8} {:>9} {:>10} {:>10} {:>10} {:>9}".format(
+        "mode", "entries", "seconds", "pkgs/sec", "http calls", "calls/pkg", "RSS MB")
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print("{:<16} {:>8} {:>9.2f} {:>10.1f} {:>10} {:>10.2f} {:>9.1f}{}".format(
+            result['mode'], result['entries'], result['seconds'], result['packages_per_sec'], result['http_calls'],
+            result['calls_per_package'], result['peak_rss_mb'],
+            "" if result['returncode'] == 0 else "  (exit {})".format(result['returncode'])))
+
+
+parser = argparse.ArgumentParser(description='Benchmark import_yocto_build_manifest.py against a local fake Black Duck server')
+parser.add_argument('--sizes', help='Manifest sizes (number of entries) to benchmark (default 1000 10000 50000)', type=int, nargs='+', default=[1000, 10000, 50000])
+parser.add_argument('--latency', help='Delay in seconds added to each fake server response (default 0)', type=float, default=0.0)
+parser.add_argument('--script-args', help='Extra options passed to both kblookup and import runs (e.g. "-w 8" or "--async")', default="")
+parser.add_argument('--warm', help='Also run kblookup a second time with the KB response cache populated', action='store_true')
+parser.add_argument('--no-import', help='Only benchmark kblookup mode', action='store_true')
+parser.add_argument('--workdir', help='Directory for the benchmark run directories (default system temp directory)')
+parser.add_argument('--json', help='Write results to this file as JSON')
+
+if __name__ == "__main__":
+    opts = parser.parse_args()
+    allresults = []
+    for size in opts.sizes:
+        print("Benchmarking {} manifest entries ...".format(size), flush=True)
+        results = run_size(size, opts)
+        print_results(results)
+        print("(run directory {})".format(results[0]['workdir']))
+        print("")
+        allresults += results
+
+    print("SUMMARY:")
+    print_results(allresults)
+    if opts.json:
+        with open(opts.json, "w") as jfile:
+            json.dump(allresults, jfile, indent=2)
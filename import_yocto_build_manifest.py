@@ -26,115 +26,1214 @@
 #   kernel-module;SKIP
 
 import argparse
-#import json
+import asyncio
+import atexit
+import bisect
+import cProfile
+import csv
+import email.utils
+import fnmatch
+import functools
+import glob
+import hashlib
+import itertools
+import json
 import logging
+import multiprocessing
+import os
+import pstats
+import random
 import re
-from difflib import SequenceMatcher
+import requests
+import signal
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 from blackduck.HubRestApi import HubInstance
 
-logging.basicConfig(filename='import_yocto_build_manifest.log',level=logging.INFO)
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
-hub = HubInstance()
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 kblookupdict = {}   # Dict of component names from kbfile with matching array of component URLs for each
 kbverdict = {}      # Dict of component/version strings with single component version URL for each
-kbnomatchcomplist = []  # List of components which returned no match in KB
-manualcomplist = {} # Dict of manually added components for optional deletion if -d specified
-repdict = {}        # Dict of component name replacement strings
-skiplist = []       # List of component name strings to skip
-listfile = ""
+kbnomatchcomps = set()  # Set of component search names which returned no match in KB
+kbsearchresults = {}    # Dict of component search names with list of KB search hits (each search run once per run)
+manualcomplist = {} # Dict of manually added components (KB component version URL with BOM component URL) for optional deletion if -d specified
+reprules = None     # Component name replacement and SKIP rules (ReplacementRules) from the replacement file
+listfile = None     # Output listfile (opened once for the run if -l specified)
+kbcache = None      # Persistent KB response cache (KBCache) unless --no-cache specified
+matchstore = None   # Shared store of kblookup results (MatchStore) unless --no-cache specified
+pkgdata = None      # Yocto pkgdata (PkgData) mapping manifest packages to recipes if --pkgdata specified
+reciperesults = {}  # Dict of (recipe, version) with find_comp_from_kb() result for each (searched once per run)
+recipehints = {}    # Dict of package names with (recipe, version) given in the input file (license.manifest or SPDX)
+sourcenames = {}    # Dict of recipe names with KB search names from their source URLs (SPDX)
+profiler = None     # Profiler for the hot path functions if --profile specified
+batchprofiles = []  # Profile files written by batch worker processes
+resultswriter = None    # Per-entry result records (ResultsWriter) if --results specified
+explainrules = False    # Report the replacement file rule applied to each manifest entry (--explain)
 
-def get_kb_component(componentname):
-    #print("DEBUG: processing component {}".format(componentname))
+#
+# Time to live (seconds) for cached KB responses by endpoint
+CACHE_TTLS = {
+    'search': 7 * 24 * 3600,        # /api/search/components results
+    'component': 30 * 24 * 3600,    # KB component details
+    'versions': 24 * 3600,          # KB component version lists (new versions are released most often)
+}
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "import_yocto_build_manifest")
+UMASK = os.umask(0)     # Process umask (read once - setting it is not thread safe)
+os.umask(UMASK)
+
+def output_file_mode(filename):
+    #
+    # Permissions for an output file rewritten from a temporary file (tempfile.mkstemp() creates files readable
+    # only by the owner) - those of the existing file, or the default for a new file as open() would create it
+    try:
+        return os.stat(filename).st_mode & 0o7777
+    except FileNotFoundError:
+        return 0o666 & ~UMASK
+
+class KBResponse:
+    #
+    # Minimal stand-in for a requests Response returned for cached KB data
+    def __init__(self, status_code, data, headers=None):
+        self.status_code = status_code
+        self._data = data
+        self.headers = headers or {}
+
+    def json(self):
+        return self._data
+
+class KBCache:
+    #
+    # Persistent on-disk cache of KB GET responses
+    # One JSON file per URL under <cachedir>/<endpoint>/, written atomically so concurrent runs can share the cache
+    # Entries expire after the endpoint TTL and the oldest (least recently used) entries are removed by prune()
+    # once the cache exceeds maxsize bytes
+    def __init__(self, cachedir, maxsize):
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, url, endpoint):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cachedir, endpoint, key[:2], key + ".json")
+
+    def get(self, url, endpoint):
+        path = self._path(url, endpoint)
+        try:
+            with open(path, "r") as cfile:
+                entry = json.load(cfile)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        if entry.get('url') != url or time.time() - entry.get('time', 0) > CACHE_TTLS[endpoint]:
+            self.misses += 1
+            return None
+        try:
+            # Update mtime to record last use for eviction
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return entry['data']
+
+    def put(self, url, endpoint, data):
+        path = self._path(url, endpoint)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w") as cfile:
+                json.dump({'url': url, 'time': time.time(), 'data': data}, cfile)
+            os.replace(tmppath, path)
+        except OSError as e:
+            logging.error("KBCache.put(): Failed to write cache file {} - {}".format(path, e))
+
+    def prune(self):
+        #
+        # Remove expired entries then evict least recently used entries until within maxsize
+        now = time.time()
+        entries = []
+        total = 0
+        for endpoint in CACHE_TTLS:
+            for root, dirs, files in os.walk(os.path.join(self.cachedir, endpoint)):
+                for fname in files:
+                    path = os.path.join(root, fname)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if fname.endswith(".tmp") or now - stat.st_mtime > CACHE_TTLS[endpoint]:
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                    total += stat.st_size
+
+        count = 0
+        if total > self.maxsize:
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.maxsize:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                count += 1
+        logging.info("KBCache: {} hits, {} misses, {} entries evicted, {} bytes used".format(self.hits, self.misses, count, total))
+
+class MatchStore:
+    #
+    # Shared store of kblookup results (from resolve_manifest_entry()) under
+    # <cachedir>/matches/<server URL digest>/<replacement file digest>/ so that concurrent and later runs on the
+    # same host against the same Black Duck server reuse each other's resolved component and version URLs
+    # - each process appends its results (JSON lines) to its own segment file, holding an exclusive lock on it
+    #   for as long as it is open, so results are published without any shared locking
+    # - results published by other processes are read from all segments (new lines only, at most every REFRESH
+    #   seconds when a result is not found)
+    # - close() merges the segments of finished processes into matches.jsonl (under matches.lock) once there
+    #   are COMPACT_SEGMENTS of them, dropping expired results
+    # Results are keyed by the component, version, the KB component URLs known for the component from the
+    # KB Lookup File and the recipe searched for it with --pkgdata (which determine the result)
+    # Results without a match expire after the 'versions' cache TTL and matches after the 'component' cache TTL
+    REFRESH = 5.0
+    COMPACT_SEGMENTS = 16
+
+    def __init__(self, cachedir, server, digest):
+        serverdigest = hashlib.sha1(server.encode('utf-8')).hexdigest()
+        self.dirname = os.path.join(cachedir, "matches", serverdigest[:16], digest[:16] or "default")
+        self.results = {}       # Dict of (component, version, KB component URLs, recipe) with (time, result)
+        self.offsets = {}       # Dict of (file name, inode) with offset read to
+        self.lock = threading.Lock()
+        self.segment = None     # Segment file descriptor for this process
+        self.pid = None
+        self.refreshed = 0.0
+
+    @staticmethod
+    def key(package, version):
+        compurls = kblookupdict[package] if package in kblookupdict else []
+        return package, version, tuple(compurls), tuple(package_recipe(package) or ())
+
+    @staticmethod
+    def expired(entrytime, result):
+        matched = result[0] != "NO VERSION MATCH" or (result[1] != "" and result[1].split(";")[3] != "NO MATCH")
+        return time.time() - entrytime > CACHE_TTLS['component' if matched else 'versions']
+
+    def read(self, path, offset, results):
+        #
+        # Add the complete lines from offset in a segment (or matches.jsonl) to results - returns the new offset
+        try:
+            with open(path, "rb") as sfile:
+                sfile.seek(offset)
+                data = sfile.read()
+        except OSError:
+            return offset
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line)
+                key = (entry['package'], entry['version'], tuple(entry['compurls']), tuple(entry.get('recipe', ())))
+                entrytime, result = entry['time'], tuple(entry['result'])
+            except (ValueError, KeyError, TypeError):
+                continue
+            if not self.expired(entrytime, result) and (key not in results or results[key][0] < entrytime):
+                results[key] = (entrytime, result)
+        return offset + end
+
+    def files(self):
+        try:
+            names = os.listdir(self.dirname)
+        except OSError:
+            return []
+        return [name for name in names if name == "matches.jsonl" or (name.startswith("segment-") and name.endswith(".jsonl"))]
+
+    def refresh(self):
+        #
+        # Read results published since the last refresh (called holding self.lock)
+        self.refreshed = time.monotonic()
+        for name in self.files():
+            path = os.path.join(self.dirname, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            # matches.jsonl is replaced by compact() so files are tracked by inode as well as name
+            offset = self.offsets.get((name, stat.st_ino), 0)
+            if stat.st_size > offset:
+                self.offsets[(name, stat.st_ino)] = self.read(path, offset, self.results)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.results.get(key)
+            if entry is None and time.monotonic() - self.refreshed > self.REFRESH:
+                self.refresh()
+                entry = self.results.get(key)
+        if entry is None or self.expired(*entry):
+            return None
+        metrics.count('shared_matches')
+        result = entry[1]
+        return result[:4] + (dict(result[4]),)
+
+    def put(self, key, result):
+        entry = {'time': time.time(), 'package': key[0], 'version': key[1], 'compurls': list(key[2]), 'recipe': list(key[3]),
+                 'result': result}
+        line = (json.dumps(entry) + "\n").encode("utf-8")
+        with self.lock:
+            self.results[key] = (entry['time'], tuple(result))
+            if self.open_segment():
+                try:
+                    os.write(self.segment, line)
+                except OSError as e:
+                    logging.error("MatchStore.put(): Failed to write segment - {}".format(e))
+
+    def open_segment(self):
+        #
+        # Open the segment for this process (a forked batch worker process opens its own segment)
+        if self.segment is not None and self.pid == os.getpid():
+            return True
+        try:
+            os.makedirs(self.dirname, exist_ok=True)
+            fd, path = tempfile.mkstemp(dir=self.dirname, prefix="segment-", suffix=".jsonl")
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+        except OSError as e:
+            logging.error("MatchStore.open_segment(): Failed to create segment in {} - {}".format(self.dirname, e))
+            return False
+        self.segment = fd
+        self.pid = os.getpid()
+        self.offsets[(os.path.basename(path), os.fstat(fd).st_ino)] = 0
+        logging.debug("MatchStore: writing segment {}".format(path))
+        return True
+
+    def close(self):
+        with self.lock:
+            if self.segment is not None and self.pid == os.getpid():
+                os.close(self.segment)
+            self.segment = None
+        self.compact()
+
+    def compact(self, force=False):
+        #
+        # Merge the segments of finished processes into matches.jsonl - segments still locked by a running
+        # process are left alone, and nothing is done if another process is already compacting
+        if fcntl is None:
+            return
+        try:
+            lockfile = open(os.path.join(self.dirname, "matches.lock"), "a")
+        except OSError:
+            return
+        with lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+            segments = []
+            try:
+                for name in self.files():
+                    if name == "matches.jsonl":
+                        continue
+                    path = os.path.join(self.dirname, name)
+                    try:
+                        fd = os.open(path, os.O_RDONLY)
+                    except OSError:
+                        continue
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        # (an empty segment may not be locked by its new writer yet)
+                        stat = os.fstat(fd)
+                        if stat.st_size == 0 and time.time() - stat.st_mtime < 60:
+                            raise OSError("new segment")
+                    except OSError:
+                        os.close(fd)
+                        continue
+                    segments.append((path, fd))
+                if len(segments) < self.COMPACT_SEGMENTS and not force:
+                    return
+                results = {}
+                for path in [os.path.join(self.dirname, "matches.jsonl")] + [path for path, fd in segments]:
+                    self.read(path, 0, results)
+                fd, tmppath = tempfile.mkstemp(dir=self.dirname, prefix="matches", suffix=".tmp")
+                with os.fdopen(fd, "w") as mfile:
+                    for (package, version, compurls, recipe), (entrytime, result) in results.items():
+                        mfile.write(json.dumps({'time': entrytime, 'package': package, 'version': version,
+                                                'compurls': list(compurls), 'recipe': list(recipe), 'result': result}) + "\n")
+                os.replace(tmppath, os.path.join(self.dirname, "matches.jsonl"))
+                for path, fd in segments:
+                    os.remove(path)
+                logging.info("MatchStore: compacted {} segments into {} results".format(len(segments), len(results)))
+            except OSError as e:
+                logging.error("MatchStore.compact(): Failed to compact {} - {}".format(self.dirname, e))
+            finally:
+                for path, fd in segments:
+                    os.close(fd)
+
+class Metrics:
+    #
+    # Run metrics written by --metrics at the end of the run
+    # - call counts and latency histograms for the hot path functions, HTTP requests (by endpoint) and manifest
+    #   entries (per-package wall time)
+    # - HTTP requests by endpoint and status code, and response bytes received
+    # - counters (lookups answered from the per-run search and component version dicts)
+    # KB response cache hits and misses are taken from kbcache when the report is written (batch worker counts are
+    # added to kbcache by merge())
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    PREFIX = "import_yocto_build_manifest"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.timings = {}   # Dict of name with dict(count, sum, max, buckets)
+        self.http = {}      # Dict of endpoint with dict(bytes, status (dict of status code with count))
+        self.counters = {}  # Dict of name with count
+
+    def observe(self, name, seconds):
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(self.BUCKETS)}
+            timing['count'] += 1
+            timing['sum'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+            for index, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    timing['buckets'][index] += 1
+                    break
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def http_response(self, endpoint, status, nbytes, seconds):
+        self.observe("http:" + endpoint, seconds)
+        with self.lock:
+            http = self.http.setdefault(endpoint, {'bytes': 0, 'status': {}})
+            http['bytes'] += nbytes
+            http['status'][str(status)] = http['status'].get(str(status), 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps({'timings': self.timings, 'http': self.http, 'counters': self.counters}))
+
+    def merge(self, snapshot):
+        #
+        # Add metrics from a batch worker process
+        if kbcache and 'cache' in snapshot:
+            kbcache.hits += snapshot['cache']['hits']
+            kbcache.misses += snapshot['cache']['misses']
+        with self.lock:
+            for name, timing in snapshot['timings'].items():
+                mine = self.timings.setdefault(name, {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(self.BUCKETS)})
+                mine['count'] += timing['count']
+                mine['sum'] += timing['sum']
+                mine['max'] = max(mine['max'], timing['max'])
+                mine['buckets'] = [a + b for a, b in zip(mine['buckets'], timing['buckets'])]
+            for endpoint, http in snapshot['http'].items():
+                mine = self.http.setdefault(endpoint, {'bytes': 0, 'status': {}})
+                mine['bytes'] += http['bytes']
+                for status, count in http['status'].items():
+                    mine['status'][status] = mine['status'].get(status, 0) + count
+            for name, value in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self, command):
+        data = self.snapshot()
+        timings = {}
+        for name, timing in data['timings'].items():
+            cumulative = 0
+            histogram = {}
+            for bound, count in zip(self.BUCKETS, timing['buckets']):
+                cumulative += count
+                histogram[str(bound)] = cumulative
+            histogram['+Inf'] = timing['count']
+            timings[name] = {
+                'count': timing['count'],
+                'total_seconds': round(timing['sum'], 6),
+                'mean_seconds': round(timing['sum'] / timing['count'], 6) if timing['count'] else 0,
+                'max_seconds': round(timing['max'], 6),
+                'histogram': histogram,
+            }
+        for endpoint, http in data['http'].items():
+            http['requests'] = sum(http['status'].values())
+        cache = {'hits': 0, 'misses': 0, 'hit_ratio': None}
+        if kbcache:
+            cache = {'hits': kbcache.hits, 'misses': kbcache.misses,
+                     'hit_ratio': round(kbcache.hits / (kbcache.hits + kbcache.misses), 4) if kbcache.hits + kbcache.misses else None}
+        return {
+            'command': command,
+            'elapsed_seconds': round(time.time() - self.start, 3),
+            'functions': {name: timing for name, timing in timings.items() if ":" not in name and name != 'package'},
+            'packages': timings.get('package'),
+            'http': {endpoint: dict(http, latency=timings.get("http:" + endpoint)) for endpoint, http in data['http'].items()},
+            'cache': cache,
+            'counters': data['counters'],
+        }
+
+    def prometheus(self, report):
+        lines = []
+
+        def histogram(metric, help, label, items):
+            lines.append("# HELP {}_{} {}".format(self.PREFIX, metric, help))
+            lines.append("# TYPE {}_{} histogram".format(self.PREFIX, metric))
+            for value, timing in items:
+                labels = '{}="{}"'.format(label, value) if label else ""
+                for bound, count in timing['histogram'].items():
+                    lines.append('{}_{}_bucket{{{}le="{}"}} {}'.format(self.PREFIX, metric, labels + "," if labels else "", bound, count))
+                lines.append('{}_{}_sum{} {}'.format(self.PREFIX, metric, "{" + labels + "}" if labels else "", timing['total_seconds']))
+                lines.append('{}_{}_count{} {}'.format(self.PREFIX, metric, "{" + labels + "}" if labels else "", timing['count']))
+
+        def metric(name, type, help, items):
+            lines.append("# HELP {}_{} {}".format(self.PREFIX, name, help))
+            lines.append("# TYPE {}_{} {}".format(self.PREFIX, name, type))
+            for labels, value in items:
+                lines.append("{}_{}{} {}".format(self.PREFIX, name, "{" + labels + "}" if labels else "", value))
+
+        metric("run_seconds", "gauge", "Elapsed time of the run", [("", report['elapsed_seconds'])])
+        histogram("function_seconds", "Latency of hot path functions", "function", sorted(report['functions'].items()))
+        if report['packages']:
+            histogram("package_seconds", "Wall time to resolve each manifest entry", None, [("", report['packages'])])
+        histogram("http_request_seconds", "Latency of HTTP requests", "endpoint",
+                  [(endpoint, http['latency']) for endpoint, http in sorted(report['http'].items())])
+        metric("http_requests_total", "counter", "HTTP requests by endpoint and status code",
+               [('endpoint="{}",status="{}"'.format(endpoint, status), count)
+                for endpoint, http in sorted(report['http'].items()) for status, count in sorted(http['status'].items())])
+        metric("http_response_bytes_total", "counter", "HTTP response bytes received",
+               [('endpoint="{}"'.format(endpoint), http['bytes']) for endpoint, http in sorted(report['http'].items())])
+        metric("cache_hits_total", "counter", "KB response cache hits", [("", report['cache']['hits'])])
+        metric("cache_misses_total", "counter", "KB response cache misses", [("", report['cache']['misses'])])
+        if report['cache']['hit_ratio'] is not None:
+            metric("cache_hit_ratio", "gauge", "KB response cache hit ratio", [("", report['cache']['hit_ratio'])])
+        for name, value in sorted(report['counters'].items()):
+            metric(name + "_total", "counter", name.replace("_", " "), [("", value)])
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename, command):
+        #
+        # Write the report as Prometheus text format for *.prom or *.txt files, otherwise JSON
+        report = self.report(command)
+        try:
+            with open(filename, "w") as mfile:
+                if os.path.splitext(filename)[1].lower() in (".prom", ".txt"):
+                    mfile.write(self.prometheus(report))
+                else:
+                    json.dump(report, mfile, indent=2)
+        except OSError as e:
+            logging.error("Metrics.write(): Failed to write {} - {}".format(filename, e))
+            return
+        print("Wrote run metrics to {}".format(filename))
+
+metrics = Metrics()
+
+class Profiler:
+    #
+    # cProfile of the hot path functions for --profile - each thread has its own profile (enabled while the
+    # outermost instrumented function runs) and the profiles are combined when written
+    def __init__(self, filename):
+        self.filename = filename
+        self.profiles = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def enter(self):
+        depth = getattr(self.local, 'depth', 0)
+        self.local.depth = depth + 1
+        if depth > 0 or getattr(self.local, 'disabled', False):
+            return
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            profile = self.local.profile = cProfile.Profile()
+            with self.lock:
+                self.profiles.append(profile)
+        try:
+            profile.enable()
+        except ValueError:
+            # Only one profiler can be active at a time from Python 3.12 - this thread is not profiled
+            logging.warning("Profiler: cannot profile thread {}".format(threading.current_thread().name))
+            self.local.disabled = True
+
+    def exit(self):
+        self.local.depth -= 1
+        if self.local.depth == 0 and not getattr(self.local, 'disabled', False):
+            self.local.profile.disable()
+
+    def stats(self):
+        with self.lock:
+            profiles = [profile for profile in self.profiles if profile.getstats()]
+        if not profiles:
+            return None
+        return pstats.Stats(*profiles)
+
+    def write(self, extra=()):
+        #
+        # extra is a list of profile files from batch worker processes to add (and remove)
+        stats = self.stats()
+        for filename in extra:
+            if stats is None:
+                stats = pstats.Stats(filename)
+            else:
+                stats.add(filename)
+            os.remove(filename)
+        if stats is None:
+            print("No profile data recorded")
+            return
+        stats.dump_stats(self.filename)
+        print("Wrote profile of hot path functions to {} (view with: python3 -m pstats {})".format(self.filename, self.filename))
+
+def instrumented(name):
+    #
+    # Decorator recording call count and latency of a hot path function in metrics (and profiling it if --profile)
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*params, **kwargs):
+            if profiler:
+                profiler.enter()
+            start = time.perf_counter()
+            try:
+                return func(*params, **kwargs)
+            finally:
+                metrics.observe(name, time.perf_counter() - start)
+                if profiler:
+                    profiler.exit()
+        return wrapper
+    return decorator
+
+class TokenCacheHubInstance(HubInstance):
+    #
+    # HubInstance which keeps the bearer token from API token authentication (and the server version) in a
+    # private file (owner read/write only) under the cache directory, keyed by a hash of the server URL and
+    # API token, and reuses it in later runs until shortly before it expires
+    # Username/password authentication is not cached, and API token authentication is not cached if TOKEN_DIR is
+    # None (set from --cache-dir and --no-cache by open_kbcache())
+    TOKEN_DIR = os.path.join(CACHE_DIR, "tokens")
+    EXPIRY_MARGIN = 300     # Seconds before expiry when a cached token is no longer used
+
+    def token_file(self):
+        api_token = self.config.get('api_token')
+        if not api_token or not self.TOKEN_DIR:
+            return None
+        key = hashlib.sha256("{}\n{}".format(self.config['baseurl'], api_token).encode()).hexdigest()
+        return os.path.join(self.TOKEN_DIR, key + ".json")
+
+    def load_token(self, tokenfile):
+        try:
+            with open(tokenfile, "r") as tfile:
+                info = os.fstat(tfile.fileno())
+                if info.st_uid != os.getuid() or info.st_mode & 0o077:
+                    logging.warning("Ignoring cached token file {} - not private to the current user".format(tokenfile))
+                    return None
+                cached = json.load(tfile)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning("Ignoring cached token file {} - {}".format(tokenfile, e))
+            return None
+        if not isinstance(cached, dict) or cached.get('expires', 0) - time.time() < self.EXPIRY_MARGIN:
+            return None
+        return cached
+
+    def save_token(self):
+        tokenfile = self.token_file()
+        if tokenfile is None:
+            return
+        try:
+            os.makedirs(self.TOKEN_DIR, mode=0o700, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=self.TOKEN_DIR, suffix=".tmp")
+            with os.fdopen(fd, "w") as tfile:
+                json.dump(self.cachedtoken, tfile)
+            os.replace(tmpname, tokenfile)
+        except OSError as e:
+            logging.warning("Failed to write cached token file {} - {}".format(tokenfile, e))
+
+    def discard_token(self):
+        tokenfile = self.token_file()
+        if tokenfile:
+            try:
+                os.remove(tokenfile)
+            except OSError:
+                pass
+
+    def get_auth_token(self):
+        self.cachedtoken = {}
+        if not self.config.get('api_token'):
+            return super().get_auth_token()
+        tokenfile = self.token_file()
+        cached = self.load_token(tokenfile) if tokenfile else None
+        if cached:
+            logging.info("Using cached bearer token (expires {})".format(time.ctime(cached['expires'])))
+            metrics.count("auth_token_reused")
+            self.cachedtoken = cached
+            return cached['bearerToken'], cached['csrfToken'], None
+
+        post = functools.partial(requests.post, headers={'Authorization': 'token {}'.format(self.config['api_token'])},
+                                 verify=not self.config['insecure'])
+        response = http_request('auth', post, self.config['baseurl'] + "/api/tokens/authenticate")
+        try:
+            data = response.json()
+            self.cachedtoken = {
+                'bearerToken': data['bearerToken'],
+                'csrfToken': response.headers.get('X-CSRF-TOKEN'),
+                'expires': time.time() + data.get('expiresInMilliseconds', 0) / 1000,
+            }
+        except (ValueError, KeyError, TypeError):
+            logging.error("Authentication failure, could not obtain bearer token (status code {})".format(response.status_code))
+            raise Exception("Failed to obtain bearer token, check for valid authentication token")
+        if hasattr(self, 'version_info'):
+            # Re-authentication after the server version is known
+            self.cachedtoken['version_info'] = self.version_info
+            self.save_token()
+        return self.cachedtoken['bearerToken'], self.cachedtoken['csrfToken'], None
+
+    def _get_hub_rest_api_version_info(self):
+        #
+        # Requested through http_request() (rather than by HubInstance) so a throttled or failed request is retried
+        if 'version_info' in self.cachedtoken:
+            return self.cachedtoken['version_info']
+        get = functools.partial(requests.get, verify=not self.config['insecure'])
+        response = http_request('server_version', get, self.config['baseurl'] + "/api/current-version")
+        try:
+            version_info = response.json() if response.status_code == 200 else None
+        except ValueError:
+            version_info = None
+        if not isinstance(version_info, dict) or 'version' not in version_info:
+            # Assume version 3 as HubInstance does - not cached so the version is requested again in the next run
+            logging.warning("Failed to retrieve the Black Duck server version (status code {})".format(response.status_code))
+            return {'version': '3'}
+        if self.cachedtoken:
+            self.cachedtoken['version_info'] = version_info
+            self.save_token()
+        return version_info
+
+class LazyHub:
+    #
+    # Stand-in for the HubInstance which only connects (authenticates) to the Black Duck server when the first
+    # request is made, so --help and runs resolved entirely from the KB Lookup File and KB response cache make
+    # no network calls - the server URL and options are read from .restconfig.json without connecting
+    def __init__(self):
+        self.instance = None
+        self.lock = threading.Lock()
+        self.fileconfig = None
+
+    @property
+    def config(self):
+        if self.instance is not None:
+            return self.instance.config
+        if self.fileconfig is None:
+            try:
+                with open(HubInstance.configfile, "r") as cfile:
+                    self.fileconfig = json.load(cfile)
+            except (OSError, ValueError):
+                # Report the missing or invalid configuration as HubInstance does
+                return self.connect().config
+        return self.fileconfig
+
+    def get_urlbase(self):
+        return self.config['baseurl']
+
+    def connect(self):
+        with self.lock:
+            if self.instance is None:
+                logging.info("Connecting to Black Duck server")
+                start = time.perf_counter()
+                self.instance = TokenCacheHubInstance()
+                metrics.observe('hub_connect', time.perf_counter() - start)
+        return self.instance
+
+    def __getattr__(self, name):
+        return getattr(self.connect(), name)
+
+    def reauthenticate(self, token):
+        #
+        # Replace a bearer token rejected by the server (expired or revoked) - concurrent requests which failed
+        # with the same token only re-authenticate once
+        instance = self.connect()
+        with self.lock:
+            if instance.token == token:
+                logging.info("Bearer token rejected by server - authenticating again")
+                instance.discard_token()
+                instance.token, instance.csrf_token, instance.cookie = instance.get_auth_token()
+
+hub = LazyHub()
+
+TRANSIENT_STATUS_CODES = (429, 500, 502, 503, 504)
+THROTTLE_STATUS_CODES = (429, 503)
+# KB GETs and the requests made while connecting are retried by http_request() (BOM updates are retried by BOMWriter)
+RETRIED_ENDPOINTS = ('search', 'component', 'versions', 'auth', 'server_version')
+UNAUTHENTICATED_ENDPOINTS = ('auth', 'server_version')     # Requests made while connecting (no bearer token)
+
+class KBRequestError(Exception):
+    #
+    # A KB request was throttled or failed with a server or connection error after all retries - the result
+    # of the lookup is unknown so it must not be recorded as NO MATCH
+    pass
+
+def retry_after_seconds(headers):
+    #
+    # Returns the delay from the Retry-After header of a response (seconds or HTTP date) or None
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+class HubThrottle:
+    #
+    # Client side limits for the Hub requests of a run (shared by all threads, or all tasks in --async mode)
+    # - token bucket: at most rate requests per second on average, in bursts of up to rate requests (--max-rate)
+    # - adaptive concurrency (AIMD): at most limit requests in flight - the limit grows by 1 for every limit
+    #   responses up to maxlimit (the workers or --max-inflight) and is halved when the server throttles a request
+    #   (429/503), at most once per COOLDOWN seconds so a burst of throttled responses only halves it once
+    #   (with maxlimit 0 there is no limit until the first throttled response, then maxlimit is the requests in flight)
+    # - Retry-After: all requests are paused until the time given by the server in a throttled response
+    # Throttled or failed KB requests are retried up to retries times with exponential backoff (see retry_delay())
+    COOLDOWN = 1.0
+    MAX_BACKOFF = 60.0
+
+    def __init__(self, rate=0.0, maxlimit=0, retries=4, backoff=0.5):
+        self.rate = rate
+        self.burst = max(rate, 1.0)
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+        self.maxlimit = maxlimit
+        self.limit = float(maxlimit)
+        self.inflight = 0
+        self.paused = 0.0       # Monotonic time until which requests are paused (Retry-After)
+        self.decreased = 0.0    # Monotonic time the limit was last halved
+        self.retries = retries
+        self.backoff = backoff
+        self.cond = threading.Condition()
+
+    def try_start(self):
+        #
+        # Take a concurrency slot for a request - returns False if the limit is reached
+        with self.cond:
+            if self.maxlimit and self.inflight >= int(self.limit):
+                return False
+            self.inflight += 1
+            return True
+
+    def reserve(self):
+        #
+        # Take a token for a request - returns the seconds to wait before sending it
+        with self.cond:
+            now = time.monotonic()
+            wait = max(self.paused - now, 0.0)
+            if self.rate > 0:
+                self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    def start(self):
+        #
+        # Wait for a concurrency slot and a token (threads - AsyncKBClient waits with asyncio)
+        with self.cond:
+            self.cond.wait_for(self.try_start)
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def finish(self, status, retryafter=None):
+        #
+        # Release the slot of a completed request and adjust the concurrency limit from its status
+        with self.cond:
+            self.inflight -= 1
+            now = time.monotonic()
+            if status in THROTTLE_STATUS_CODES:
+                metrics.count("throttled_responses")
+                if retryafter:
+                    self.paused = max(self.paused, now + retryafter)
+                if not self.maxlimit:
+                    self.maxlimit = self.limit = self.inflight + 1
+                if now - self.decreased >= self.COOLDOWN:
+                    self.limit = max(self.limit / 2, 1.0)
+                    self.decreased = now
+                    metrics.count("concurrency_decreases")
+                    logging.info("Hub throttled requests - concurrency limit reduced to {}".format(int(self.limit)))
+            elif self.maxlimit and status != "error" and status < 500:
+                self.limit = min(self.limit + 1 / self.limit, self.maxlimit)
+            self.cond.notify_all()
+
+    def retry_delay(self, attempt, retryafter=None):
+        #
+        # Seconds to wait before retry attempt (1 for the first retry) - exponential backoff with jitter,
+        # or the Retry-After delay from the server if longer
+        delay = min(self.backoff * (2 ** (attempt - 1)), self.MAX_BACKOFF) * (0.5 + random.random() / 2)
+        return max(delay, retryafter or 0.0)
+
+hubthrottle = HubThrottle()
+
+def open_throttle(args, maxlimit, processes=1):
+    #
+    # Configure the Hub request limits for the run - the --max-rate is shared between batch worker processes
+    global hubthrottle
+    hubthrottle = HubThrottle(args.max_rate / processes, maxlimit, args.kb_retries)
+    if args.max_rate > 0:
+        logging.info("Hub requests limited to {} per second".format(args.max_rate))
+
+def http_request(endpoint, func, *params):
+    #
+    # Run a Hub request function recording latency, status code and response bytes in metrics
+    # Requests are limited by hubthrottle - KB GETs and connection requests which are throttled or fail with a server
+    # or connection error are retried with backoff (honouring Retry-After)
+    # Authentication is not limited as it can run (in hub.reauthenticate()) while other requests hold all the slots
+    # A request rejected with 401 (expired or revoked bearer token) is repeated once after authenticating again
+    token = hub.token if endpoint not in UNAUTHENTICATED_ENDPOINTS else None
+    throttle = hubthrottle if endpoint != 'auth' else None
+    retries = hubthrottle.retries if endpoint in RETRIED_ENDPOINTS else 0
+    attempt = 0
+    reauthenticated = False
+    while True:
+        if throttle:
+            throttle.start()
+        start = time.perf_counter()
+        status = "error"
+        nbytes = 0
+        retryafter = None
+        try:
+            response = func(*params)
+            status = response.status_code
+            nbytes = len(response.content or b"")
+            retryafter = retry_after_seconds(response.headers)
+        except requests.RequestException as e:
+            # (only connection errors and timeouts can succeed when repeated - e.g. an invalid URL fails at once)
+            if attempt >= retries or not isinstance(e, (requests.ConnectionError, requests.Timeout)):
+                raise
+            logging.debug("{} request failed - {}".format(endpoint, e))
+        finally:
+            metrics.http_response(endpoint, status, nbytes, time.perf_counter() - start)
+            if throttle:
+                throttle.finish(status, retryafter)
+        if status == 401 and token is not None and not reauthenticated:
+            reauthenticated = True
+            hub.reauthenticate(token)
+            continue
+        if (status != "error" and status not in TRANSIENT_STATUS_CODES) or attempt >= retries:
+            return response
+        attempt += 1
+        metrics.count("request_retries")
+        delay = hubthrottle.retry_delay(attempt, retryafter)
+        logging.info("Retrying {} request (status {}, attempt {}) in {:.1f} seconds".format(endpoint, status, attempt, delay))
+        time.sleep(delay)
+
+class SingleFlight:
+    #
+    # Coalesces identical concurrent calls - while a call for a key is in flight, other callers for the same
+    # key wait for it and share its result (or exception) instead of repeating it
+    # Keys are removed once the call completes so nothing is held after it (results are memoised by the callers)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}     # Dict of key with Future for calls in flight
+
+    def do(self, key, func, *params):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            metrics.count("coalesced_calls")
+            return future.result()
+        try:
+            result = func(*params)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return result
+
+flights = SingleFlight()    # KB GETs (by URL) and per-run KB lookups (by memo key) in flight
+
+def kb_get(url, endpoint):
+    #
+    # GET a KB URL using the persistent cache if enabled - only successful responses are cached
+    # Only one GET for a URL is in flight at once - concurrent callers share the response
+    if kbcache:
+        data = kbcache.get(url, endpoint)
+        if data is not None:
+            logging.debug("Cache hit for {}".format(url))
+            return KBResponse(200, data)
+    return flights.do(('GET', url), fetch_kb_url, url, endpoint)
+
+def fetch_kb_url(url, endpoint):
+    if kbcache:
+        # (cached by another thread while waiting to fetch)
+        data = kbcache.get(url, endpoint)
+        if data is not None:
+            return KBResponse(200, data)
+    try:
+        response = http_request(endpoint, hub.execute_get, url)
+    except requests.RequestException as e:
+        raise KBRequestError("KB request {} failed - {}".format(url, e))
+    if kbcache and response.status_code == 200:
+        kbcache.put(url, endpoint, response.json())
+    return response
+
+def open_kbcache(args):
+    global kbcache
+    # (bearer tokens are kept with the KB response cache)
+    TokenCacheHubInstance.TOKEN_DIR = None if args.no_cache else os.path.join(args.cache_dir, "tokens")
+    if args.no_cache:
+        logging.info("KB response cache disabled")
+        return
+    kbcache = KBCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    logging.info("Using KB response cache {}".format(args.cache_dir))
+
+def open_matchstore(args):
+    global matchstore
+    if args.no_cache:
+        return
+    # (component and version URLs are only valid for the server they came from)
+    matchstore = MatchStore(args.cache_dir, hub.get_urlbase(), journal_options(args)['replace_file'])
+    logging.info("Using shared match store {}".format(matchstore.dirname))
+
+def close_caches():
+    if matchstore:
+        matchstore.close()
+    if kbcache:
+        kbcache.prune()
+
+def kb_search_url(componentname):
     componentname = componentname.replace(" ", "+")
     #packagename = packagename.replace("-", "+")
-    req_url = hub.get_urlbase() + "/api/search/components?q=name:{}&limit={}".format(componentname, 20)
-    try:
-        response = hub.execute_get(req_url)
-    except:
-        logging.error("get_kb_component(): Exception trying to find KB matches")
+    return hub.get_urlbase() + "/api/search/components?q=name:{}&limit={}".format(componentname, 20)
+
+def check_kb_response(response, what):
+    #
+    # Raise KBRequestError if a KB request was throttled or failed with a server error (after all retries)
+    if response.status_code in TRANSIENT_STATUS_CODES:
+        raise KBRequestError("{} failed, status code: {}".format(what, response.status_code))
+    return response
+
+def kb_search_hits(response):
+    #
+    # Return the list of hits from a KB search response or None if the search failed
+    # Raises KBRequestError if the search was throttled or failed with a server error
+    check_kb_response(response, "KB search")
+    if response.status_code != 200:
+        return None
+    respitems = response.json().get('items', [])
+    hits = []
+    if respitems and respitems[0]['searchResultStatistics']['numResultsInThisPage'] > 0:
+        hits = respitems[0]['hits']
+    return hits
+
+def kb_versions_url(component):
+    # URL of the version list for a KB component (from the component response)
+    respitems = component.json().get('_meta')
+    links = respitems['links']
+    return links[0]['href'] + "?limit=3000"
 
+@instrumented('get_kb_component')
+def get_kb_component(componentname):
+    #
+    # Run a KB search - raises KBRequestError if the request failed with a connection error after all retries
+    req_url = kb_search_url(componentname)
+    response = kb_get(req_url, 'search')
     if response.status_code != 200:
-        logging.error("Failed to retrieve KB matches, status code: {}".format(response.status_code))
+        logging.error("Failed to retrieve KB matches for {}, status code: {}".format(componentname, response.status_code))
 
     return response
 
-def find_ver_from_compver(kburl, version):
-    matchversion = ""
+def get_kb_hits(componentname):
+    #
+    # Return the list of KB search hits for a component search name - each distinct search is run once per run
+    # Returns None if the search failed (not retried during this run) - raises KBRequestError if it was throttled
+    # or failed with a server or connection error (not memoised, so later lookups search again)
+    if componentname in kbsearchresults:
+        metrics.count("search_memo_hits")
+        return kbsearchresults[componentname]
+    return flights.do(('search', componentname), fetch_kb_hits, componentname)
+
+def fetch_kb_hits(componentname):
+    if componentname in kbsearchresults:
+        return kbsearchresults[componentname]
+    hits = kb_search_hits(get_kb_component(componentname))
+    kbsearchresults[componentname] = hits
+    return hits
+
+def normalise_kbversion(versionname):
+    return versionname.replace('-', '.').replace('_', '.')
+
+VERSION_SEGMENT = re.compile(r"\d+|[a-z]+")
+VERSION_SEGMENT_MAX = (2, 0, "")     # Sorts after every parsed version segment
+
+def parse_version(versionname):
+    #
+    # Parse a version string into a tuple of segments for partial matching - digits and letters are split into
+    # separate segments (so '2.4.7-r0', '2.4.7r0' and '2_4_7_r0' are the same) and leading alphabetic segments
+    # such as 'v' or 'release' are dropped. Numeric segments sort numerically (so '1.10' sorts after '1.9')
+    segments = [(0, int(seg), "") if seg.isdigit() else (1, 0, seg) for seg in VERSION_SEGMENT.findall(versionname.lower())]
+    while segments and segments[0][0] == 1:
+        segments.pop(0)
+    return tuple(segments)
 
-    component = hub.execute_get(kburl)
+class ComponentVersionIndex:
+    #
+    # Index of the versions of one KB component keyed by normalised version string
+    # Includes the version with any leading 'v' removed (e.g. 'v1.2' also matches local version '1.2');
+    # the first KB version in list order is kept for each key, as for the original linear scan
+    #
+    # Partial matches use a sorted list of parsed version tuples (built on the first partial lookup) searched
+    # with bisect, so each lookup is logarithmic in the number of KB versions:
+    # - strength 2: the KB version is the start of the local version (e.g. KB '1.1.5' for '1.1.5+gitAUTOINC'
+    #   or '2.4.7-r0' - the longest such KB version), or the local version is the start of the KB version
+    # - strength 1: the numeric part of the versions differs only in the final segment, by at most 2
+    def __init__(self, compname, sourceurl, kbversions):
+        self.compname = compname
+        self.sourceurl = sourceurl
+        self.versions = {}
+        self.kbversions = kbversions
+        self.parsed = None      # Dict of parsed version tuple with (versionName, version URL)
+        self.keys = None        # Sorted list of parsed version tuples
+        for kbversion in kbversions:
+            kbversionname = normalise_kbversion(kbversion['versionName'])
+            entry = (kbversion['versionName'], kbversion['_meta']['href'])
+            self.versions.setdefault(kbversionname, entry)
+            if (len(kbversionname) > 2) and (kbversionname.lower()[0] == 'v'):
+                self.versions.setdefault(kbversionname[1:], entry)
+
+    def find(self, version):
+        # Returns (versionName, version URL) for an exact match or None
+        return self.versions.get(version.replace('-', '.'))
+
+    def parse(self):
+        parsed = {}
+        for kbversion in self.kbversions:
+            key = parse_version(kbversion['versionName'])
+            if key:
+                parsed.setdefault(key, (kbversion['versionName'], kbversion['_meta']['href']))
+        self.keys = sorted(parsed)
+        self.parsed = parsed
+
+    def find_partial(self, version):
+        # Returns (versionName, version URL, match strength) for the nearest partial match or None
+        if self.keys is None:
+            self.parse()
+        key = parse_version(version)
+        if not key:
+            return None
+        #
+        # KB version is the start of (or the same as) the local version - longest first
+        for length in range(len(key), 0, -1):
+            if key[:length] in self.parsed:
+                if length > 1 or len(key) == 1 or key[1][0] == 1:
+                    return self.parsed[key[:length]] + (2,)
+                break
+        #
+        # Local version is the start of the KB version - first (lowest) KB version after it in sort order
+        pos = bisect.bisect_right(self.keys, key)
+        if pos < len(self.keys) and self.keys[pos][:len(key)] == key:
+            return self.parsed[self.keys[pos]] + (2,)
+        #
+        # Close numeric version - same leading numeric segments, final numeric segment within 2
+        numeric = 0
+        while numeric < len(key) and key[numeric][0] == 0:
+            numeric += 1
+        if numeric < 2:
+            return None
+        prefix, final = key[:numeric - 1], key[numeric - 1][1]
+        start = bisect.bisect_left(self.keys, prefix + ((0, max(final - 2, 0), ""),))
+        end = bisect.bisect_right(self.keys, prefix + ((0, final + 2, ""), VERSION_SEGMENT_MAX))
+        best = None
+        for kbkey in self.keys[start:end]:
+            if len(kbkey) == numeric or (len(kbkey) > numeric and kbkey[numeric][0] == 1):
+                distance = abs(kbkey[numeric - 1][1] - final)
+                if best is None or distance < best[0]:
+                    best = (distance, kbkey)
+        if best is None:
+            return None
+        return self.parsed[best[1]] + (1,)
+
+compverindex = {}   # Dict of KB component URLs with ComponentVersionIndex for each (built once per run)
+
+def get_component_version_index(kburl):
+    #
+    # Return the version index for a KB component, fetching the component and its version list
+    # the first time the component is seen in this run
+    # Returns None if the component or version list cannot be retrieved (not retried during this run)
+    # Raises KBRequestError if a request was throttled or failed with a server or connection error
+    if kburl in compverindex:
+        metrics.count("version_index_memo_hits")
+        return compverindex[kburl]
+    return flights.do(('version_index', kburl), fetch_component_version_index, kburl)
+
+def fetch_component_version_index(kburl):
+    if kburl in compverindex:
+        return compverindex[kburl]
+    component = kb_get(kburl, 'component')
+    kbversions = None
+    if component.status_code == 200:
+        #
+        # Request the list of versions for this component
+        kbversions = kb_get(kb_versions_url(component), 'versions')
+    index = build_component_version_index(kburl, component, kbversions)
+    compverindex[kburl] = index
+    return index
+
+def build_component_version_index(kburl, component, kbversions):
+    check_kb_response(component, "KB component {}".format(kburl))
+    if kbversions is not None:
+        check_kb_response(kbversions, "KB component versions {}".format(kburl))
     if component.status_code != 200:
         logging.error("Failed to retrieve component, status code: {}".format(component.status_code))
-        return "", "", 0, "", ""
-    bdcomp_sourceurl = component.json().get('url')
-    #
-    # Request the list of versions for this component
-    compname = component.json().get('name')
-    respitems = component.json().get('_meta')
-    links = respitems['links']
-    vers_url = links[0]['href'] + "?limit=3000"
-    kbversions = hub.execute_get(vers_url)
+        return None
     if kbversions.status_code != 200:
         logging.error("Failed to retrieve component, status code: {}".format(kbversions.status_code))
-        return "", "", 0, "", ""
+        return None
+    index = ComponentVersionIndex(component.json().get('name'), component.json().get('url'), kbversions.json().get('items'))
+    logging.debug("Indexed {} versions for component {} ({})".format(len(index.versions), index.compname, kburl))
+    return index
 
-    localversion = version.replace('-','.')
-    for kbversion in kbversions.json().get('items'):
+@instrumented('find_ver_from_compver')
+def find_ver_from_compver(kburl, version):
+    matchversion = ""
 
-        kbversionname = kbversion['versionName'].replace('-', '.').replace('_', '.')
-        kbver_url = kbversion['_meta']['href']
-        logging.debug("component = {} searchversion = {} kbver = {} kbverurl = {}".format(compname, version, kbversionname, kbver_url))
-        if ((kbversionname == localversion) or ((len(kbversionname) > 2) and (kbversionname.lower()[0] == 'v') and (kbversionname[1:] == localversion))):
-            # exact version string match
-            matchversion = kbversion['versionName']
-            matchstrength = 3
-            break
+    index = get_component_version_index(kburl)
+    if index is None:
+        return "", "", 0, "", ""
+    compname = index.compname
+    bdcomp_sourceurl = index.sourceurl
 
-#
-#         # Need to look for partial matches
-#         seq = SequenceMatcher(None, kbversionname, localversion)
-#         match = seq.find_longest_match(0, len(kbversionname), 0, len(localversion))
-#         if (match.a == 0) and (match.b == 0) and (match.size == len(kbversionname)):
-#             # Found match of full kbversion at start of search_version
-#             if len(kbversionname) > len(matchversion):
-#                 # Update if the kbversion is longer than the previous match
-#                 matchversion = kbversion['versionName']
-#                 matchstrength = 2
-#                 logging.debug("Found component block 1 - version="+ matchversion)
-#
-#         elif (match.b == 0) and (match.size == len(localversion)):
-#             # Found match of full search_version within kbversion
-#             # Need to check if kbversion has digits before the match (would mean a mismatch)
-#             mob = re.search('\d', kbversionname[0:match.a])
-#             if not mob and (len(kbversionname) > len(matchversion)):
-#                 # new version string matches kbversion but with characters before and is longer than the previous match
-#                 matchversion = kbversion['versionName']
-#                 logging.debug("Found component block 2 - version="+ matchversion)
-#                 if (match.a == 1) and (kbversionname.lower() == 'v' ):  # Special case of kbversion starting with 'v'
-#                     matchstrength = 3
-#                 else:
-#                     matchstrength = 2
-
-#         elif (match.a == 0) and (match.b == 0) and (match.size > 2):
-#             # both strings match at start for more than 2 characters min
-#             # Need to try close numeric version match
-#             # - Get the final segment of searchversion & kbversion
-#             # - Match if 2 versions off?
-#             if 0 <= match.size - localversion.rfind(".") <= 2:
-#                 # common matched string length is after final .
-#                 kbfinalsegment = kbversionname.split(".")[-1]
-#                 localfinalsegment = localversion.split(".")[-1]
-#                 if (kbfinalsegment.isdigit() and localfinalsegment.isdigit()):
-#                     # both final segments are numeric
-#                     logging.debug("kbfinalsegment = " + kbfinalsegment + " localfinalsegment = " + localfinalsegment + " matchversion = " + matchversion)
-#                     if abs(int(kbfinalsegment) - int(localfinalsegment)) <= 2:
-#                         # values of final segments are within 2 of each other
-#                         if len(kbversionname) >= len(matchversion):
-#                             # kbversion is longer or equal to matched version string
-#                             matchversion = kbversion['versionName']
-#                             matchstrength = 1
-#                             logging.debug("Found component block 3 - version="+ matchversion)
+    match = index.find(version)
+    if match:
+        # exact version string match
+        matchversion, kbver_url = match
+        matchstrength = 3
+        logging.debug("component = {} searchversion = {} kbver = {} kbverurl = {}".format(compname, version, matchversion, kbver_url))
+    else:
+        # nearest partial version match (see ComponentVersionIndex)
+        match = index.find_partial(version)
+        if match:
+            matchversion, kbver_url, matchstrength = match
+            logging.debug("component = {} searchversion = {} partial kbver = {} strength = {}".format(compname, version, matchversion, matchstrength))
 
     if matchversion != "":
         srcurl = bdcomp_sourceurl
@@ -146,34 +1245,28 @@ def find_ver_from_compver(kburl, version):
     return "", "", 0, "", ""
 
 def find_ver_from_hits(hits, search_version):
-    matchversion = ""
-    matchstrength=0
-    for hit in hits:
-        #
-        # Get component from URL
-        comp_url = hit['component']
-        foundcompname, matchversion, matchstrength, bdcomp_sourceurl, bdcompver_url = find_ver_from_compver(comp_url, search_version)
-        if matchstrength == 3:
-            break
-
-    if matchversion == "":
-        if search_version.count("+") > 0:
-            search_version = search_version.split("+")[0]
-            for hit in hits:
-                #
-                # Get component from URL
-                comp_url = hit['component']
-                foundcompname, matchversion, matchstrength, bdcomp_sourceurl, bdcompver_url = find_ver_from_compver(comp_url, search_version)
-                if matchstrength == 3:
-                    break
-    if matchversion == "":
-        return "", "", 0, "", "", ""
-    else:
-        return foundcompname, matchversion, matchstrength, bdcomp_sourceurl, comp_url, bdcompver_url
+    #
+    # Return the strongest version match from the hits (the first hit for equal strengths), stopping at an
+    # exact match - versions containing + are also tried without the + suffix unless matched exactly
+    best = ("", "", 0, "", "", "")
+    versions = [search_version]
+    if search_version.count("+") > 0:
+        versions.append(search_version.split("+")[0])
+    for version in versions:
+        for hit in hits:
+            #
+            # Get component from URL
+            comp_url = hit['component']
+            foundcompname, matchversion, matchstrength, bdcomp_sourceurl, bdcompver_url = find_ver_from_compver(comp_url, version)
+            if matchstrength > best[2]:
+                best = (foundcompname, matchversion, matchstrength, bdcomp_sourceurl, comp_url, bdcompver_url)
+            if matchstrength == 3:
+                return best
+    return best
 
 
 def search_kbcomponent(component, version):
-    if component in kbnomatchcomplist:
+    if component in kbnomatchcomps:
         return "", "", 0, "", "", ""
 
     compver = component + "/" + version
@@ -181,131 +1274,227 @@ def search_kbcomponent(component, version):
         # Already matched this
         return component, version, 3, "", kbverdict[compver].rsplit("/", 2)[0], kbverdict[compver]
 
-    response = get_kb_component(component)
-    if response.status_code != 200:
+    hits = get_kb_hits(component)
+    if hits is None:
         return "", "", 0, "", "", ""
 
-    respitems = response.json().get('items', [])
-    #logging.debug("{} items returned".format(respitems[0]['searchResultStatistics']['numResultsInThisPage']))
-    if respitems[0]['searchResultStatistics']['numResultsInThisPage'] > 0:
-        temp_comp, temp_version, matchstrength, temp_srcurl, temp_compurl, temp_compverurl = find_ver_from_hits(respitems[0]['hits'], version)
+    if len(hits) > 0:
+        temp_comp, temp_version, matchstrength, temp_srcurl, temp_compurl, temp_compverurl = find_ver_from_hits(hits, version)
         return temp_comp, temp_version, matchstrength, temp_srcurl, temp_compurl, temp_compverurl
     else:
-        kbnomatchcomplist.append(component)
+        kbnomatchcomps.add(component)
         return "", "", 0, "", "", ""
 
-def find_comp_from_kb(compname, version, outkbfile, inkbfile, repdict):
+def search_candidates(compname, reprules):
+    #
+    # Expand a manifest component name into the ordered list of KB search names tried by find_comp_from_kb():
+    # - the name (or replacement from the replacement file)
+    # - the name with - and _ replaced by :: (full length name only)
+    # - the name with - and _ replaced by spaces
+    # then repeated after removing trailing -xxx (or .xxx if no -) from the name
+    #
+    # Returns list of (search name, base name) tuples
+    origcomp = compname
+    #
+    # Replace component names from replacement file
+    replacement, rule = reprules.replace(compname)
+    if replacement is not None:
+        compname = replacement
+
+    candidates = []
+    while True:
+        names = [compname]
+        if (len(compname) == len(origcomp)) and (compname.find("-") > -1):
+            names.append(compname.replace("-", "::").replace("_", "::"))
+        if (compname.find("-") > -1) or (compname.find("_") > -1):
+            names.append(compname.replace("-", " ").replace("_", " "))
+        for name in names:
+            if name != "" and (name, compname) not in candidates:
+                candidates.append((name, compname))
+        #
+        # Remove trailing -xxx from package name
+        newcompname = compname.rsplit("-", 1)[0]
+        if len(newcompname) == len(compname):
+            #
+            # No - found, try removing trailing .xxxx
+            newcompname = compname.rsplit(".", 1)[0]
+            if (len(newcompname) == len(compname)):
+                break
+        compname = newcompname
+    return candidates
+
+def plan_kb_searches(packages, reprules):
+    #
+    # Expand all manifest components needing KB lookups into their candidate search names before any
+    # network calls - returns the total number of candidate searches and the set of distinct search names
+    # (components from the same recipe are searched once if the recipe is known)
+    total = 0
+    distinct = set()
+    for package in packages:
+        recipe = package_recipe(package)
+        names = recipe_search_terms(recipe) if recipe else []
+        names += [name for name, basename in search_candidates(search_target(package, "")[0], reprules) if name not in names]
+        for name in names:
+            total += 1
+            if name not in kbsearchresults and name not in kbnomatchcomps:
+                distinct.add(name)
+    return total, distinct
+
+def find_comp_from_kb(compname, version, reprules, terms=()):
     #
     # Try to find component in KB
+    # May be called from worker threads - returns the kbfile line, the list output message and the
+    # matched component name, leaving updates of the kbfile and lookup dicts to the caller
+    # Exact search terms (for a recipe) are searched first - the name variants from search_candidates()
+    # are only searched if none of them match
     #
-    end = False
     found_comp = ""
     found_version = ""
+    found_search = ""
     comp_url = ""
     compver_url = ""
     source_url = ""
     max_matchstrength = 0
 
     origcomp = compname
-    #
-    # Replace component names from replacement file
-    if compname in repdict:
-        compname = repdict[compname]
-
-    while end == False:
-        logging.info("Searching KB for component '{}'".format(compname))
-        temp_comp, temp_version, matchstrength, temp_srcurl, temp_compurl, temp_compverurl = search_kbcomponent(compname, version)
+    candidates = [(term, term) for term in terms]
+    candidates += [candidate for candidate in search_candidates(origcomp, reprules) if candidate[0] not in terms]
+    for index, (searchname, compname) in enumerate(candidates):
+        if index == len(terms) and max_matchstrength > 0:
+            break
+        logging.debug("Searching KB for component '{}'".format(searchname))
+        temp_comp, temp_version, matchstrength, temp_srcurl, temp_compurl, temp_compverurl = search_kbcomponent(searchname, version)
         if matchstrength > 0:
             logging.info("Matched version {} with strength {}".format(temp_version, matchstrength))
-        if matchstrength == 3:
-            end = True
         if matchstrength > max_matchstrength:
             max_matchstrength = matchstrength
             found_comp = temp_comp
             found_version = temp_version
+            found_search = searchname
             comp_url = temp_compurl
             compver_url = temp_compverurl
             source_url = temp_srcurl
+        if matchstrength == 3:
+            break
 
-        if (end == False) and (len(compname) == len(origcomp)) and (compname.find("-") > -1):
-            compnamecolons = compname.replace("-", "::")
-            compnamecolons = compnamecolons.replace("_", "::")
-            logging.info("Searching KB for component '{}'".format(compnamecolons))
-            temp_comp, temp_version, matchstrength, temp_srcurl, temp_compurl, temp_compverurl = search_kbcomponent(compnamecolons, version)
-            if matchstrength > 0:
-                logging.info("Matched version {} with strength {}".format(temp_version, matchstrength))
-            if matchstrength == 3:
-                end = True
-            if matchstrength > max_matchstrength:
-                max_matchstrength = matchstrength
-                found_comp = temp_comp
-                found_version = temp_version
-                comp_url = temp_compurl
-                compver_url = temp_compverurl
-                source_url = temp_srcurl
-
-        if (end == False) and ((compname.find("-") > -1) or (compname.find("_") > -1)):
-            #
-            # Process component replacing - with spaces
-            compnamespaces = compname.replace("-", " ")
-            compnamespaces = compnamespaces.replace("_", " ")
-            logging.info("Searching KB for component '{}'".format(compnamespaces))
-            temp_comp, temp_version, matchstrength, temp_srcurl, temp_compurl, temp_compverurl = search_kbcomponent(compnamespaces, version)
-            if matchstrength > 0:
-                logging.info("Matched version {} with strength {}".format(temp_version, matchstrength))
-            if matchstrength == 3:
-                end = True
-            if matchstrength > max_matchstrength:
-                max_matchstrength = matchstrength
-                found_comp = temp_comp
-                found_version = temp_version
-                comp_url = temp_compurl
-                compver_url = temp_compverurl
-                source_url = temp_srcurl
-
-        if end == False:
-            #
-            # Remove trailing -xxx from package name
-            newcompname = compname.rsplit("-", 1)[0]
-            if len(newcompname) == len(compname):
-                #
-                # No - found, try removing trailing .xxxx
-                newcompname = compname.rsplit(".", 1)[0]
-                if (len(newcompname) == len(compname)):
-                    end = True
-            compname = newcompname
-
+    match = {'kb_component': found_comp, 'kb_version': found_version, 'search': found_search, 'match_strength': max_matchstrength}
     if max_matchstrength > 0:
-        logging.info("Component matched and added to output KBLookup file")
-        listoutput(" - MATCHED '{}/{}'".format(found_comp, found_version), True)
-        kblookupdict.setdefault(compname, []).append(comp_url)
-        kbverdict[compname + "/" + version] = compver_url
+        logging.debug("Component {} matched and added to output KBLookup file".format(origcomp))
         if source_url:
             if source_url.count(";") > 0:
                 source_url = source_url.replace(";", "")
-        return "{};{};{};{};{};{};\n".format(origcomp,found_comp,source_url,comp_url,version,compver_url)
+        return "{};{};{};{};{};{};\n".format(origcomp,found_comp,source_url,comp_url,version,compver_url), \
+               " - MATCHED '{}/{}'".format(found_comp, found_version), compname, match
 
     else:
-        logging.info("Component NOT matched - NO MATCH added to output KBLookup file")
-        listoutput(" - NO MATCH", True)
-        return "{};;;NO MATCH;{};NO VERSION MATCH;\n".format(origcomp, version)
+        logging.debug("Component {} NOT matched - NO MATCH added to output KBLookup file".format(origcomp))
+        return "{};;;NO MATCH;{};NO VERSION MATCH;\n".format(origcomp, version), " - NO MATCH", compname, match
 
-def add_kbfile_entry(outkbfile, line):
-    try:
-        ofile = open(outkbfile, "a+")
-    except:
-        logging.error("append_kbfile(): Failed to open file {} for read".format(outkbfile))
+class PkgData:
+    #
+    # Yocto pkgdata for the build (--pkgdata) - maps the binary packages in the build manifest to their source
+    # recipe (PN) and version (PV) from runtime-reverse/<package> (e.g. tmp/pkgdata/<machine>/runtime-reverse/libacl1
+    # links to ../runtime/libacl, which contains "PN: acl" and "PV: 2.2.53")
+    def __init__(self, dirname):
+        if os.path.basename(os.path.normpath(dirname)) != "runtime-reverse":
+            dirname = os.path.join(dirname, "runtime-reverse")
+        self.dirname = dirname
+        self.recipes = {}   # Dict of package name with (PN, PV) or None (read once per package)
+
+    def recipe(self, package):
+        if package in self.recipes:
+            return self.recipes[package]
+        values = {}
+        try:
+            with open(os.path.join(self.dirname, package), "r") as pfile:
+                for line in pfile:
+                    key, sep, value = line.partition(": ")
+                    if key in ("PN", "PV"):
+                        values[key] = value.strip()
+        except (OSError, ValueError):
+            pass
+        recipe = None
+        if values.get('PN') and values.get('PV'):
+            # (AUTOINC is replaced by the package revision in the package version)
+            recipe = (values['PN'], normalise_manifest_version(values['PV'].replace("AUTOINC", "0")))
+        else:
+            logging.debug("PkgData: no recipe found for package {}".format(package))
+        self.recipes[package] = recipe
+        return recipe
+
+def open_pkgdata(args):
+    global pkgdata
+    if not getattr(args, 'pkgdata', None):
         return
+    pkgdata = PkgData(args.pkgdata)
+    if not os.path.isdir(pkgdata.dirname):
+        print("ERROR: Cannot find pkgdata runtime-reverse directory {}".format(pkgdata.dirname))
+        exit(1)
+    print("Using recipes from pkgdata {}".format(pkgdata.dirname))
+    logging.info("Using recipes from pkgdata {}".format(pkgdata.dirname))
 
-    ofile.write(line)
-    ofile.close()
+def package_recipe(package):
+    #
+    # Returns the (recipe, version) searched in the KB for a manifest component - from the input file
+    # (license.manifest or SPDX) or --pkgdata - or None to search for the component itself
+    # Replacement file rules for the component take precedence
+    if reprules.replace(package)[0] is not None:
+        return None
+    recipe = recipehints.get(package)
+    if recipe is None and pkgdata is not None:
+        recipe = pkgdata.recipe(package)
+    return recipe
 
-def update_kbfile_entry(outkbfile, package, version, compurl, kbverurl):
+def recipe_search_terms(recipe):
     #
-    # Append version strings to kbfile entry
+    # Exact KB search names for a recipe - the recipe name (or its replacement) and names from its source URL
+    name = reprules.replace(recipe[0])[0] or recipe[0]
+    return list(dict.fromkeys([name] + sourcenames.get(recipe[0], [])))
+
+def search_target(package, version):
     #
-    # FIELDS:
-    # 1 = Local component name;
+    # Returns the name and version searched in the KB for a manifest entry
+    recipe = package_recipe(package)
+    return recipe if recipe else (package, version)
+
+def find_recipe_from_kb(package, version, recipe):
+    #
+    # Find a component in the KB from its recipe (input file or --pkgdata) - each recipe/version is searched once and the
+    # result used for all of its packages (as find_comp_from_kb() for the package)
+    if recipe in reciperesults:
+        metrics.count("recipe_memo_hits")
+        newkbline, listmsg, compname, match = reciperesults[recipe]
+    else:
+        newkbline, listmsg, compname, match = flights.do(('recipe', recipe), fetch_recipe_from_kb, recipe)
+    elements = newkbline.split(";")
+    elements[0] = package
+    elements[4] = version
+    return ";".join(elements), listmsg, compname, dict(match)
+
+def fetch_recipe_from_kb(recipe):
+    if recipe not in reciperesults:
+        logging.debug("Searching KB for recipe {}/{}".format(*recipe))
+        reciperesults[recipe] = find_comp_from_kb(recipe[0], recipe[1], reprules, recipe_search_terms(recipe))
+    return reciperesults[recipe]
+
+def record_kb_match(compname, version, compurl, verurl):
+    #
+    # Add a new match to the lookup dicts (compurl is None for a new version of a known component)
+    if compurl is not None:
+        kblookupdict.setdefault(compname, []).append(compurl)
+    kbverdict[compname + "/" + version] = verurl
+
+class KBFile:
+    #
+    # In-memory model of the output KB Lookup file
+    # Lines are held in file order with an index keyed by (local component name, KB component URL) so that
+    # version matches can be appended without rewriting the file - the file is written once by save()
+    # (write to a temporary file then rename) at the end of the run or at periodic checkpoints
+    # save() holds a lock on <file>.lock and first merges any entries written to the file by other runs since
+    # it was loaded, so concurrent runs with the same output file do not lose each other's matches
+    #
+    # FIELDS:
+    # 1 = Local component name;
     # 2 = KB component name;
     # 3 = KB component source URL;
     # 4 = KB component URL;
@@ -314,256 +1503,2170 @@ def update_kbfile_entry(outkbfile, package, version, compurl, kbverurl):
     # 5 = Local component version string
     # 6 = KB Component version URL
     # (Repeated as often as matched)
+    def __init__(self, filename, checkpoint=100):
+        self.filename = filename
+        self.checkpoint = checkpoint
+        self.lines = []
+        self.index = {}
+        self.compurlindex = {}  # Dict of local component name with KB component URLs (in file order)
+        self.added = set()      # (local component name, KB component URL) of lines added by lookups in this run
+        self.changes = 0
+        self.stat = None    # Identity of the file as last loaded or saved
+
+    def load(self):
+        #
+        # Load existing contents of the output file (new entries are appended to it)
+        if not self.filename:
+            return
+        try:
+            with open(self.filename, "r") as kfile:
+                self.stat = self.file_stat(kfile.fileno())
+                for line in kfile:
+                    self.add_entry(line, False)
+        except FileNotFoundError:
+            return
+        except OSError:
+            logging.error("KBFile.load(): Failed to open file {} for read".format(self.filename))
+
+    def add_entry(self, line, changed=True):
+        line = line.rstrip("\r\n")
+        if line == "":
+            return
+        elements = line.split(";")
+        if len(elements) < 4:
+            logging.error("KBFile.add_entry(): Invalid KB Lookup file line '{}'".format(line))
+            return
+        if (elements[0], elements[3]) not in self.index:
+            self.compurlindex.setdefault(elements[0], []).append(elements[3])
+        self.index.setdefault((elements[0], elements[3]), []).append(len(self.lines))
+        self.lines.append(line)
+        if changed:
+            self.added.add((elements[0], elements[3]))
+            self.changed()
+
+    def update_entry(self, package, version, compurl, kbverurl):
+        #
+        # Append version strings to kbfile entries for package/compurl
+        for index in self.index.get((package, compurl), []):
+            self.lines[index] = "{}{};{};".format(self.lines[index], version, kbverurl)
+            logging.debug("KBFile.update_entry(): updated kbfile line with '{};{};'".format(version, kbverurl))
+        self.changed()
+
+    def has_entry(self, package, compurl):
+        return (package, compurl) in self.index
+
+    def compurls(self, localname):
+        return list(self.compurlindex.get(localname, []))
+
+    def has_version(self, package, compurl, version):
+        for index in self.index.get((package, compurl), []):
+            if version in self.lines[index].split(";")[4::2]:
+                return True
+        return False
+
+    def entries(self):
+        return iter(self.lines)
+
+    def changed(self):
+        self.changes += 1
+        if self.checkpoint and self.changes >= self.checkpoint:
+            self.save()
+
+    @staticmethod
+    def file_stat(fd):
+        stat = os.fstat(fd)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def merge(self):
+        #
+        # Add entries (and versions of entries) written to the file by another run since it was loaded or saved
+        try:
+            kfile = open(self.filename, "r")
+        except FileNotFoundError:
+            return
+        with kfile:
+            stat = self.file_stat(kfile.fileno())
+            if stat == self.stat:
+                return
+            count = 0
+            for line in kfile:
+                elements = line.rstrip("\r\n").split(";")
+                if len(elements) < 4:
+                    continue
+                key = (elements[0], elements[3])
+                if key not in self.index:
+                    self.add_entry(line, False)
+                    count += 1
+                    continue
+                for version, kbverurl in zip(elements[4::2], elements[5::2]):
+                    if version and not self.has_version(elements[0], elements[3], version):
+                        index = self.index[key][0]
+                        self.lines[index] = "{}{};{};".format(self.lines[index], version, kbverurl)
+                        count += 1
+        if count:
+            logging.info("KBFile.merge(): merged {} entries written to {} by another run".format(count, self.filename))
+
+    def save(self):
+        if not self.filename:
+            # In-memory only (KBLookup without an output file)
+            return True
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        lockfile = None
+        try:
+            if fcntl:
+                lockfile = open(self.filename + ".lock", "a")
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            self.merge()
+            fd, tmppath = tempfile.mkstemp(dir=dirname, prefix=os.path.basename(self.filename), suffix=".tmp")
+            with os.fdopen(fd, "w") as ofile:
+                for line in self.lines:
+                    ofile.write(line + "\n")
+                ofile.flush()
+                os.fchmod(ofile.fileno(), output_file_mode(self.filename))
+                self.stat = self.file_stat(ofile.fileno())
+            os.replace(tmppath, self.filename)
+        except OSError as e:
+            logging.error("KBFile.save(): Failed to write file {} - {}".format(self.filename, e))
+            return False
+        finally:
+            if lockfile:
+                lockfile.close()
+        logging.debug("KBFile.save(): wrote {} entries to {}".format(len(self.lines), self.filename))
+        self.changes = 0
+        return True
+
+class SQLiteKBFile:
+    #
+    # KB Lookup file held in an indexed SQLite database (used for kbfiles named *.db, *.sqlite or *.sqlite3)
+    # Supports the same interface as KBFile for output, plus on-demand lookups by local component name and
+    # name/version so large shared kbfiles do not need to be loaded into memory at startup
+    #
+    # Each text kbfile line is a row in components; each version pair is a row in versions
+    # (rowid order preserves the text file order for export)
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS components (
+            id INTEGER PRIMARY KEY, localname TEXT, kbname TEXT, srcurl TEXT, compurl TEXT);
+        CREATE INDEX IF NOT EXISTS components_localname ON components(localname);
+        CREATE INDEX IF NOT EXISTS components_compurl ON components(compurl);
+        CREATE TABLE IF NOT EXISTS versions (
+            compid INTEGER, localname TEXT, version TEXT, verurl TEXT);
+        CREATE INDEX IF NOT EXISTS versions_namever ON versions(localname, version);
+        CREATE INDEX IF NOT EXISTS versions_compid ON versions(compid);
+        """
+
+    def __init__(self, filename, checkpoint=100):
+        self.filename = filename
+        self.checkpoint = checkpoint
+        self.changes = 0
+        self.added = set()      # (local component name, KB component URL) of entries added by lookups in this run
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+
+    def load(self):
+        # Nothing to do - entries are read on demand
+        return
+
+    def add_entry(self, line, changed=True):
+        elements = line.rstrip("\r\n").split(";")
+        if len(elements) < 4:
+            if line.strip():
+                logging.error("SQLiteKBFile.add_entry(): Invalid KB Lookup file line '{}'".format(line.rstrip()))
+            return
+        with self.lock:
+            cursor = self.db.execute("INSERT INTO components (localname, kbname, srcurl, compurl) VALUES (?, ?, ?, ?)",
+                                     elements[0:4])
+            index = 4
+            while index < len(elements) - 1:
+                self.db.execute("INSERT INTO versions (compid, localname, version, verurl) VALUES (?, ?, ?, ?)",
+                                (cursor.lastrowid, elements[0], elements[index], elements[index+1]))
+                index += 2
+        if changed:
+            self.added.add((elements[0], elements[3]))
+            self.changed()
+
+    def update_entry(self, package, version, compurl, kbverurl):
+        with self.lock:
+            rows = self.db.execute("SELECT id FROM components WHERE localname = ? AND compurl = ? ORDER BY id",
+                                   (package, compurl)).fetchall()
+            for (compid,) in rows:
+                self.db.execute("INSERT INTO versions (compid, localname, version, verurl) VALUES (?, ?, ?, ?)",
+                                (compid, package, version, kbverurl))
+        self.changed()
+
+    def component_count(self):
+        # Number of distinct local component names
+        with self.lock:
+            return self.db.execute("SELECT COUNT(DISTINCT localname) FROM components").fetchone()[0]
+
+    def compurls(self, localname):
+        with self.lock:
+            rows = self.db.execute("SELECT compurl FROM components WHERE localname = ? ORDER BY id",
+                                   (localname,)).fetchall()
+        return [row[0] for row in rows]
+
+    def verurl(self, localname, version):
+        # Last matching pair wins, as for kbverdict built from a text file
+        with self.lock:
+            row = self.db.execute("SELECT verurl FROM versions WHERE localname = ? AND version = ? ORDER BY rowid DESC LIMIT 1",
+                                  (localname, version)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM components").fetchone()[0]
+
+    def has_entry(self, package, compurl):
+        with self.lock:
+            row = self.db.execute("SELECT 1 FROM components WHERE localname = ? AND compurl = ? LIMIT 1",
+                                  (package, compurl)).fetchone()
+        return row is not None
+
+    def has_version(self, package, compurl, version):
+        with self.lock:
+            row = self.db.execute("SELECT 1 FROM versions JOIN components ON versions.compid = components.id "
+                                  "WHERE components.localname = ? AND components.compurl = ? AND versions.version = ? LIMIT 1",
+                                  (package, compurl, version)).fetchone()
+        return row is not None
+
+    def entries(self):
+        #
+        # Export entries as text kbfile lines
+        with self.lock:
+            comps = self.db.execute("SELECT id, localname, kbname, srcurl, compurl FROM components ORDER BY id").fetchall()
+        for compid, localname, kbname, srcurl, compurl in comps:
+            with self.lock:
+                vers = self.db.execute("SELECT version, verurl FROM versions WHERE compid = ? ORDER BY rowid",
+                                       (compid,)).fetchall()
+            line = "{};{};{};{};".format(localname, kbname, srcurl, compurl)
+            for version, verurl in vers:
+                line += "{};{};".format(version, verurl)
+            yield line
+
+    def changed(self):
+        self.changes += 1
+        if self.checkpoint and self.changes >= self.checkpoint:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            self.db.commit()
+        self.changes = 0
+        return True
+
+class SQLiteCompView:
+    #
+    # Read-only kblookupdict replacement backed by SQLiteKBFile (plus components added during this run)
+    def __init__(self, kbdb):
+        self.kbdb = kbdb
+        self.added = {}
+
+    def __contains__(self, compname):
+        return compname in self.added or len(self.kbdb.compurls(compname)) > 0
+
+    def __len__(self):
+        return self.kbdb.component_count() + sum(1 for compname in self.added if not self.kbdb.compurls(compname))
+
+    def __getitem__(self, compname):
+        urls = self.kbdb.compurls(compname) + self.added.get(compname, [])
+        if not urls:
+            raise KeyError(compname)
+        return urls
+
+    def setdefault(self, compname, default):
+        return self.added.setdefault(compname, default)
+
+class SQLiteVerView:
+    #
+    # Read-only kbverdict replacement backed by SQLiteKBFile (plus versions matched during this run)
+    def __init__(self, kbdb):
+        self.kbdb = kbdb
+        self.added = {}
+
+    def _lookup(self, compver):
+        if compver in self.added:
+            return self.added[compver]
+        compname, sep, version = compver.rpartition("/")
+        return self.kbdb.verurl(compname, version)
+
+    def __contains__(self, compver):
+        return self._lookup(compver) is not None
+
+    def __getitem__(self, compver):
+        verurl = self._lookup(compver)
+        if verurl is None:
+            raise KeyError(compver)
+        return verurl
+
+    def __setitem__(self, compver, verurl):
+        self.added[compver] = verurl
+
+def is_sqlite_kbfile(filename):
+    if os.path.splitext(filename)[1].lower() in (".db", ".sqlite", ".sqlite3"):
+        return True
     try:
-        ofile = open(outkbfile, "r")
+        with open(filename, "rb") as kfile:
+            return kfile.read(16) == b"SQLite format 3\x00"
+    except OSError:
+        return False
+
+def open_kbfile(filename, checkpoint=100):
+    if is_sqlite_kbfile(filename):
+        return SQLiteKBFile(filename, checkpoint)
+    return KBFile(filename, checkpoint)
+
+def import_kbfile(kbfile, outkb):
+    #
+    # If outkb is not None then copy kbfile entries to the output KBFile
+    #
+    # FIELDS:
+    # 1 = Local component name;
+    # 2 = KB component name;
+    # 3 = KB component source URL;
+    # 4 = KB component URL;
+    #
+    # OPTIONAL:
+    # 5 = Local component version string
+    # 6 = KB Component version URL
+    # (Repeated as often as matched)
+    global kblookupdict, kbverdict
+
+    output = outkb is not None and os.path.abspath(outkb.filename) != os.path.abspath(kbfile)
+    if is_sqlite_kbfile(kbfile):
+        #
+        # SQLite kbfile - lookups are performed on demand
+        if not os.path.isfile(kbfile):
+            logging.error("import_kbfile(): Failed to open file {} ".format(kbfile))
+            return
+        print("Opening Input KB Lookup database {} ...".format(kbfile))
+        kbdb = SQLiteKBFile(kbfile, 0)
+        kblookupdict = SQLiteCompView(kbdb)
+        kbverdict = SQLiteVerView(kbdb)
+        if output:
+            for line in kbdb.entries():
+                outkb.add_entry(line, False)
+        print("Using {} entries from {}".format(kbdb.count(), kbfile))
+        return
+
+    try:
+        kfile = open(kbfile, "r")
     except:
-        logging.error("update_kbfile(): Failed to open file {} for read".format(outkbfile))
+        logging.error("import_kbfile(): Failed to open file {} ".format(kbfile))
         return
 
-    lines = ofile.readlines()
-    ofile.close()
+    print("Reading Input KB Lookup file {} ...".format(kbfile))
+
+    count = 0
+    for line in kfile:
+        elements = line.split(";")
+        if len(elements) < 4:
+            continue
+        compname = elements[0]
+        kbcompurl = elements[3]
+        kblookupdict.setdefault(compname, []).append(kbcompurl)
+        index = 4
+        while index < len(elements) - 1:
+            kbverdict[compname + "/" + elements[index]] = elements[index+1]
+            index += 2
+        count += 1
+        if output:
+            outkb.add_entry(line, False)
+
+    kfile.close()
+
+    print("Processed {} entries from {}".format(count, kbfile))
+    return
+
+def convert_kbfile(infile, outfile):
+    #
+    # Convert a KB Lookup file between text and SQLite formats (chosen by filename)
+    if not os.path.isfile(infile):
+        print("ERROR: Cannot open input KB Lookup file {}".format(infile))
+        return False
+    if os.path.exists(outfile):
+        print("ERROR: Output file {} already exists".format(outfile))
+        return False
+
+    inkb = open_kbfile(infile, 0)
+    inkb.load()
+    outkb = open_kbfile(outfile, 0)
+    count = 0
+    for line in inkb.entries():
+        outkb.add_entry(line, False)
+        count += 1
+    outkb.save()
+    print("Converted {} entries from {} to {}".format(count, infile, outfile))
+    return True
+
+class ResumeKBFile:
+    #
+    # Wrapper for the output KBFile used when applying results read back from the lookup journal
+    # Results which had already been written to the output file before the previous run stopped are not added again
+    # Only entries added in this run are reported as existing, so resumed results get the same outcome (e.g. New
+    # Match rather than New Version Match for a line written at a checkpoint) as in a single complete run
+    def __init__(self, kbfile):
+        self.kbfile = kbfile
+
+    def add_entry(self, line, changed=True):
+        elements = line.rstrip("\r\n").split(";")
+        if not self.kbfile.has_entry(elements[0], elements[3]):
+            self.kbfile.add_entry(line, changed)
+            return
+        self.kbfile.added.add((elements[0], elements[3]))
+        for version, kbverurl in zip(elements[4::2], elements[5::2]):
+            self.update_entry(elements[0], version, elements[3], kbverurl)
+
+    def update_entry(self, package, version, compurl, kbverurl):
+        if not self.kbfile.has_version(package, compurl, version):
+            self.kbfile.update_entry(package, version, compurl, kbverurl)
+
+    def has_entry(self, package, compurl):
+        return (package, compurl) in self.kbfile.added
+
+    def compurls(self, localname):
+        return [compurl for compurl in self.kbfile.compurls(localname) if (localname, compurl) in self.kbfile.added]
+
+class LookupJournal:
+    #
+    # Append-only journal of kblookup results (JSON lines) kept alongside the output kbfile as <output>.journal
+    # Each result is written and flushed as soon as it is applied, so a run which stops early (crash, Ctrl-C or
+    # --budget) can be repeated with the same options and continues without repeating the completed lookups
+    # The first line records the options which affect lookup results - the journal is discarded if they change
+    # A partial last line (from a crash during a write) is ignored
+    def __init__(self, filename, options):
+        self.filename = filename
+        self.options = options
+        self.jfile = None
+
+    def load(self):
+        #
+        # Returns dict of (component, version) with resolve_manifest_entry() results from the previous run
+        results = {}
+        try:
+            with open(self.filename, "r") as jfile:
+                lines = iter(jfile)
+                try:
+                    header = json.loads(next(lines))
+                except (StopIteration, ValueError):
+                    header = None
+                if header != {'journal': self.options}:
+                    print("Ignoring lookup journal {} from a run with different options".format(self.filename))
+                    logging.info("Ignoring lookup journal {} - options changed".format(self.filename))
+                    return results
+                for line in lines:
+                    try:
+                        entry = json.loads(line)
+                        results[(entry['package'], entry['version'])] = tuple(entry['result'])
+                    except (ValueError, KeyError, TypeError):
+                        break
+        except FileNotFoundError:
+            return results
+        except OSError as e:
+            logging.error("LookupJournal.load(): Failed to read {} - {}".format(self.filename, e))
+            return results
+
+        #
+        # Rewrite the valid entries so new results are not appended after a partial line
+        self.open(results)
+        return results
+
+    def open(self, results=None):
+        try:
+            self.jfile = open(self.filename, "w")
+            self.jfile.write(json.dumps({'journal': self.options}) + "\n")
+            for (package, version), result in (results or {}).items():
+                self.jfile.write(json.dumps({'package': package, 'version': version, 'result': result}) + "\n")
+            self.jfile.flush()
+        except OSError as e:
+            logging.error("LookupJournal.open(): Failed to write {} - {}".format(self.filename, e))
+            self.jfile = None
+
+    def record(self, package, version, result):
+        if self.jfile is None:
+            self.open()
+        if self.jfile is None:
+            return
+        self.jfile.write(json.dumps({'package': package, 'version': version, 'result': result}) + "\n")
+        self.jfile.flush()
+
+    def close(self):
+        if self.jfile is not None:
+            os.fsync(self.jfile.fileno())
+            self.jfile.close()
+            self.jfile = None
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+
+def journal_options(args):
+    #
+    # Options recorded in the lookup journal header (a different replacement file, input kbfile, pkgdata or input
+    # format gives different results)
+    try:
+        with open(args.replace_file, "rb") as rfile:
+            repdigest = hashlib.sha1(rfile.read()).hexdigest()
+    except OSError:
+        repdigest = ""
+    return {
+        'format': 2,
+        'replace_file': repdigest,
+        'kbfile': os.path.abspath(args.kbfile) if args.kbfile else "",
+        'pkgdata': os.path.abspath(args.pkgdata) if getattr(args, 'pkgdata', None) else "",
+        'input_format': getattr(args, 'input_format', 'auto'),
+    }
+
+class ManifestState:
+    #
+    # Component/version entries of the build manifest processed by a run, saved as JSON (--save-state) so a later
+    # run can process only the entries added or changed since then (--previous)
+    # In import mode each entry records the KB version URL in the BOM for the entry ("" for none, None if unknown)
+    FORMAT = 1
+
+    def __init__(self, command, options, entries=None):
+        self.command = command
+        self.options = options
+        self.entries = entries if entries is not None else {}     # Dict of (component, version) with KB version URL
+
+    def fingerprint(self):
+        data = json.dumps(sorted([package, version, kbverurl or ""] for (package, version), kbverurl in self.entries.items()))
+        return hashlib.sha1(data.encode()).hexdigest()
 
+    def save(self, filename):
+        tmpname = filename + ".tmp"
+        try:
+            with open(tmpname, "w") as sfile:
+                json.dump({'state': self.FORMAT, 'command': self.command, 'options': self.options,
+                           'fingerprint': self.fingerprint(),
+                           'entries': [[package, version, kbverurl] for (package, version), kbverurl in self.entries.items()]}, sfile)
+            os.replace(tmpname, filename)
+        except OSError as e:
+            print("ERROR: Cannot write manifest state file {} - {}".format(filename, e))
+            logging.error("ManifestState.save(): Failed to write {} - {}".format(filename, e))
+            return
+        print("Saved manifest state ({} entries) to {}".format(len(self.entries), filename))
+
+def state_options(args):
+    #
+    # Options recorded in the manifest state file - the previous state is not used if they change
+    if args.command == 'import':
+        return {'project': args.project, 'version': args.version}
+    return {'replace_file': journal_options(args)['replace_file']}
+
+def load_previous_manifest(filename, command, options):
+    #
+    # Returns the ManifestState of a previous manifest file or state file (--save-state), or None if all
+    # entries should be processed (file not found, or a state file from a run with different options)
     try:
-        ofile = open(outkbfile, "w")
+        pfile = open(filename, "r")
+    except OSError:
+        print("Previous manifest {} not found - processing all entries".format(filename))
+        logging.info("Previous manifest {} not found".format(filename))
+        return None
+
+    with pfile:
+        if pfile.read(1) != "{":
+            #
+            # Previous build manifest file
+            pfile.close()
+            state = ManifestState(command, options)
+            for package, version, skip, compfile in ManifestReader([filename], reprules):
+                if package != "":
+                    state.entries[(package, version)] = None
+            return state
+        pfile.seek(0)
+        try:
+            data = json.load(pfile)
+            state = ManifestState(data['command'], data['options'],
+                                  {(package, version): kbverurl for package, version, kbverurl in data['entries']})
+            valid = data['state'] == ManifestState.FORMAT and data['fingerprint'] == state.fingerprint()
+        except (ValueError, KeyError, TypeError):
+            valid = False
+    if not valid:
+        print("Ignoring invalid manifest state file {} - processing all entries".format(filename))
+        logging.error("Invalid manifest state file {}".format(filename))
+        return None
+    if state.command == command and state.options != options:
+        print("Ignoring manifest state file {} from a run with different options - processing all entries".format(filename))
+        logging.info("Ignoring manifest state file {} - options changed".format(filename))
+        return None
+    if state.command != command:
+        # URLs are only recorded by import mode
+        state.entries = dict.fromkeys(state.entries)
+    return state
+
+def find_compver_from_compurl(package, kburl, search_version):
+    compname, matchversion, matchstrength, bdcomp_sourceurl, bd_verurl = find_ver_from_compver(kburl, search_version)
+    if matchstrength > 0:
+        logging.debug("Found version match {} with strength {}".format(matchversion, matchstrength))
+        return bd_verurl, bdcomp_sourceurl, compname, matchversion, matchstrength
+    else:
+        logging.debug("No version match found")
+        return "NO VERSION MATCH", "", "", "", 0
+
+@instrumented('package')
+def resolve_manifest_entry(package, version):
+    #
+    # Resolve a single manifest entry against the KB (run in worker threads)
+    # Must not print or write to the output files - results are applied in manifest order by the main loop
+    # Results published to the shared match store by this or other processes are reused
+    start = time.perf_counter()
+    try:
+        if matchstore is None:
+            return lookup_manifest_entry(package, version)
+        key = matchstore.key(package, version)
+        result = matchstore.get(key)
+        if result is None:
+            result = lookup_manifest_entry(package, version)
+            matchstore.put(key, result)
+        return result
+    except KBRequestError as e:
+        return lookup_error_result(package, version, e, start)
+
+def lookup_error_result(package, version, error, start):
+    #
+    # resolve_manifest_entry() result for a lookup which failed with a KB request error - the entry is reported as
+    # failed and is not written to the KB Lookup File, lookup journal or match store, so it is looked up again
+    logging.error("KB lookup for {}/{} failed - {}".format(package, version, error))
+    metrics.count("kb_lookup_errors")
+    match = {'kb_component': "", 'kb_version': "", 'search': "", 'match_strength': 0, 'error': str(error),
+             'elapsed': round(time.perf_counter() - start, 6)}
+    return "NO VERSION MATCH", "", "", "", match
+
+def lookup_failed(result):
+    return result is not None and bool(result[4].get('error'))
+
+def lookup_manifest_entry(package, version):
+    #
+    # Returns version URL found from the existing kbfile component URLs (or "NO VERSION MATCH"),
+    # followed by the kbfile line, list output message and component name from an open KB search,
+    # and a dict of the matched KB component, KB version, search name used and elapsed time
+    start = time.perf_counter()
+    if package in kblookupdict:
+        #
+        # Loop through component URLs to check for component version
+        logging.debug("Version {}/{} not found in KBLookup file - searching in KB".format(package, version))
+        # (the strongest version match from the component URLs, stopping at an exact match)
+        best = None
+        for kburl in kblookupdict[package]:
+            if kburl == "NO MATCH":
+                continue
+            logging.debug("Working with component entry {} from KBLookup file".format(kburl))
+            kbverurl, srcurl, kbname, kbversion, matchstrength = find_compver_from_compurl(package, kburl, version)
+            if kbverurl != "NO VERSION MATCH" and (best is None or matchstrength > best[3]):
+                best = (kbverurl, kbname, kbversion, matchstrength)
+                if matchstrength == 3:
+                    break
+        if best:
+            kbverurl, kbname, kbversion, matchstrength = best
+            match = {'kb_component': kbname, 'kb_version': kbversion, 'search': "", 'match_strength': matchstrength,
+                     'elapsed': round(time.perf_counter() - start, 6)}
+            return kbverurl, "", "", "", match
+        #
+        # No version match from existing KBLookup entries
+        # Need to do a final open search
+    else:
+        logging.debug("Component {} not found in KBLookup file".format(package))
+
+    recipe = package_recipe(package)
+    if recipe:
+        newkbline, listmsg, compname, match = find_recipe_from_kb(package, version, recipe)
+    else:
+        newkbline, listmsg, compname, match = find_comp_from_kb(package, version, reprules)
+    match['elapsed'] = round(time.perf_counter() - start, 6)
+    return "NO VERSION MATCH", newkbline, listmsg, compname, match
+
+@instrumented('package')
+def resolve_import_entry(package, version):
+    #
+    # Find the KB component version URL for a manifest entry in import mode
+    # Returns "" if the component is not in the kbfile, "NO VERSION MATCH", or KB_LOOKUP_FAILED if the
+    # KB version list could not be retrieved
+    if package not in kblookupdict:
+        return ""
+    #
+    # Check if package/version is in kbverdict
+    packstr = package + "/" + version
+    if packstr in kbverdict:
+        #
+        # Component version URL found in kbfile
+        logging.debug("Compver found in kbverdict packstr = {}, kbverdict[packstr] = {}".format(packstr, kbverdict[packstr]))
+        return kbverdict[packstr]
+    #
+    # No match of component version in kbfile version URLs
+    kbverurl = "NO VERSION MATCH"
+    beststrength = 0
+    for kburl in kblookupdict[package]:
+        #
+        # Loop through component URLs from kbfile - use the strongest version match, stopping at an exact match
+        if kburl == "NO MATCH":
+            continue
+        try:
+            verurl, srcurl, kbname, kbversion, matchstrength = find_compver_from_compurl(package, kburl, version)
+        except KBRequestError as e:
+            return import_lookup_error(package, version, e)
+        if matchstrength > beststrength:
+            kbverurl, beststrength = verurl, matchstrength
+        if matchstrength == 3:
+            break
+    return kbverurl
+
+KB_LOOKUP_FAILED = "KB LOOKUP FAILED"
+
+def import_lookup_error(package, version, error):
+    logging.error("KB lookup for {}/{} failed - {}".format(package, version, error))
+    metrics.count("kb_lookup_errors")
+    return KB_LOOKUP_FAILED
+
+BOM_COMPONENT_HEADERS = {
+        'Content-Type':'application/vnd.blackducksoftware.bill-of-materials-6+json'
+}
+
+def bom_component_postdata(kbverurl, compfile, compver):
+    return {
+            "component" : kbverurl,
+            "componentPurpose" : "import_manifest: imported from file " + compfile,
+            "componentModified" : False,
+            "componentModification" : "Original component = " + compver
+    }
+
+@instrumented('add_comp_to_bom')
+def add_comp_to_bom(bdverurl, kbverurl, compfile, compver):
+
+    posturl = bdverurl + "/components"
+    postdata = bom_component_postdata(kbverurl, compfile, compver)
+
+    #print("POST command - posturl = {} postdata = {}".format(posturl, postdata, custom_headers))
+    return http_request('bom_add', hub.execute_post, posturl, postdata, BOM_COMPONENT_HEADERS)
+
+@instrumented('del_comp_from_bom')
+def del_comp_from_bom(compurl):
+    return http_request('bom_delete', hub.execute_delete, compurl)
+
+class BOMOperation:
+    #
+    # A BOM add (POST) or delete (DELETE) request and its result
+    def __init__(self, action, url, compver, kbverurl="", compfile=""):
+        self.action = action        # 'add' or 'delete'
+        self.url = url              # Project version URL (add) or BOM component URL (delete)
+        self.compver = compver      # Manifest component/version (add) or BOM component/version (delete)
+        self.kbverurl = kbverurl    # KB component version URL to add
+        self.compfile = compfile
+        self.status_code = None
+        self.retry_after = None     # Retry-After delay from a throttled response
+        self.attempts = 0
+        self.error = ""
+        self.elapsed = 0.0
+
+    def succeeded(self):
+        return self.status_code in (200, 201, 204)
+
+    def transient(self):
+        # Connection errors, throttling and server errors are retried
+        return self.status_code is None or self.status_code in TRANSIENT_STATUS_CODES
+
+    def record(self):
+        return {'action': self.action, 'component': self.compver, 'url': self.url, 'kbverurl': self.kbverurl,
+                'status': self.status_code, 'attempts': self.attempts, 'error': self.error,
+                'elapsed': round(self.elapsed, 3)}
+
+def bom_retry_delay(operation, retries, backoff):
+    #
+    # Return the time to wait before retrying a failed operation (exponential backoff with jitter, or the
+    # Retry-After delay from the server if longer) or None if the operation is complete
+    if operation.succeeded() or not operation.transient() or operation.attempts > retries:
+        return None
+    logging.info("Retrying BOM {} {} (status {}, attempt {})".format(operation.action, operation.compver, operation.status_code, operation.attempts))
+    return max(backoff * (2 ** (operation.attempts - 1)) * (0.5 + random.random() / 2), operation.retry_after or 0.0)
+
+def bom_operation_done(operation):
+    if operation.succeeded():
+        logging.debug("BOM {} {} completed ({})".format(operation.action, operation.compver, operation.kbverurl or operation.url))
+    else:
+        logging.error("BOM {} {} failed, status code: {} {}".format(operation.action, operation.compver, operation.status_code, operation.error))
+
+class BOMWriter:
+    #
+    # Runs BOM add and delete operations in a thread pool, retrying transient failures with backoff
+    def __init__(self, workers, retries, backoff):
+        self.workers = max(workers, 1)
+        self.retries = retries
+        self.backoff = backoff
+
+    def execute(self, operation):
+        start = time.time()
+        while True:
+            operation.attempts += 1
+            try:
+                if operation.action == 'add':
+                    response = add_comp_to_bom(operation.url, operation.kbverurl, operation.compfile, operation.compver)
+                else:
+                    response = del_comp_from_bom(operation.url)
+                operation.status_code = response.status_code
+                operation.retry_after = retry_after_seconds(response.headers)
+                operation.error = ""
+            except Exception as e:
+                operation.status_code = None
+                operation.error = str(e)
+            delay = bom_retry_delay(operation, self.retries, self.backoff)
+            if delay is None:
+                break
+            time.sleep(delay)
+        operation.elapsed = time.time() - start
+        bom_operation_done(operation)
+        return operation
+
+    def run(self, operations):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(self.execute, operations))
+
+def run_bom_operations(args, operations):
+    if not operations:
+        return operations
+    if args.use_async:
+        return run_async(args.max_inflight, async_run_bom_operations, operations, args.retries, args.backoff)
+    return BOMWriter(args.workers, args.retries, args.backoff).run(operations)
+
+def bom_add_outcome(operation):
+    #
+    # Result of a BOM add - returns 'added', 'exists' (409 Conflict or 412 Precondition Failed - the component
+    # version is already in the BOM) or 'failed' (any other error, reported with its status code)
+    if operation.succeeded():
+        return 'added'
+    elif operation.status_code in (409, 412):
+        return 'exists'
+    else:
+        return 'failed'
+
+def write_bom_report(filename, operations):
+    try:
+        with open(filename, "w") as rfile:
+            for operation in operations:
+                rfile.write(json.dumps(operation.record()) + "\n")
+    except OSError:
+        logging.error("Failed to write BOM report file {}".format(filename))
+
+class AsyncKBClient:
+    #
+    # asyncio client for the KB and BOM requests (requires the aiohttp package)
+    # Uses one pooled keep-alive session for all requests with at most max_inflight requests in flight,
+    # the Hub authentication headers from hub.get_headers() and the persistent KB response cache
+    # Requests are limited by hubthrottle and KB GETs are retried as for http_request()
+    # Results are stored in the same per-run dicts as the synchronous functions (kbsearchresults,
+    # compverindex) so the matching logic can run unchanged once the data has been fetched
+    def __init__(self, max_inflight):
+        self.max_inflight = max_inflight
+        self.session = None
+        self.inflight = None
+        self.slots = None   # Condition notified when a hubthrottle slot is released
+        self.pending = {}   # Dict of key with future for fetches in flight (as SingleFlight)
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_inflight, keepalive_timeout=60,
+                                         ssl=False if hub.config.get('insecure') else None)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=300))
+        self.inflight = asyncio.Semaphore(self.max_inflight)
+        self.slots = asyncio.Condition()
+        return self
+
+    async def __aexit__(self, *excinfo):
+        await self.session.close()
+
+    async def request(self, endpoint, method, url, data=None, custom_headers={}):
+        body = None
+        if data is not None:
+            body = json.dumps(data)
+        retries = hubthrottle.retries if endpoint in RETRIED_ENDPOINTS else 0
+        attempt = 0
+        reauthenticated = False
+        while True:
+            token = hub.token
+            headers = hub.get_headers()
+            headers.update(custom_headers)
+            async with self.slots:
+                await self.slots.wait_for(hubthrottle.try_start)
+            await asyncio.sleep(hubthrottle.reserve())
+            async with self.inflight:
+                start = time.perf_counter()
+                status = "error"
+                content = b""
+                retryafter = None
+                try:
+                    async with self.session.request(method, url, headers=headers, data=body) as response:
+                        content = await response.read()
+                        status = response.status
+                        retryafter = retry_after_seconds(response.headers)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt >= retries or not isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+                        raise
+                    logging.debug("{} request failed - {}".format(endpoint, e))
+                finally:
+                    metrics.http_response(endpoint, status, len(content), time.perf_counter() - start)
+                    hubthrottle.finish(status, retryafter)
+                    async with self.slots:
+                        self.slots.notify_all()
+            if status == 401 and not reauthenticated:
+                # Bearer token expired or revoked
+                reauthenticated = True
+                hub.reauthenticate(token)
+                continue
+            if (status != "error" and status not in TRANSIENT_STATUS_CODES) or attempt >= retries:
+                break
+            attempt += 1
+            metrics.count("request_retries")
+            delay = hubthrottle.retry_delay(attempt, retryafter)
+            logging.info("Retrying {} request (status {}, attempt {}) in {:.1f} seconds".format(endpoint, status, attempt, delay))
+            await asyncio.sleep(delay)
+        try:
+            respdata = json.loads(content) if content else None
+        except ValueError:
+            respdata = None
+        return KBResponse(status, respdata, {'Retry-After': str(retryafter)} if retryafter is not None else None)
+
+    async def get(self, url, endpoint):
+        if kbcache:
+            data = kbcache.get(url, endpoint)
+            if data is not None:
+                return KBResponse(200, data)
+
+        async def fetch():
+            try:
+                response = await self.request(endpoint, 'GET', url)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise KBRequestError("KB request {} failed - {}".format(url, e))
+            if kbcache and response.status_code == 200:
+                kbcache.put(url, endpoint, response.json())
+            return response
+        return await self.coalesce(('GET', url), fetch)
+
+    async def post(self, url, data, custom_headers={}):
+        return await self.request('bom_add', 'POST', url, data, custom_headers)
+
+    async def delete(self, url):
+        return await self.request('bom_delete', 'DELETE', url)
+
+    async def coalesce(self, key, fetch):
+        #
+        # Await fetch() unless a fetch for key is already in flight, in which case share its result
+        if key in self.pending:
+            metrics.count("coalesced_calls")
+            return await self.pending[key]
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        try:
+            result = await fetch()
+        except Exception as e:
+            future.set_exception(e)
+            # (marks the exception as retrieved if there are no other waiters)
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self.pending[key]
+        return result
+
+    async def once(self, name, memo, key, fetch):
+        #
+        # Fetch a result into memo[key] unless already fetched or in flight
+        if key in memo:
+            metrics.count(name + "_memo_hits")
+            return memo[key]
+
+        async def fetch_memo():
+            result = await fetch()
+            memo[key] = result
+            return result
+        return await self.coalesce((name, key), fetch_memo)
+
+    async def kb_hits(self, componentname):
+        async def fetch():
+            return kb_search_hits(await self.get(kb_search_url(componentname), 'search'))
+        return await self.once("search", kbsearchresults, componentname, fetch)
+
+    async def component_version_index(self, kburl):
+        async def fetch():
+            component = await self.get(kburl, 'component')
+            kbversions = None
+            if component.status_code == 200:
+                kbversions = await self.get(kb_versions_url(component), 'versions')
+            return build_component_version_index(kburl, component, kbversions)
+        return await self.once("version_index", compverindex, kburl, fetch)
+
+async def async_search_kbcomponent(client, component, version):
+    #
+    # Fetch the KB data needed by search_kbcomponent() for this search name (stopping at the first hit
+    # with a version match as find_ver_from_hits() does) - returns True if the version was matched
+    if component in kbnomatchcomps:
+        return False
+    if component + "/" + version in kbverdict:
+        return True
+    hits = await client.kb_hits(component)
+    if not hits:
+        return False
+    for hit in hits:
+        await client.component_version_index(hit['component'])
+        if find_ver_from_compver(hit['component'], version)[2] == 3:
+            return True
+    return search_kbcomponent(component, version)[2] == 3
+
+async def async_resolve_manifest_entry(client, package, version):
+    #
+    # Fetch the KB data for a manifest entry concurrently then resolve it with resolve_manifest_entry()
+    # which runs from the fetched data without further requests
+    start = time.perf_counter()
+    if matchstore:
+        result = matchstore.get(matchstore.key(package, version))
+        if result is not None:
+            return result
+    try:
+        await async_fetch_manifest_entry(client, package, version)
+    except KBRequestError as e:
+        return lookup_error_result(package, version, e, start)
+    result = resolve_manifest_entry.__wrapped__(package, version)
+    elapsed = time.perf_counter() - start
+    result[4]['elapsed'] = round(elapsed, 6)
+    metrics.observe('package', elapsed)
+    return result
+
+async def async_fetch_manifest_entry(client, package, version):
+    #
+    # Fetch the KB data that resolve_manifest_entry() needs for a manifest entry (as lookup_manifest_entry())
+    fetched = False
+    if package in kblookupdict:
+        # (an open search is only needed if none of the component URLs has a version match)
+        for kburl in kblookupdict[package]:
+            if kburl == "NO MATCH":
+                continue
+            await client.component_version_index(kburl)
+            matchstrength = find_ver_from_compver(kburl, version)[2]
+            fetched = fetched or matchstrength > 0
+            if matchstrength == 3:
+                break
+    if not fetched:
+        recipe = package_recipe(package)
+        searchname, searchversion = recipe or (package, version)
+        terms = recipe_search_terms(recipe) if recipe else []
+        for term in terms:
+            if await async_search_kbcomponent(client, term, searchversion):
+                fetched = True
+                break
+        # (as find_comp_from_kb() the name variants are only searched if none of the exact terms match)
+        fetched = fetched or any(search_kbcomponent(term, searchversion)[2] > 0 for term in terms)
+    if not fetched:
+        for searchname, basename in search_candidates(searchname, reprules):
+            if searchname not in terms and await async_search_kbcomponent(client, searchname, searchversion):
+                break
+
+async def async_resolve_entries(client, entries):
+    return await asyncio.gather(*[async_resolve_manifest_entry(client, package, version) for package, version in entries])
+
+async def async_resolve_import_entries(client, entries):
+    #
+    # Resolve KB version URLs for import concurrently - returns list of resolve_import_entry() results in manifest order
+    async def process(package, version):
+        start = time.perf_counter()
+        if package in kblookupdict and package + "/" + version not in kbverdict:
+            for kburl in kblookupdict[package]:
+                if kburl == "NO MATCH":
+                    continue
+                try:
+                    await client.component_version_index(kburl)
+                except KBRequestError as e:
+                    return import_lookup_error(package, version, e)
+                if find_ver_from_compver(kburl, version)[2] == 3:
+                    break
+        result = resolve_import_entry.__wrapped__(package, version)
+        metrics.observe('package', time.perf_counter() - start)
+        return result
+
+    return await asyncio.gather(*[process(entry[0], entry[1]) for entry in entries])
+
+async def async_execute_bom_operation(client, operation, retries, backoff):
+    start = time.time()
+    while True:
+        operation.attempts += 1
+        try:
+            if operation.action == 'add':
+                response = await client.post(operation.url + "/components",
+                                             bom_component_postdata(operation.kbverurl, operation.compfile, operation.compver),
+                                             BOM_COMPONENT_HEADERS)
+            else:
+                response = await client.delete(operation.url)
+            operation.status_code = response.status_code
+            operation.retry_after = retry_after_seconds(response.headers)
+            operation.error = ""
+        except Exception as e:
+            operation.status_code = None
+            operation.error = str(e)
+        delay = bom_retry_delay(operation, retries, backoff)
+        if delay is None:
+            break
+        await asyncio.sleep(delay)
+    operation.elapsed = time.time() - start
+    bom_operation_done(operation)
+    return operation
+
+async def async_run_bom_operations(client, operations, retries, backoff):
+    return await asyncio.gather(*[async_execute_bom_operation(client, operation, retries, backoff) for operation in operations])
+
+def run_async(max_inflight, func, *params):
+    #
+    # Run func(client, *params) with an AsyncKBClient in a new event loop
+    async def main():
+        async with AsyncKBClient(max_inflight) as client:
+            return await func(client, *params)
+    return asyncio.run(main())
+
+def completed_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+BOM_ACCEPT_HEADERS = {
+        'Accept':'application/vnd.blackducksoftware.bill-of-materials-6+json'
+}
+
+def iter_bom_components(bdversion, pagesize=500):
+    #
+    # Generator returning all components in the project version BOM, fetching one page at a time
+    url = bdversion['_meta']['href'] + "/components"
+    offset = 0
+    while True:
+        response = http_request('bom_list', hub.execute_get, "{}?offset={}&limit={}".format(url, offset, pagesize), BOM_ACCEPT_HEADERS)
+        if response.status_code != 200:
+            logging.error("Failed to retrieve project version components, status code: {}".format(response.status_code))
+            raise RuntimeError("Cannot retrieve project version components (status code {})".format(response.status_code))
+        data = response.json()
+        items = data.get('items', [])
+        for item in items:
+            yield item
+        offset += len(items)
+        if len(items) == 0 or offset >= data.get('totalCount', 0):
+            break
+
+class BOMSnapshot:
+    #
+    # Index of the components in a project version BOM keyed by KB component version URL
+    # (or KB component URL for components without a version)
+    def __init__(self):
+        self.components = {}    # Dict of KB component version URL with BOM component
+        self.manual = {}        # Dict of KB component version URL with BOM component URL for manually added components
+        self.count = 0
+
+    def load(self, bdversion):
+        for component in iter_bom_components(bdversion):
+            self.add(component)
+        return self
+
+    def add(self, component):
+        key = component.get('componentVersion') or component.get('component')
+        self.count += 1
+        if not key:
+            return
+        self.components[key] = component
+        if 'MANUAL_BOM_COMPONENT' in component.get('matchTypes', []):
+            self.manual[key] = component['_meta']['href']
+
+    def __contains__(self, kbverurl):
+        return kbverurl in self.components
+
+    def describe(self, kbverurl):
+        component = self.components.get(kbverurl, {})
+        return "{}/{}".format(component.get('componentName', ''), component.get('componentVersionName', ''))
+
+def manage_project_version(proj, ver):
+    bdproject = hub.get_project_by_name(proj)
+    if not bdproject:
+        resp = hub.create_project(proj, ver)
+        if resp.status_code != 201:
+            logging.debug("Cannot create project {}".format(proj))
+            return None, None
+
+        print("Created project '{}'".format(proj))
+        bdproject = hub.get_project_by_name(proj)
+    else:
+        print("Opening project '{}'".format(proj))
+
+    bdversion = hub.get_version_by_name(bdproject, ver)
+    if not bdversion:
+        resp = hub.create_project_version(bdproject, ver)
+        if resp.status_code != 201:
+            logging.debug("Cannot create version {}".format(ver))
+            return None, None
+        print("Created version '{}'".format(ver))
+        bdversion = hub.get_version_by_name(bdproject, ver)
+    else:
+        print("Opening version '{}'".format(ver))
+    return bdproject, bdversion
+
+
+def read_compfile(compfile):
+    #
+    # Generator returning lines from a build manifest file ("-" for stdin)
+    if compfile == "-":
+        for line in sys.stdin:
+            yield line
+        return
+    try:
+        cfile = open(compfile)
     except:
-        logging.error("update_kbfile(): Failed to open file {} for write".format(outkbfile))
+        logging.error("Failed to open file {} ".format(compfile))
         return
 
+    with cfile:
+        for line in cfile:
+            yield line
+
+
+def parse_compfile_line(line):
+# Example line from build manifest:
+#     alsa-utils-alsamixer aarch64 1.1.5
+#
+# Returns component name and version (with trailing +digits removed) or None for an invalid line
+    splitline = line.rstrip().split(" ")
+    if len(splitline) != 3:
+        logging.error("Invalid build manifest line format - expecting '<comp> <arch> <version'")
+        return None
+
+    return splitline[0], normalise_manifest_version(splitline[2])
+
+
+def normalise_manifest_version(vername):
+    # Remove trailing +digits from a package version
+    plus = vername.count("+")
+    if (plus > 0):
+        pos = vername.index("+")
+        if (len(vername) > pos + 1) and vername[pos+1:].isdigit():
+            vername = vername[0:pos]
+    return vername
+
+
+def is_skipped(package, reprules):
+    return reprules.skip(package) is not None
+
+
+def process_compfile_line(line, reprules):
+    parsed = parse_compfile_line(line)
+    if parsed is None:
+        return("", "", True)
+    return(parsed[0], parsed[1], is_skipped(parsed[0], reprules))
+    #
+    # 3rd return parameter is whether this line should be SKIPPED
+
+
+#
+# Input format parsers - each takes an iterator of lines from an input file and yields
+# (package, version, recipe, recipe version, source URL) for each entry, or None for an invalid entry
+# (recipe, recipe version and source URL are None if not known)
+
+def parse_manifest_lines(lines):
+    #
+    # Yocto image build manifest (<package> <arch> <version> lines)
     for line in lines:
-        elements = line.split(";")
-        compname = elements[0]
-        thiscompurl = elements[3]
-        if compname != package:
-            ofile.write(line)
+        if line.strip() == "":
+            continue
+        parsed = parse_compfile_line(line)
+        yield None if parsed is None else parsed + (None, None, None)
+
+def parse_license_manifest(lines):
+    #
+    # Yocto license.manifest - a block of "KEY: value" lines for each package separated by blank lines:
+    #     PACKAGE NAME: alsa-utils-alsamixer
+    #     PACKAGE VERSION: 1.1.5
+    #     RECIPE NAME: alsa-utils
+    #     LICENSE: GPLv2+
+    block = {}
+    for line in itertools.chain(lines, [""]):
+        line = line.strip()
+        if line:
+            key, sep, value = line.partition(":")
+            block[key.strip()] = value.strip()
+            continue
+        if not block:
+            continue
+        if block.get('PACKAGE NAME') and block.get('PACKAGE VERSION'):
+            version = normalise_manifest_version(block['PACKAGE VERSION'])
+            recipe = block.get('RECIPE NAME') or None
+            yield block['PACKAGE NAME'], version, recipe, version if recipe else None, None
+        else:
+            logging.error("Invalid license.manifest entry - expecting 'PACKAGE NAME' and 'PACKAGE VERSION'")
+            yield None
+        block = {}
+
+def parse_spdx_json(lines):
+    #
+    # SPDX 2.x JSON document (as written by the Yocto create-spdx class)
+    # Binary packages are reported with the recipe they are GENERATED_FROM (if in the same document),
+    # otherwise the packages in the document are taken to be recipes (SPDXRef-Recipe-*)
+    # The document is read in full as JSON does not allow it to be parsed a line at a time
+    try:
+        doc = json.loads("".join(lines))
+        packages = {package['SPDXID']: package for package in doc.get('packages', [])}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        logging.error("Invalid SPDX JSON document")
+        yield None
+        return
+    generatedfrom = {}
+    for relationship in doc.get('relationships', []):
+        if relationship.get('relationshipType') == 'GENERATED_FROM':
+            generatedfrom[relationship.get('spdxElementId')] = relationship.get('relatedSpdxElement')
+
+    def location(package):
+        url = package.get('downloadLocation', '')
+        return url if url not in ("", "NOASSERTION", "NONE") else None
+
+    binaries = [spdxid for spdxid in packages if not spdxid.startswith(("SPDXRef-Recipe-", "SPDXRef-Image-"))]
+    recipes = [spdxid for spdxid in packages if spdxid.startswith("SPDXRef-Recipe-")]
+    for spdxid in binaries or recipes:
+        package = packages[spdxid]
+        if not package.get('name') or not package.get('versionInfo'):
+            logging.error("SPDX package {} has no name or version - ignored".format(spdxid))
+            yield None
+            continue
+        version = normalise_manifest_version(package['versionInfo'])
+        recipe = packages.get(generatedfrom.get(spdxid), package if spdxid in recipes else None)
+        if recipe and recipe.get('name'):
+            yield package['name'], version, recipe['name'], normalise_manifest_version(recipe.get('versionInfo') or version), location(recipe)
+        else:
+            yield package['name'], version, None, None, location(package)
+
+INPUT_FORMATS = {
+    'manifest': parse_manifest_lines,
+    'license': parse_license_manifest,
+    'spdx': parse_spdx_json,
+}
+
+def detect_input_format(lines, compfile):
+    #
+    # Returns the format of an input file (from the name, or the first non-blank line) and its lines
+    lines = iter(lines)
+    if compfile.endswith(".json"):
+        return 'spdx', lines
+    first = []
+    for line in lines:
+        first.append(line)
+        if line.strip():
+            break
+    text = "".join(first).strip()
+    if text.startswith("{"):
+        fmt = 'spdx'
+    elif text.startswith("PACKAGE NAME:"):
+        fmt = 'license'
+    else:
+        fmt = 'manifest'
+    return fmt, itertools.chain(first, lines)
+
+def source_url_names(url):
+    #
+    # KB search names from a source download URL - the project name from the archive file name (without
+    # the version) or repository path, e.g. "alsa-utils" from .../alsa-utils-1.1.5.tar.bz2 and "zlib" from
+    # https://github.com/madler/zlib/archive/v1.2.11.tar.gz
+    path = re.sub(r"^[a-z0-9+]+://[^/]*", "", url.split(";")[0].strip(), flags=re.IGNORECASE)
+    for segment in reversed([segment for segment in path.split("/") if segment]):
+        name = re.sub(r"\.(tar\.[a-z0-9]+|tgz|tbz2|txz|zip|git)$", "", segment, flags=re.IGNORECASE)
+        name = re.sub(r"[-_.]v?\d[\w.+~-]*$", "", name)
+        if name and not re.match(r"^v?\d", name) and name.lower() not in SOURCE_URL_IGNORED:
+            return [name]
+    return []
+
+SOURCE_URL_IGNORED = ("archive", "archives", "releases", "release", "download", "downloads", "files", "pub", "tags",
+                      "refs", "src", "source", "sources", "dist", "tarballs")
+
+def record_recipe(package, recipe, recipeversion, sourceurl):
+    #
+    # Record the recipe for a manifest package given in the input file (license.manifest or SPDX)
+    recipehints[package] = (recipe, recipeversion)
+    if sourceurl:
+        for name in source_url_names(sourceurl):
+            if name != recipe and name not in sourcenames.setdefault(recipe, []):
+                sourcenames[recipe].append(name)
+
+
+class ManifestReader:
+    #
+    # Streaming reader for one or more build manifest files ("-" for stdin)
+    # Lines are parsed lazily (by the INPUT_FORMATS parser for fmt, or the format detected for each file if 'auto')
+    # and exact duplicate component/version pairs (after version normalisation) are dropped before the SKIP check
+    # and lookup stages - recipes given in the input file are recorded for the KB searches
+    # Yields (component, version, skip, manifest file) - component is "" for an invalid line
+    def __init__(self, compfiles, reprules, fmt='auto'):
+        self.compfiles = compfiles
+        self.reprules = reprules
+        self.fmt = fmt
+        self.seen = set()
+        self.duplicates = 0
+        self.invalid = 0
+
+    def __iter__(self):
+        for compfile in self.compfiles:
+            yield from self.read_lines(read_compfile(compfile), compfile)
+
+    def read_lines(self, lines, compfile):
+        #
+        # Parse build manifest lines (from compfile or another source such as a serve mode request)
+        fmt = self.fmt
+        if fmt == 'auto':
+            fmt, lines = detect_input_format(lines, compfile)
+            logging.info("Reading {} as {} format".format(compfile, fmt))
+        for entry in INPUT_FORMATS[fmt](lines):
+            if entry is None:
+                self.invalid += 1
+                yield "", "", True, compfile
+                continue
+            package, version, recipe, recipeversion, sourceurl = entry
+            if (package, version) in self.seen:
+                self.duplicates += 1
+                continue
+            self.seen.add((package, version))
+            if recipe:
+                record_recipe(package, recipe, recipeversion, sourceurl)
+            yield package, version, is_skipped(package, self.reprules), compfile
+
+
+def check_compfiles(compfiles):
+    for compfile in compfiles:
+        if compfile != "-" and not os.path.isfile(compfile):
+            print("ERROR: Cannot open build manifest file {}".format(compfile))
+            logging.error("Failed to open file {} ".format(compfile))
+            return False
+    if compfiles.count("-") > 1:
+        print("ERROR: stdin (-) can only be specified once")
+        return False
+    return True
+
+
+class ReplacementRules:
+    #
+    # Component name replacement and SKIP rules from the replacement file, compiled once so the cost of
+    # matching a name depends on the length of the name rather than the number of rules:
+    # - exact name replacements (dict)
+    # - SKIP prefixes and the literal leading text of glob: and re: rules are held in one character trie,
+    #   walked once along the name - only the patterns on that path are tried (first in file order wins)
+    #
+    # Rule descriptions (for --explain) are the rule text and replacement file line number
+    END = ""            # Trie node key for a SKIP prefix rule ending at the node
+    PATTERNS = 0        # Trie node key for the list of (index, regex, replacement, rule) pattern rules at the node
+
+    def __init__(self):
+        self.exact = {}         # Dict of component name with (replacement, rule)
+        self.trie = {}
+        self.count = 0
+
+    def _node(self, prefix):
+        node = self.trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        return node
+
+    @staticmethod
+    def literal_prefix(name):
+        #
+        # Literal text any name matching the glob: or re: rule must start with
+        if name.startswith("glob:"):
+            return re.match(r"[^*?\[]*", name[5:]).group(0)
+        pattern = name[3:]
+        if "|" in pattern:
+            return ""
+        prefix = re.match(r"[^.^$*+?{}\[\]\\|()]*", pattern).group(0)
+        if prefix and pattern[len(prefix):len(prefix) + 1] in ("*", "?", "{"):
+            # Last literal character is optional or repeated
+            prefix = prefix[:-1]
+        return prefix
+
+    def add(self, name, replacement, rule):
+        if name.startswith("glob:") or name.startswith("re:"):
+            if name.startswith("glob:"):
+                regex = re.compile(fnmatch.translate(name[5:]))
+            else:
+                regex = re.compile("(?:{})\\Z".format(name[3:]))
+            node = self._node(self.literal_prefix(name))
+            node.setdefault(self.PATTERNS, []).append((self.count, regex, replacement, rule))
+        elif replacement == "SKIP":
+            self._node(name).setdefault(self.END, rule)
+        else:
+            self.exact[name] = (replacement, rule)
+        self.count += 1
+
+    def _patterns(self, name, skip):
+        #
+        # Yields the pattern rules on the trie path of name in file order, or the first SKIP prefix rule found
+        node = self.trie
+        candidates = []
+        for char in [None] + list(name):
+            if char is not None:
+                node = node.get(char)
+                if node is None:
+                    break
+            if skip and self.END in node:
+                return [(-1, None, "SKIP", node[self.END])]
+            candidates += [entry for entry in node.get(self.PATTERNS, ()) if (entry[2] == "SKIP") == skip]
+        candidates.sort(key=lambda entry: entry[0])
+        return candidates
+
+    def skip(self, name):
+        #
+        # Returns the SKIP rule matching name or None
+        for index, regex, replacement, rule in self._patterns(name, True):
+            if regex is None or regex.match(name):
+                return rule
+        return None
+
+    def replace(self, name):
+        #
+        # Returns (replacement name, rule) or (None, None) if no replacement rule matches name
+        if name in self.exact:
+            return self.exact[name]
+        for index, regex, replacement, rule in self._patterns(name, False):
+            match = regex.match(name)
+            if match:
+                if rule.startswith("re:"):
+                    replacement = match.expand(replacement)
+                return replacement, rule
+        return None, None
+
+    def explain(self, name):
+        #
+        # Returns a description of the rule applied to name for --explain
+        rule = self.skip(name)
+        if rule:
+            return "SKIPPED by rule '{}'".format(rule)
+        replacement, rule = self.replace(name)
+        if rule:
+            return "replaced by '{}' from rule '{}'".format(replacement, rule)
+        return "no matching rule"
+
+def process_replacement_file(repfile):
+    #
+    # Rule formats (one per line, lines starting with # are ignored):
+    #   component_name;replacement_string       exact component name
+    #   skip_string;SKIP                        components starting with skip_string
+    #   glob:pattern;replacement_string|SKIP    components matching a glob pattern (e.g. glob:kernel-module-*;SKIP)
+    #   re:regex;replacement_string|SKIP        components matching a regular expression - the replacement can
+    #                                           include groups from the regex (e.g. re:lib(.*)[0-9]+;\1)
+    rules = ReplacementRules()
+    try:
+        rfile = open(repfile)
+    except:
+        print("ERROR: Failed to open replacement file {}".format(repfile))
+        logging.error("Failed to open file {} ".format(repfile))
+        return None
+
+    with rfile:
+        for lineno, line in enumerate(rfile, 1):
+            if line.count(";") == 0 or line.startswith("#"):
+                continue
+            splitline = line.rstrip().split(";")
+            rule = "{};{} (line {})".format(splitline[0], splitline[1], lineno)
+            try:
+                rules.add(splitline[0], splitline[1], rule)
+            except re.error as e:
+                print("ERROR: Invalid pattern in replacement file line {} - {}".format(lineno, e))
+                logging.error("Invalid pattern in replacement file line {} - {}".format(lineno, e))
+                continue
+            if splitline[1] == "SKIP":
+                if splitline[0].startswith("glob:") or splitline[0].startswith("re:"):
+                    print("Will Skip components matching {}".format(splitline[0]))
+                else:
+                    print("Will Skip components starting with {}".format(splitline[0]))
+                logging.info("Will Skip components matching rule {}".format(rule))
+            else:
+                logging.info("Adding replacement {} for component {}".format(splitline[1], splitline[0]))
+
+    return rules
+
+reprules = ReplacementRules()
+
+def listoutput(outline, newline):
+    if listfile:
+        if newline:
+            listfile.write(outline + "\n")
+        else:
+            listfile.write(outline)
+
+    if newline:
+        print(outline)
+    else:
+        print(outline, end = "", flush = True)
+
+class ResultsWriter:
+    #
+    # Buffered writer of one result record per manifest entry (--results) as JSON lines, or CSV for *.csv files
+    # Records are dicts with the keys in FIELDS - the console and listfile output is formatted from the same records
+    FIELDS = ('package', 'version', 'outcome', 'kb_component', 'kb_version', 'kb_component_url', 'kb_version_url',
+              'source_url', 'search', 'match_strength', 'rule', 'detail', 'elapsed')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.rfile = open(filename, "w", buffering=1024 * 1024, newline="")
+        self.csvwriter = None
+        if os.path.splitext(filename)[1].lower() == ".csv":
+            self.csvwriter = csv.DictWriter(self.rfile, fieldnames=self.FIELDS)
+            self.csvwriter.writeheader()
+        self.count = 0
+
+    def write(self, record):
+        if self.csvwriter:
+            self.csvwriter.writerow(record)
+        else:
+            self.rfile.write(json.dumps(record) + "\n")
+        self.count += 1
+
+    def close(self):
+        self.rfile.close()
+        print("Wrote {} result records to {}".format(self.count, self.filename))
+
+def open_results(args):
+    global resultswriter
+    if getattr(args, 'results', None):
+        try:
+            resultswriter = ResultsWriter(args.results)
+        except OSError as e:
+            print("ERROR: Cannot open results file {} - {}".format(args.results, e))
+            exit(1)
+
+def result_record(package, version, outcome=""):
+    record = dict.fromkeys(ResultsWriter.FIELDS, "")
+    record.update(package=package, version=version, outcome=outcome, elapsed=0)
+    return record
+
+def report_result(record, text):
+    #
+    # Write the result record for a manifest entry, with the console/listfile line formatted from it
+    if resultswriter:
+        resultswriter.write(record)
+    listoutput(text, True)
+    logging.info("Component {}/{}: {}".format(record['package'], record['version'], record['outcome']))
+
+def kblookup_result_text(record):
+    text = "Manifest Component = '{}/{}'".format(record['package'], record['version'])
+    outcome = record['outcome']
+    if outcome == 'skipped':
+        return text + "- SKIPPED"
+    if outcome == 'nokblookupmatch':
+        return text + "- NO MATCH in input KB File"
+    if outcome == 'alreadymatched':
+        return text + " - already MATCHED in input KB file"
+    if outcome == 'newvermatch':
+        text += " - MATCHED '{}/{}'".format(record['package'], record['version'])
+        if record['match_strength'] and record['match_strength'] < 3:
+            text += " (partial version match '{}', strength {})".format(record['kb_version'], record['match_strength'])
+        return text
+    if outcome == 'newmatch':
+        text += " - MATCHED '{}/{}'".format(record['kb_component'], record['kb_version'])
+        if record['match_strength'] and record['match_strength'] < 3:
+            text += " (partial version match, strength {})".format(record['match_strength'])
+        return text
+    if outcome == 'lookupfailed':
+        return text + " - KB LOOKUP FAILED ({})".format(record['detail'])
+    return text + " - NO MATCH"
+
+def import_result_text(record):
+    text = "Manifest component to add = '{}/{}'".format(record['package'], record['version'])
+    outcome = record['outcome']
+    if outcome == 'notinkbfile':
+        return text + " - Does not exist in KBlookup file (SKIPPED)"
+    if outcome == 'added':
+        return text + " - Component added"
+    if outcome == 'exists':
+        if record['detail']:
+            return text + " - Component NOT added (Already exists as '{}')".format(record['detail'])
+        return text + " - Component NOT added (Already exists)"
+    if outcome == 'failed':
+        return text + " - Component NOT added (Error {})".format(record['detail'])
+    return text + " - No component match from KB (NOT ADDED)"
+
+def needs_kb_lookup(package, version, skip):
+    if skip:
+        return False
+    if package not in kblookupdict:
+        return True
+    return kblookupdict[package][0] != "NO MATCH" and package + "/" + version not in kbverdict
+
+def apply_kblookup_entry(outkb, package, version, skip, lookup, result, newmatches):
+    #
+    # Write the KB lookup result (from resolve_manifest_entry()) for a manifest entry to outkb and report it
+    # New matches are appended to newmatches for record_kb_match() once all lookups are complete
+    # Returns the SUMMARY counter (outcome) for the entry
+    record = kblookup_record(outkb, package, version, skip, lookup, result, newmatches)
+    report_result(record, kblookup_result_text(record))
+    if explainrules and record['rule']:
+        listoutput("    Rule: {}".format(reprules.explain(package)), True)
+    return record['outcome']
+
+def kblookup_record(outkb, package, version, skip, lookup, result, newmatches):
+    #
+    # Write the KB lookup result for a manifest entry to outkb - returns the result record
+    record = result_record(package, version)
+    if skip:
+        record['outcome'] = 'skipped'
+    elif package in kblookupdict and not lookup:
+        #
+        # Found primary package name in kbfile
+        record['kb_component_url'] = kblookupdict[package][0]
+        if kblookupdict[package][0] == "NO MATCH":
+            record['outcome'] = 'nokblookupmatch'
+        else:
+            #
+            # Found in KB ver URL list - Nothing to do
+            record['outcome'] = 'alreadymatched'
+            record['kb_version_url'] = kbverdict[package + "/" + version]
+    else:
+        kbverurl, newkbline, listmsg, compname, match = result
+        record.update(match)
+        if lookup_failed(result):
+            #
+            # KB requests failed - nothing is written to outkb so the entry is looked up again in the next run
+            record.update(outcome='lookupfailed', detail=record.pop('error'))
+        elif kbverurl != "NO VERSION MATCH" and package in kblookupdict:
+            #
+            # KB version URL found for component URL in kbfile
+            record.update(outcome='newvermatch', kb_component_url=kblookupdict[package][0], kb_version_url=kbverurl)
+            newmatches.append((package, version, None, kbverurl))
+            outkb.update_entry(package, version, kblookupdict[package][0], kbverurl)
+        elif newkbline.split(";")[3] != "NO MATCH" and outkb.has_entry(package, newkbline.split(";")[3]):
+            #
+            # Component matched earlier in this run for another version - add the version to the same kbfile line
+            elements = newkbline.split(";")
+            record.update(outcome='newvermatch', source_url=elements[2], kb_component_url=elements[3], kb_version_url=elements[5])
+            newmatches.append((compname, version, None, elements[5]))
+            outkb.update_entry(package, version, elements[3], elements[5])
+        elif newkbline.split(";")[3] != "NO MATCH":
+            elements = newkbline.split(";")
+            record.update(outcome='newmatch', source_url=elements[2], kb_component_url=elements[3], kb_version_url=elements[5])
+            newmatches.append((compname, version, elements[3], elements[5]))
+            outkb.add_entry(newkbline)
+        elif package in kblookupdict:
+            #
+            # No version match - need to add NO VERSION MATCH string to kbfile
+            record.update(outcome='novermatch', kb_component_url=kblookupdict[package][0])
+            outkb.update_entry(package, version, kblookupdict[package][0], "NO VERSION MATCH")
+        elif [compurl for compurl in outkb.compurls(package) if compurl != "NO MATCH"]:
+            #
+            # Component matched earlier in this run for another version - add NO VERSION MATCH to the same kbfile line
+            compurl = [compurl for compurl in outkb.compurls(package) if compurl != "NO MATCH"][0]
+            record.update(outcome='novermatch', kb_component_url=compurl)
+            outkb.update_entry(package, version, compurl, "NO VERSION MATCH")
         else:
-            if compurl != thiscompurl:
-                ofile.write(line)
-            else:
-                ofile.write("{}{};{};\n".format(line.rstrip(), version, kbverurl))
-                logging.debug("update_kbfile(): updated kbfile line with '{};{};'".format(version, kbverurl))
+            record['outcome'] = 'nokbmatch'
+            outkb.add_entry(newkbline)
 
-    ofile.close()
-    return
+    record['rule'] = reprules.skip(package) or reprules.replace(package)[1] or ""
+    return record
 
-def import_kbfile(kbfile, outfile):
+def resolve_import_urls(args, entries):
     #
-    # If outfile is not "" then copy kbfile to outfile
+    # Returns the KB version URL (from resolve_import_entry()) for each (component, version, manifest file) entry
+    if args.use_async:
+        return run_async(args.max_inflight, async_resolve_import_entries, entries)
+    with ThreadPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+        return list(executor.map(lambda entry: resolve_import_entry(entry[0], entry[1]), entries))
+
+def import_manifest_delta(args, previous, current, entries, kbverurls):
     #
-    # FIELDS:
-    # 1 = Local component name;
-    # 2 = KB component name;
-    # 3 = KB component source URL;
-    # 4 = KB component URL;
+    # Reduce an import to the manifest entries added or changed since the previous manifest (--previous)
+    # Returns the changed entries and their KB version URLs, and the set of KB version URLs no longer used by
+    # any manifest entry (deleted from the BOM with -d)
+    valid = lambda kbverurl: kbverurl not in (None, "", "NO VERSION MATCH", KB_LOOKUP_FAILED)
+    prevurls = {}
+    unresolved = []
+    for key, kbverurl in previous.entries.items():
+        if kbverurl is None and key in current.entries:
+            kbverurl = current.entries[key]
+        elif kbverurl is None:
+            unresolved.append(key + ("",))
+        prevurls[key] = kbverurl
     #
-    # OPTIONAL:
-    # 5 = Local component version string
-    # 6 = KB Component version URL
-    # (Repeated as often as matched)
+    # Entries from a previous build manifest (rather than state file) are resolved from the current KB Lookup File
+    for (package, version, compfile), kbverurl in zip(unresolved, resolve_import_urls(args, unresolved)):
+        prevurls[(package, version)] = kbverurl
 
-#    kblookupdict = {}
-#    kbverdict = {}
-    output = False
-    try:
-        kfile = open(kbfile, "r")
-    except:
-        logging.error("import_kbfile(): Failed to open file {} ".format(kbfile))
-#        return kblookupdict, kbverdict
-        return
-
-    print("Reading Input KB Lookup file {} ...".format(kbfile))
-    if outfile != "" and outfile != kbfile:
-        output = True
-        try:
-            ofile = open(outfile, "a+")
-        except:
-            logging.error("import_kbfile(): Failed to open file {} ".format(outfile))
-#            return "",""
-            return
+    changed = [index for index, (package, version, compfile) in enumerate(entries)
+               if (package, version) not in prevurls or prevurls[(package, version)] != kbverurls[index]]
+    print_manifest_changes(args.previous, previous, current, len(entries) - len(changed), len(changed))
+    # (the previous KB version URLs of entries whose KB lookup failed are kept)
+    removedurls = set(kbverurl for kbverurl in prevurls.values() if valid(kbverurl)) - \
+                  set(kbverurl for kbverurl in current.entries.values() if valid(kbverurl)) - \
+                  set(prevurls.get(key) for key, kbverurl in current.entries.items() if kbverurl == KB_LOOKUP_FAILED)
+    return [entries[index] for index in changed], [kbverurls[index] for index in changed], removedurls
 
-    lines = kfile.readlines()
+def print_manifest_changes(prevfile, previous, current, unchanged, changed):
+    #
+    # Report the differences from the previous manifest (--previous)
+    removed = sum(1 for entry in previous.entries if entry not in current.entries)
+    print("Changes since previous manifest {}: {} entries added or changed, {} removed, {} unchanged".format(
+        prevfile, changed, removed, unchanged))
+    logging.info("Changes since previous manifest {}: {} added or changed, {} removed, {} unchanged".format(
+        prevfile, changed, removed, unchanged))
 
-    count = 0
-    for line in lines:
-        elements = line.split(";")
-        compname = elements[0]
-        kbcompurl = elements[3]
-        #if kbcompurl != "NO MATCH":
-        #kblookupdict[compname] = kbcompurl
-        kblookupdict.setdefault(compname, []).append(kbcompurl)
-        index = 4
-        while index < len(elements) - 1:
-            kbverdict[compname + "/" + elements[index]] = elements[index+1]
-            index += 2
-        #elif kbcompurl == "NO MATCH":
-        #    kblookupdict.setdefault(compname, []).append("NO MATCH")
-        count += 1
-        if output:
-            ofile.write(line)
+class KBLookup:
+    #
+    # Library API for KB lookups of build manifest entries (used by serve mode)
+    # The KB Lookup File entries, KB search results, component version indexes and replacement rules are held in
+    # the module lookup dicts between calls - so only one KBLookup can be created in a process (RuntimeError)
+    # The KB response cache, shared match store, pkgdata and Hub request limits are set up for the process as
+    # for the command line options of the same names
+    # New matches are written to the output KB Lookup File (kept in memory only if output is not specified)
+    created = False
 
-    kfile.close
-    if output:
-        ofile.close()
+    def __init__(self, replace_file=None, kbfile=None, output=None, workers=4, checkpoint=100, pkgdata=None,
+                 cache_dir=CACHE_DIR, cache_size=500, no_cache=False, max_rate=0.0, kb_retries=4):
+        global reprules
+        if KBLookup.created:
+            raise RuntimeError("Only one KBLookup can be created in a process")
+        rules = None
+        if replace_file:
+            rules = process_replacement_file(replace_file)
+            if rules is None:
+                raise ValueError("Cannot read replacement file {}".format(replace_file))
+        if pkgdata and not os.path.isdir(PkgData(pkgdata).dirname):
+            raise ValueError("Cannot find pkgdata runtime-reverse directory {}".format(PkgData(pkgdata).dirname))
+        KBLookup.created = True
+        if rules is not None:
+            reprules = rules
+        options = argparse.Namespace(replace_file=replace_file or "", kbfile=kbfile, pkgdata=pkgdata, cache_dir=cache_dir,
+                                     cache_size=cache_size, no_cache=no_cache, max_rate=max_rate, kb_retries=kb_retries)
+        open_kbcache(options)
+        # (concurrent lookup calls share the Hub - no concurrency limit until the Hub throttles them)
+        open_throttle(options, 0)
+        open_matchstore(options)
+        open_pkgdata(options)
+        self.workers = max(workers, 1)
+        self.lock = threading.Lock()
+        self.outkb = open_kbfile(output, checkpoint) if output else KBFile("", 0)
+        self.outkb.load()
+        if kbfile:
+            import_kbfile(kbfile, self.outkb if output else None)
 
-    print("Processed {} entries from {}".format(count, kbfile))
-#    return kblookupdict, kbverdict
-    return
+    def lookup(self, entries):
+        #
+        # Resolve (component, version, skip) entries - returns a result record for each entry in order
+        # KB searches run concurrently, then results are applied to the lookup dicts and output KB Lookup File
+        # under the lock (entries resolved by another call in the meantime are reported as already matched)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(resolve_manifest_entry, package, version) if needs_kb_lookup(package, version, skip) else None
+                       for package, version, skip in entries]
+            results = [future.result() if future else None for future in futures]
 
-def find_compver_from_compurl(package, kburl, search_version):
-    compname, matchversion, matchstrength, bdcomp_sourceurl, bd_verurl = find_ver_from_compver(kburl, search_version)
-    if matchstrength > 0:
-        logging.info("Found version match {}".format(matchversion))
-        return bd_verurl, bdcomp_sourceurl
-    else:
-        logging.info("No version match found")
-        return "NO VERSION MATCH", ""
+        records = []
+        with self.lock:
+            newmatches = []
+            nomatches = []
+            for (package, version, skip), result in zip(entries, results):
+                lookup = result is not None and needs_kb_lookup(package, version, skip)
+                record = kblookup_record(self.outkb, package, version, skip, lookup, result, newmatches)
+                records.append(record)
+                #
+                # Results are recorded as they would be read back from the output KB Lookup File (keyed by
+                # the manifest component name)
+                if record['outcome'] == 'nokbmatch':
+                    nomatches.append(package)
+                elif record['outcome'] == 'novermatch':
+                    kbverdict[package + "/" + version] = "NO VERSION MATCH"
+                elif record['outcome'] == 'newmatch' and result[3] != package:
+                    newmatches.append((package, version, record['kb_component_url'], record['kb_version_url']))
+                elif record['outcome'] == 'newvermatch' and result[3] != package:
+                    newmatches.append((package, version, None, record['kb_version_url']))
+            for compname, version, compurl, verurl in newmatches:
+                record_kb_match(compname, version, compurl, verurl)
+            #
+            # Packages with no KB match are only marked NO MATCH if no other version matched a component
+            for package in nomatches:
+                if package not in kblookupdict:
+                    kblookupdict.setdefault(package, ["NO MATCH"])
+        return records
 
-def add_comp_to_bom(bdverurl, kbverurl, compfile, compver):
+    def kbfile_lines(self, packages):
+        #
+        # Returns the output KB Lookup File lines for the local component names in packages
+        with self.lock:
+            return [line for line in self.outkb.entries() if line.split(";")[0] in packages]
 
-    posturl = bdverurl + "/components"
-    custom_headers = {
-            'Content-Type':'application/vnd.blackducksoftware.bill-of-materials-6+json'
-    }
+    def save(self):
+        with self.lock:
+            return self.outkb.save()
 
-    postdata =  {
-            "component" : kbverurl,
-            "componentPurpose" : "import_manifest: imported from file " + compfile,
-            "componentModified" : False,
-            "componentModification" : "Original component = " + compver
-    }
+    def close(self):
+        self.save()
+        close_caches()
 
-    #print("POST command - posturl = {} postdata = {}".format(posturl, postdata, custom_headers))
-    response = hub.execute_post(posturl, postdata, custom_headers)
-    if response.status_code == 200:
-        print(" - Component added")
-        logging.debug("Component added {}".format(kbverurl))
-        return True
-    else:
-        print(" - Component NOT added (Already exists)")
-        logging.error("Component NOT added {}".format(kbverurl))
-        return False
+class BOMImport:
+    #
+    # Library API for importing build manifest entries into a Black Duck project version BOM
+    # using the KB version URLs from the KB Lookup File (or the lookup dicts already loaded)
+    def __init__(self, project, version, kbfile=None, workers=4, retries=3, backoff=1.0, use_async=False, max_inflight=100):
+        self.project = project
+        self.version = version
+        self.options = argparse.Namespace(workers=workers, retries=retries, backoff=backoff,
+                                          use_async=use_async, max_inflight=max_inflight)
+        self.bdversion = None
+        self.bomsnapshot = None
+        self.operations = []    # BOM add and delete operations run (for --bom-report)
+        if kbfile:
+            import_kbfile(kbfile, None)
 
-def del_comp_from_bom(compurl):
+    def resolve(self, entries):
+        #
+        # Returns the KB version URL for each (component, version, manifest file) entry
+        return resolve_import_urls(self.options, entries)
 
-    response = hub.execute_delete(compurl)
-    if response.status_code == 200:
-        logging.debug("Component deleted {}".format(compurl))
+    def open(self):
+        #
+        # Open (or create) the project version and read its BOM - returns False if the version cannot be created
+        # Raises RuntimeError if the BOM cannot be read
+        bdproject, self.bdversion = manage_project_version(self.project, self.version)
+        if not self.bdversion:
+            print("Cannot create version {}".format(self.version))
+            return False
+        logging.debug("Looking through the components for project {}, version {}.".format(self.project, self.version))
+        self.bomsnapshot = BOMSnapshot().load(self.bdversion)
         return True
-    else:
-        logging.error("Component NOT deleted {}".format(compurl))
-        return False
-
-def manage_project_version(proj, ver):
-    bdproject = hub.get_project_by_name(proj)
-    if not bdproject:
-        resp = hub.create_project(proj, ver)
-        if resp.status_code != 201:
-            logging.debug("Cannot create project {}".format(proj))
-            return None, None
-
-        print("Created project '{}'".format(proj))
-        bdproject = hub.get_project_by_name(proj)
-    else:
-        print("Opening project '{}'".format(proj))
 
-    bdversion = hub.get_version_by_name(bdproject, ver)
-    if not bdversion:
-        resp = hub.create_project_version(bdproject, ver)
-        if resp.status_code != 201:
-            logging.debug("Cannot create version {}".format(ver))
-            return None, None
-        print("Created version '{}'".format(ver))
-        bdversion = hub.get_version_by_name(bdproject, ver)
-    else:
-        print("Opening version '{}'".format(ver))
-    return bdproject, bdversion
+    def add(self, entries, kbverurls):
+        #
+        # Add the KB version URLs for (component, version, manifest file) entries to the BOM
+        # Only components which are not already in the BOM (or added for an earlier entry) are added
+        # Returns a result record for each entry
+        addops = {}
+        adding = set()
+        bdversion_url = self.bdversion['_meta']['href']
+        for index, ((package, version, compfile), kbverurl) in enumerate(zip(entries, kbverurls)):
+            if kbverurl not in ("", "NO VERSION MATCH", KB_LOOKUP_FAILED) and kbverurl not in self.bomsnapshot and kbverurl not in adding:
+                addops[index] = BOMOperation('add', bdversion_url, package + "/" + version, kbverurl, compfile)
+                adding.add(kbverurl)
+        print("Adding {} components to project ...".format(len(addops)))
+        run_bom_operations(self.options, list(addops.values()))
+        self.operations += addops.values()
 
+        records = []
+        for index, ((package, version, compfile), kbverurl) in enumerate(zip(entries, kbverurls)):
+            record = result_record(package, version)
+            if kbverurl == "":
+                record['outcome'] = 'notinkbfile'
+            elif kbverurl == "NO VERSION MATCH":
+                record['outcome'] = 'nokbmatch'
+            elif kbverurl == KB_LOOKUP_FAILED:
+                record.update(outcome='failed', detail="KB lookup failed")
+            else:
+                record['kb_version_url'] = kbverurl
+                if index in addops:
+                    operation = addops[index]
+                    record.update(outcome=bom_add_outcome(operation), elapsed=round(operation.elapsed, 6))
+                    if record['outcome'] == 'failed':
+                        record['detail'] = operation.status_code or operation.error
+                elif kbverurl in self.bomsnapshot:
+                    record.update(outcome='exists', detail=self.bomsnapshot.describe(kbverurl))
+                else:
+                    record['outcome'] = 'exists'
+            records.append(record)
+        return records
 
-def read_compfile(compfile):
-    try:
-        cfile = open(compfile)
-    except:
-        logging.error("Failed to open file {} ".format(compfile))
-        return None
+    def delete(self, manual):
+        #
+        # Delete BOM components - manual is a dict of KB version URL with BOM component URL
+        # Returns the delete operations
+        deleteops = [BOMOperation('delete', compurl, self.bomsnapshot.describe(kbverurl), kbverurl) for kbverurl, compurl in manual.items()]
+        run_bom_operations(self.options, deleteops)
+        self.operations += deleteops
+        return deleteops
 
-    if cfile.mode != 'r':
-        logging.error("Failed to open file {} ".format(compfile))
-        return None
+def print_kblookup_summary(all_comps, counts, title="SUMMARY:"):
+    lines = [
+        title,
+        " {} Entries processed from component file".format(all_comps),
+        " {} Components Skipped".format(counts.get('skipped', 0)),
+        " {} Components Not in KB".format(counts.get('nokbmatch', 0)),
+        " {} Components Already Matched in KBLookup file (duplicate)".format(counts.get('alreadymatched', 0)),
+        " {} Components Not Matched from KBLookup file".format(counts.get('nokblookupmatch', 0)),
+        " {} Components with New Version Match".format(counts.get('newvermatch', 0)),
+        " {} Components with No Version Match".format(counts.get('novermatch', 0)),
+        " {} Components with New Match".format(counts.get('newmatch', 0)),
+    ]
+    if counts.get('lookupfailed'):
+        lines.append(" {} Components with Failed KB Lookups (not recorded - rerun to look up again)".format(counts['lookupfailed']))
+    for line in lines:
+        print(line)
+    for line in lines:
+        logging.info(line)
 
-    lines = cfile.readlines()
+def find_batch_manifests(paths):
+    #
+    # Expand manifest directories (all *.manifest files) and glob patterns into a sorted list of files
+    compfiles = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = glob.glob(os.path.join(path, "*.manifest"))
+        else:
+            found = glob.glob(path)
+        if not found:
+            print("WARNING: No build manifests found matching {}".format(path))
+            logging.warning("No build manifests found matching {}".format(path))
+        for compfile in sorted(found):
+            if os.path.isfile(compfile) and compfile not in compfiles:
+                compfiles.append(compfile)
+    return compfiles
 
-    return lines
+def batch_worker_init():
+    #
+    # Runs in each batch worker process - SQLite connections must not be used across fork() so the
+    # input kbfile database is reopened, and metrics/profiles/cache counts inherited from the main process are cleared
+    global metrics, profiler
+    metrics = Metrics()
+    if profiler:
+        profiler = Profiler(profiler.filename)
+    if matchstore:
+        matchstore.lock = threading.Lock()
+    if kbcache:
+        kbcache.hits = kbcache.misses = 0
+    hubthrottle.cond = threading.Condition()
+    if isinstance(kblookupdict, SQLiteCompView):
+        kbdb = SQLiteKBFile(kblookupdict.kbdb.filename, 0)
+        kblookupdict.kbdb = kbdb
+        kbverdict.kbdb = kbdb
 
+def resolve_batch_chunk(chunk, workers):
+    #
+    # Resolve a list of (package, version) entries in a batch worker process using a thread pool
+    # Results are returned in chunk order
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        return list(executor.map(lambda entry: resolve_manifest_entry(entry[0], entry[1]), chunk))
 
-def process_compfile_line(line, skiplist):
-# Example line from build manifest:
-#     alsa-utils-alsamixer aarch64 1.1.5
-#
-    splitline = line.rstrip().split(" ")
-    if len(splitline) != 3:
-        logging.error("Invalid build manifest line format - expecting '<comp> <arch> <version'")
-        return("", "", True)
+def resolve_batch_chunk_process(chunk, workers):
+    #
+    # Resolve a chunk in a batch worker process - returns the results with the metrics and profile
+    # (written to a temporary file) recorded for the chunk
+    global metrics, profiler
+    results = resolve_batch_chunk(chunk, workers)
+    snapshot = metrics.snapshot()
+    metrics = Metrics()
+    if kbcache:
+        snapshot['cache'] = {'hits': kbcache.hits, 'misses': kbcache.misses}
+        kbcache.hits = kbcache.misses = 0
+    profilefile = None
+    if profiler:
+        stats = profiler.stats()
+        if stats:
+            fd, profilefile = tempfile.mkstemp(prefix="batchprofile", suffix=".prof")
+            os.close(fd)
+            stats.dump_stats(profilefile)
+        profiler = Profiler(profiler.filename)
+    return results, snapshot, profilefile
 
-    vername = splitline[2]
-    plus = vername.count("+")
-    if (plus > 0):
-        pos = vername.index("+")
-        if (len(vername) > pos + 1) and vername[pos+1:].isdigit():
-            vername = vername[0:pos]
-    for skipstring in skiplist:
-        if splitline[0].find(skipstring) == 0:
-            return(splitline[0], vername, True)
+def split_batch_entries(entries, processes):
+    #
+    # Split (package, version) entries into one chunk per process, keeping all versions of a package
+    # (and all packages of a recipe with --pkgdata) in the same chunk so its KB searches and version lists
+    # are only fetched by one process
+    packages = {}
+    for package, version in entries:
+        packages.setdefault(search_target(package, version)[0], []).append((package, version))
+    chunks = [[] for i in range(processes)]
+    for index, package in enumerate(packages):
+        chunks[index % processes].extend(packages[package])
+    return [chunk for chunk in chunks if chunk]
 
-    return(splitline[0], vername, False)
+class LookupRequestHandler(BaseHTTPRequestHandler):
     #
-    # 3rd return parameter is whether this line should be SKIPPED
+    # serve mode API (JSON over HTTP):
+    #   POST /lookup    - body is build manifest text, returns {"results": [result records], "summary": {outcome: count}}
+    #   POST /kblookup  - body is build manifest text, returns the KB Lookup File lines for the manifest components
+    #                     (text - can be used as the -k file for import mode)
+    #   GET /health     - returns {"status": "ok", ...}
+    #   GET /metrics    - returns the run metrics in Prometheus text format
+    protocol_version = "HTTP/1.1"
 
+    def log_message(self, format, *params):
+        logging.debug("serve: {} - {}".format(self.address_string(), format % params))
 
-def process_replacement_file(repfile):
-    repdict = {}
-    skiplist = []
-    try:
-        rfile = open(repfile)
-    except:
-        logging.error("Failed to open file {} ".format(repfile))
-        return None
+    def send_body(self, status, body, content_type):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-    if rfile.mode != 'r':
-        logging.error("Failed to open file {} ".format(repfile))
-        return None
+    def send_json(self, status, data):
+        self.send_body(status, json.dumps(data) + "\n", "application/json")
 
-    rlines = rfile.readlines()
+    def read_manifest(self):
+        #
+        # Returns the (component, version, skip) entries from the build manifest in the request body
+        # or None if the manifest is invalid
+        length = int(self.headers.get('Content-Length') or 0)
+        text = self.rfile.read(length).decode("utf-8", errors="replace")
+        reader = ManifestReader([], reprules)
+        entries = [(package, version, skip) for package, version, skip, compfile in reader.read_lines(text.splitlines(), "request")]
+        if reader.invalid > 0:
+            return None
+        return entries
 
-    for line in rlines:
-        if line.count(";") == 0:
-            continue
-        splitline = line.rstrip().split(";")
-        if splitline[1] == "SKIP":
-            skiplist.append(splitline[0])
-            print("Will Skip components starting with {}".format(splitline[0]))
-            logging.info("Will Skip components starting with {}".format(splitline[0]))
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {'status': 'ok', 'uptime_seconds': round(time.time() - self.server.started, 3),
+                                 'requests': self.server.served, 'components': len(kblookupdict)})
+        elif self.path == "/metrics":
+            self.send_body(200, metrics.prometheus(metrics.report('serve')), "text/plain; version=0.0.4")
         else:
-            repdict[splitline[0]] = splitline[1]
-            logging.info("Adding replacement {} for component {}".format(splitline[1], splitline[0]))
+            self.send_json(404, {'error': "Unknown path {}".format(self.path)})
 
-    return repdict, skiplist
-
-def listoutput(outline, newline):
-    if listfile:
+    def do_POST(self):
+        if self.path not in ("/lookup", "/kblookup"):
+            self.send_json(404, {'error': "Unknown path {}".format(self.path)})
+            return
+        entries = self.read_manifest()
+        if entries is None:
+            self.send_json(400, {'error': "Invalid build manifest format - expecting '<comp> <arch> <version>' lines"})
+            return
         try:
-            ofile = open(listfile, "a+")
-        except:
-            logging.error("Failed to open output listfile {} for append".format(listfile))
+            records = self.server.matcher.lookup(entries)
+        except Exception as e:
+            logging.exception("serve: lookup failed")
+            self.send_json(500, {'error': str(e)})
             return
-        if newline:
-            ofile.write(outline + "\n")
-        else:
-            ofile.write(outline)
-        ofile.close()
+        self.server.request_done()
+        if self.path == "/kblookup":
+            lines = self.server.matcher.kbfile_lines(set(record['package'] for record in records))
+            self.send_body(200, "".join(line + "\n" for line in lines), "text/plain")
+            return
+        summary = {}
+        for record in records:
+            summary[record['outcome']] = summary.get(record['outcome'], 0) + 1
+        self.send_json(200, {'results': records, 'summary': summary})
 
-    if newline:
-        print(outline)
-    else:
-        print(outline, end = "", flush = True)
+class LookupServer(ThreadingHTTPServer):
+    #
+    # serve mode HTTP server - requests are handled in threads sharing one KBLookup
+    daemon_threads = True
+
+    def __init__(self, address, matcher):
+        super().__init__(address, LookupRequestHandler)
+        self.matcher = matcher
+        self.started = time.time()
+        self.served = 0
+        self.served_lock = threading.Lock()
+
+    def request_done(self):
+        with self.served_lock:
+            self.served += 1
+
+    def stop(self):
+        #
+        # Stop serve_forever() from a signal handler (shutdown() waits for it so must run in another thread)
+        threading.Thread(target=self.shutdown, daemon=True).start()
+
+def write_run_reports(args):
+    #
+    # Write the --metrics and --profile files at exit
+    if getattr(args, 'metrics', None):
+        metrics.write(args.metrics, args.command)
+    if profiler:
+        profiler.write(batchprofiles)
 
 #
 # Main Program
@@ -573,262 +3676,561 @@ parser = argparse.ArgumentParser(description='Process or import yocto build mani
 subparsers = parser.add_subparsers(help='Choose operation mode', dest='command')
 # create the parser for the "kblookup" command
 parser_g = subparsers.add_parser('kblookup', help='Process build manifest to find matching KB URLs & export to file')
-parser_g.add_argument('-c', '--component_file', help='Input build manifest file', required=True)
+parser_g.add_argument('-c', '--component_file', help='Input build manifest file(s) ("-" for stdin)', nargs='+', required=True)
+parser_g.add_argument('--input-format', help='Format of the input files - Yocto build manifest, license.manifest or SPDX JSON document (default auto - detected for each file)', choices=['auto'] + list(INPUT_FORMATS), default='auto')
 parser_g.add_argument('-r', '--replace_file', help='File of input component name replacement strings and SKIP component strings', required=True)
+parser_g.add_argument('--pkgdata', help='Yocto pkgdata directory for the build (tmp/pkgdata/<machine>) - manifest packages are searched in the KB by source recipe and version, once per recipe')
 parser_g.add_argument('-k', '--kbfile', help='Input file of KB component IDs matching manifest components')
 parser_g.add_argument('-o', '--output', help='Output file of KB component IDs matching manifest components (default "kblookup.out")', default='kblookup.out')
 parser_g.add_argument('-a', '--append', help='Append new KB URLs to the KB Lookup file specified in -k', action='store_true')
 parser_g.add_argument('-l', '--listfile', help='Create an output file of component matches')
+parser_g.add_argument('--explain', help='Report the replacement file rule (SKIP or name replacement) applied to each manifest entry', action='store_true')
+parser_g.add_argument('--checkpoint', help='Write the output KB Lookup file after this many new entries (default 100, 0 = only at end)', type=int, default=100)
+parser_g.add_argument('--previous', help='Previous build manifest file or manifest state file (see --save-state) - only entries added or changed since are processed')
+parser_g.add_argument('--save-state', help='Write the manifest state to this file at the end of the run for use with --previous')
+parser_g.add_argument('--budget', help='Stop after this many KB lookups - rerun the same command to continue (default 0 = no limit)', type=int, default=0)
+parser_g.add_argument('-w', '--workers', help='Number of concurrent KB lookups (default 4)', type=int, default=4)
+parser_g.add_argument('--async', help='Use asyncio with a pooled HTTP session for KB and BOM requests (requires aiohttp)', action='store_true', dest='use_async')
+parser_g.add_argument('--max-inflight', help='Maximum number of requests in flight in --async mode (default 100)', type=int, default=100)
+parser_g.add_argument('--max-rate', help='Maximum Hub requests per second (default 0 = no limit)', type=float, default=0.0)
+parser_g.add_argument('--kb-retries', help='Number of retries for KB requests failing with throttling, server or connection errors (default 4)', type=int, default=4)
+parser_g.add_argument('--cache-dir', help='Directory for the persistent KB response cache (default "~/.cache/import_yocto_build_manifest")', default=CACHE_DIR)
+parser_g.add_argument('--cache-size', help='Maximum size of the KB response cache in MB (default 500)', type=int, default=500)
+parser_g.add_argument('--no-cache', help='Do not use the persistent KB response cache', action='store_true')
+parser_g.add_argument('--results', help='Write a result record for each manifest entry to this file - CSV for *.csv, otherwise JSON lines')
+parser_g.add_argument('--metrics', help='Write run metrics (timings, HTTP requests, cache hit ratio) to this file - Prometheus text format for *.prom or *.txt, otherwise JSON')
+parser_g.add_argument('--profile', help='Write a cProfile of the hot path functions to this file')
 
 # create the parser for the "import" command
 parser_i = subparsers.add_parser('import', help='Import build manifest into specified Black Duck project/version using KB URLs from supplied file')
-parser_i.add_argument('-c', '--component_file', help='Input build manifest file', required=True)
+parser_i.add_argument('-c', '--component_file', help='Input build manifest file(s) ("-" for stdin)', nargs='+', required=True)
+parser_i.add_argument('--input-format', help='Format of the input files - Yocto build manifest, license.manifest or SPDX JSON document (default auto - detected for each file)', choices=['auto'] + list(INPUT_FORMATS), default='auto')
 parser_i.add_argument('-k', '--kbfile', help='Input file of KB component IDs and URLs matching manifest components', required=True)
 parser_i.add_argument('-p', '--project', help='Black Duck project name',required=True)
 parser_i.add_argument('-v', '--version', help='Black Duck version name',required=True)
 parser_i.add_argument('-d', '--delete', help='Delete existing manual components from the project - if not specified then components will be added to the existing list', action='store_true')
+parser_i.add_argument('--previous', help='Previous build manifest file or manifest state file (see --save-state) - only entries added or changed since are imported (and entries removed since are deleted with -d)')
+parser_i.add_argument('--save-state', help='Write the manifest state to this file at the end of the run for use with --previous')
+parser_i.add_argument('-w', '--workers', help='Number of concurrent KB lookups and BOM updates (default 4)', type=int, default=4)
+parser_i.add_argument('--retries', help='Number of retries for BOM updates failing with throttling or server errors (default 3)', type=int, default=3)
+parser_i.add_argument('--backoff', help='Initial delay in seconds before retrying a failed BOM update, doubled for each retry (default 1.0)', type=float, default=1.0)
+parser_i.add_argument('--bom-report', help='Write a JSON lines report of all BOM add/delete operations to this file')
+parser_i.add_argument('--async', help='Use asyncio with a pooled HTTP session for KB and BOM requests (requires aiohttp)', action='store_true', dest='use_async')
+parser_i.add_argument('--max-inflight', help='Maximum number of requests in flight in --async mode (default 100)', type=int, default=100)
+parser_i.add_argument('--max-rate', help='Maximum Hub requests per second (default 0 = no limit)', type=float, default=0.0)
+parser_i.add_argument('--kb-retries', help='Number of retries for KB requests failing with throttling, server or connection errors (default 4)', type=int, default=4)
+parser_i.add_argument('--cache-dir', help='Directory for the persistent KB response cache (default "~/.cache/import_yocto_build_manifest")', default=CACHE_DIR)
+parser_i.add_argument('--cache-size', help='Maximum size of the KB response cache in MB (default 500)', type=int, default=500)
+parser_i.add_argument('--no-cache', help='Do not use the persistent KB response cache', action='store_true')
+parser_i.add_argument('--results', help='Write a result record for each manifest entry to this file - CSV for *.csv, otherwise JSON lines')
+parser_i.add_argument('--metrics', help='Write run metrics (timings, HTTP requests, cache hit ratio) to this file - Prometheus text format for *.prom or *.txt, otherwise JSON')
+parser_i.add_argument('--profile', help='Write a cProfile of the hot path functions to this file')
+
+# create the parser for the "batch" command
+parser_b = subparsers.add_parser('batch', help='Process the build manifests for multiple images to find matching KB URLs & export to a single file')
+parser_b.add_argument('-m', '--manifests', help='Directories (all *.manifest files) or glob patterns of input build manifests', nargs='+', required=True)
+parser_b.add_argument('--input-format', help='Format of the input files - Yocto build manifest, license.manifest or SPDX JSON document (default auto - detected for each file)', choices=['auto'] + list(INPUT_FORMATS), default='auto')
+parser_b.add_argument('-r', '--replace_file', help='File of input component name replacement strings and SKIP component strings', required=True)
+parser_b.add_argument('--pkgdata', help='Yocto pkgdata directory for the build (tmp/pkgdata/<machine>) - manifest packages are searched in the KB by source recipe and version, once per recipe')
+parser_b.add_argument('-k', '--kbfile', help='Input file of KB component IDs matching manifest components')
+parser_b.add_argument('-o', '--output', help='Output file of KB component IDs matching manifest components (default "kblookup.out")', default='kblookup.out')
+parser_b.add_argument('-a', '--append', help='Append new KB URLs to the KB Lookup file specified in -k', action='store_true')
+parser_b.add_argument('-l', '--listfile', help='Create an output file of component matches')
+parser_b.add_argument('--explain', help='Report the replacement file rule (SKIP or name replacement) applied to each manifest entry', action='store_true')
+parser_b.add_argument('--checkpoint', help='Write the output KB Lookup file after this many new entries (default 100, 0 = only at end)', type=int, default=100)
+parser_b.add_argument('-j', '--processes', help='Number of worker processes (default 4)', type=int, default=4)
+parser_b.add_argument('-w', '--workers', help='Number of concurrent KB lookups in each worker process (default 4)', type=int, default=4)
+parser_b.add_argument('--max-rate', help='Maximum Hub requests per second (default 0 = no limit) - shared between the worker processes', type=float, default=0.0)
+parser_b.add_argument('--kb-retries', help='Number of retries for KB requests failing with throttling, server or connection errors (default 4)', type=int, default=4)
+parser_b.add_argument('--cache-dir', help='Directory for the persistent KB response cache (default "~/.cache/import_yocto_build_manifest")', default=CACHE_DIR)
+parser_b.add_argument('--cache-size', help='Maximum size of the KB response cache in MB (default 500)', type=int, default=500)
+parser_b.add_argument('--no-cache', help='Do not use the persistent KB response cache', action='store_true')
+parser_b.add_argument('--results', help='Write a result record for each manifest entry to this file - CSV for *.csv, otherwise JSON lines')
+parser_b.add_argument('--metrics', help='Write run metrics (timings, HTTP requests, cache hit ratio) to this file - Prometheus text format for *.prom or *.txt, otherwise JSON')
+parser_b.add_argument('--profile', help='Write a cProfile of the hot path functions to this file')
 
+# create the parser for the "kbconvert" command
+parser_c = subparsers.add_parser('kbconvert', help='Convert a KB Lookup file between text and SQLite (*.db, *.sqlite) formats')
+parser_c.add_argument('-i', '--input', help='Input KB Lookup file', required=True)
+parser_c.add_argument('-o', '--output', help='Output KB Lookup file (format chosen by file extension)', required=True)
 
-#parser.add_argument("version")
-args = parser.parse_args()
+parser_s = subparsers.add_parser('serve', help='Run a local HTTP/JSON server answering KB lookups for build manifests with the KB caches kept warm')
+parser_s.add_argument('-r', '--replace_file', help='File of input component name replacement strings and SKIP component strings', required=True)
+parser_s.add_argument('--pkgdata', help='Yocto pkgdata directory for the build (tmp/pkgdata/<machine>) - manifest packages are searched in the KB by source recipe and version, once per recipe')
+parser_s.add_argument('-k', '--kbfile', help='Input file of KB component IDs matching manifest components')
+parser_s.add_argument('-o', '--output', help='Output file of KB component IDs matching manifest components - new matches are written to it (default "kblookup.out")', default='kblookup.out')
+parser_s.add_argument('--host', help='Address to listen on (default "127.0.0.1")', default='127.0.0.1')
+parser_s.add_argument('--port', help='Port to listen on (default 8383)', type=int, default=8383)
+parser_s.add_argument('--checkpoint', help='Write the output KB Lookup file after this many new entries (default 100, 0 = only at exit)', type=int, default=100)
+parser_s.add_argument('-w', '--workers', help='Number of concurrent KB lookups for each request (default 4)', type=int, default=4)
+parser_s.add_argument('--max-rate', help='Maximum Hub requests per second (default 0 = no limit)', type=float, default=0.0)
+parser_s.add_argument('--kb-retries', help='Number of retries for KB requests failing with throttling, server or connection errors (default 4)', type=int, default=4)
+parser_s.add_argument('--cache-dir', help='Directory for the persistent KB response cache (default "~/.cache/import_yocto_build_manifest")', default=CACHE_DIR)
+parser_s.add_argument('--cache-size', help='Maximum size of the KB response cache in MB (default 500)', type=int, default=500)
+parser_s.add_argument('--no-cache', help='Do not use the persistent KB response cache', action='store_true')
 
-if not args.command:
-    parser.print_help()
-    exit
+def kbconvert_main(args):
+    logging.info("KBCONVERT mode")
+    if not convert_kbfile(args.input, args.output):
+        exit(1)
 
-if args.command == 'kblookup':
+def kblookup_main(args):
+    global listfile, reprules
     logging.info("KBLOOKUP mode")
+    open_kbcache(args)
+    open_throttle(args, args.max_inflight if args.use_async else max(args.workers, 1))
+    open_results(args)
     if args.listfile:
-        listfile = args.listfile
-
-    count_skipped = 0
-    count_nokbmatch = 0
-    count_alreadymatched = 0
-    count_nokblookupmatch = 0
-    count_newvermatch = 0
-    count_novermatch = 0
-    count_newmatch = 0
+        try:
+            listfile = open(args.listfile, "a+")
+        except OSError:
+            logging.error("Failed to open output listfile {} for append".format(args.listfile))
 
     if args.replace_file:
         print("Reading replacement file {} ...".format(args.replace_file))
         logging.info("Replacement file {} specified".format(args.replace_file))
-        repdict, skiplist = process_replacement_file(args.replace_file)
+        reprules = process_replacement_file(args.replace_file)
+        if reprules is None:
+            exit(1)
+    open_matchstore(args)
+    open_pkgdata(args)
 
     logging.info("Output KBlookup file {}".format(args.output))
+    outkb = open_kbfile(args.output, args.checkpoint)
+    outkb.load()
 
     if args.kbfile:
         logging.info("Input KB lookup file {} specified".format(args.kbfile))
         if args.append:
             logging.info("Append flag specified - will copy input KB file to {}".format(args.output))
-#            kblookupdict, kbverdict = import_kbfile(args.kbfile, args.output)
-            import_kbfile(args.kbfile, args.output)
+            import_kbfile(args.kbfile, outkb)
         else:
-#            kblookupdict, kbverdict = import_kbfile(args.kbfile, "")
-            import_kbfile(args.kbfile, "")
+            import_kbfile(args.kbfile, None)
     #
     # Process components to find matching KB URLs - output to componentlookup.csv
-    logging.info("Input component file specified {}".format(args.component_file))
-    lines = read_compfile(args.component_file)
+    logging.info("Input component file(s) specified {}".format(", ".join(args.component_file)))
+    if not check_compfiles(args.component_file):
+        exit(1)
+    manifest = ManifestReader(args.component_file, reprules, args.input_format)
+    previous = None
+    if args.previous:
+        previous = load_previous_manifest(args.previous, 'kblookup', state_options(args))
+    current = ManifestState('kblookup', state_options(args))
 
     print("")
     print("Will write to output kbfile {}".format(args.output))
-    print("Processing component list file {} ...".format(args.component_file))
+    print("Processing component list file(s) {} ...".format(", ".join(args.component_file)))
+    #
+    # Results from an earlier run of the same command which stopped early are reused from the journal
+    journal = LookupJournal(args.output + ".journal", journal_options(args))
+    resumed = journal.load()
+    if resumed:
+        print("Resuming from lookup journal {} ({} entries already resolved)".format(journal.filename, len(resumed)))
+        logging.info("Resuming from lookup journal {} ({} entries)".format(journal.filename, len(resumed)))
+    #
+    # Plan which manifest entries need KB lookups (in manifest order) before running them concurrently
     processed_comps = 0
-    all_comps = 0
-    for line in lines:
-        package, version, skip = process_compfile_line(line, skiplist)
+    stopped = None
+    entries = []
+    unchanged = 0
+    for package, version, skip, compfile in manifest:
         if package == "":
             print("ERROR: Invalid input build manifest file format")
             exit(0)
 
-        all_comps += 1
-        listoutput("Manifest Component = '{}/{}'".format(package, version), False)
-        logging.info("PROCESSING COMPONENT from component file {}/{}".format(package, version))
-        if skip:
-            listoutput("- SKIPPED", True)
-            logging.info("Component SKIPPED")
-            count_skipped += 1
+        current.entries[(package, version)] = None
+        if previous is not None and (package, version) in previous.entries:
+            #
+            # Entry unchanged since the previous manifest - not processed
+            unchanged += 1
             continue
+        lookup = needs_kb_lookup(package, version, skip)
+        if lookup and (package, version) not in resumed:
+            if args.budget and processed_comps >= args.budget:
+                stopped = "budget"
+                break
+            processed_comps += 1
+        entries.append((package, version, skip, lookup))
 
-        if package in kblookupdict:
-            #
-            # Found primary package name in kbfile
-            if kblookupdict[package][0] == "NO MATCH":
-                count_nokblookupmatch += 1
-                listoutput("- NO MATCH in input KB File", True)
-                logging.info("Component found in KBlookup file, but NO MATCH entry found (No match in KB)")
-                continue
-            logging.info("Component found in KBLookup file")
-            #
-            # Check if package/version is defined in KB Lookup file
-            packverstr = package + "/" + version
-            if packverstr in kbverdict:
-                # Found in KB ver URL list - Nothing to do
-                logging.info("Component {}/{} already processed - not added".format(package, version))
-                kbverurl = kbverdict[packverstr]
-                listoutput(" - already MATCHED in input KB file", True)
-                count_alreadymatched += 1
+    if manifest.duplicates > 0:
+        print("Dropped {} duplicate component/version entries".format(manifest.duplicates))
+        logging.info("Dropped {} duplicate component/version entries".format(manifest.duplicates))
+    if previous is not None and not stopped:
+        print_manifest_changes(args.previous, previous, current, unchanged, len(entries))
+
+    total, distinct = plan_kb_searches([entry[0] for entry in entries if entry[3] and (entry[0], entry[1]) not in resumed], reprules)
+    print("Search plan: {} candidate KB searches, {} distinct queries".format(total, len(distinct)))
+    logging.info("Search plan: {} candidate KB searches, {} distinct queries".format(total, len(distinct)))
+
+    executor = None
+    futures = []
+    if args.use_async:
+        print("{} components require KB lookup - using asyncio with up to {} requests in flight".format(processed_comps, args.max_inflight))
+        results = iter(run_async(args.max_inflight, async_resolve_entries,
+                                 [(package, version) for package, version, skip, lookup in entries
+                                  if lookup and (package, version) not in resumed]))
+        for package, version, skip, lookup in entries:
+            if lookup and (package, version) not in resumed:
+                futures.append(completed_future(next(results)))
             else:
-                #
-                # Loop through component URLs to check for component version
-                logging.info("Version not found in KBLookup file - searching in KB")
-                foundkbversion = False
-                for kburl in kblookupdict[package]:
-                    logging.info("Working with first component entry from KBLookup file")
-                    kbverurl, srcurl = find_compver_from_compurl(package, kburl, version, repdict)
-                    if kbverurl != "NO VERSION MATCH":
-                        listoutput(" - MATCHED '{}/{}'".format(package, version), True)
-                        #print(" - MATCHED '{}/{}' (sourceURL={})".format(package, version, srcurl))
-                        #
-                        # KB version URL found
-                        kbverdict[package + "/" + version] = kbverurl
-                        logging.info("Matched {}/{} - Updating KBLookup file".format(package, version))
-                        update_kbfile_entry(args.output, package, version, kblookupdict[package][0], kbverurl)
-                        count_newvermatch += 1
-
-                        foundkbversion = True
-                        break
-                if foundkbversion == False:
-                    #
-                    # No version match from existing KBLookup entries
-                    # Need to do a final open search
-                    newkbline = find_comp_from_kb(package, version, args.output, args.kbfile, repdict)
-                    if newkbline.split(";")[3] != "NO MATCH":
-                        add_kbfile_entry(args.output, newkbline)
-                        count_newmatch += 1
-                    else:
-                        #
-                        # No version match - need to add NO VERSION MATCH string to kbfile
-                        logging.info("No version match found in KB - updating entry in output KBlookup file")
-                        update_kbfile_entry(args.output, package, version, kblookupdict[package][0], "NO VERSION MATCH")
-                        count_novermatch += 1
-                    processed_comps += 1
+                futures.append(None)
+    else:
+        workers = max(args.workers, 1)
+        print("{} components require KB lookup - using {} workers".format(processed_comps, workers))
+        executor = ThreadPoolExecutor(max_workers=workers)
+        for package, version, skip, lookup in entries:
+            if lookup and (package, version) not in resumed:
+                futures.append(executor.submit(resolve_manifest_entry, package, version))
+            else:
+                futures.append(None)
 
-        else:
-            logging.info("Component not found in KBLookup file")
-            newkbline = find_comp_from_kb(package, version, args.output, args.kbfile, repdict)
-            if newkbline.split(";")[3] != "NO MATCH":
-                count_newmatch += 1
+    all_comps = 0
+    counts = {}
+    newmatches = []     # New matches - added to the lookup dicts once all lookups complete so results do not depend on timing
+    resumekb = ResumeKBFile(outkb)
+    try:
+        for (package, version, skip, lookup), future in zip(entries, futures):
+            if (package, version) in resumed and lookup:
+                status = apply_kblookup_entry(resumekb, package, version, skip, lookup, resumed[(package, version)], newmatches)
+            elif lookup:
+                result = future.result()
+                status = apply_kblookup_entry(outkb, package, version, skip, lookup, result, newmatches)
+                if lookup_failed(result):
+                    # (processed again with --previous)
+                    current.entries.pop((package, version), None)
+                else:
+                    journal.record(package, version, result)
             else:
-                count_nokbmatch += 1
-            add_kbfile_entry(args.output, newkbline)
-            processed_comps += 1
+                status = apply_kblookup_entry(outkb, package, version, skip, lookup, None, newmatches)
+            all_comps += 1
+            counts[status] = counts.get(status, 0) + 1
+    except KeyboardInterrupt:
+        print("")
+        print("Interrupted - saving results")
+        logging.info("Interrupted after {} entries".format(all_comps))
+        stopped = "interrupted"
+        for future in futures:
+            if future:
+                future.cancel()
 
+    if executor:
+        executor.shutdown()
+    for compname, version, compurl, verurl in newmatches:
+        record_kb_match(compname, version, compurl, verurl)
+    outkb.save()
+    if listfile:
+        listfile.close()
+    if resultswriter:
+        resultswriter.close()
+    if stopped:
+        journal.close()
+        if stopped == "budget":
+            print("Lookup budget of {} components reached".format(args.budget))
+            logging.info("Lookup budget of {} components reached - stopping".format(args.budget))
+        print("Rerun the same command to continue from lookup journal {}".format(journal.filename))
+    else:
+        journal.remove()
+        if args.save_state:
+            current.save(args.save_state)
 
-        if processed_comps > 500:
-            print("500 components processed - terminating. Please rerun with -k option to append to kbfile")
-            logging.info("500 components processed - terminating early")
-            break
+    print_kblookup_summary(all_comps, counts)
+
+    close_caches()
+
+def batch_main(args):
+    global listfile, reprules
+    logging.info("BATCH mode")
+    open_kbcache(args)
+    open_throttle(args, max(args.workers, 1), max(args.processes, 1))
+    open_results(args)
+    if args.listfile:
+        try:
+            listfile = open(args.listfile, "a+")
+        except OSError:
+            logging.error("Failed to open output listfile {} for append".format(args.listfile))
+
+    if args.replace_file:
+        print("Reading replacement file {} ...".format(args.replace_file))
+        logging.info("Replacement file {} specified".format(args.replace_file))
+        reprules = process_replacement_file(args.replace_file)
+        if reprules is None:
+            exit(1)
+    open_matchstore(args)
+    open_pkgdata(args)
+
+    logging.info("Output KBlookup file {}".format(args.output))
+    outkb = open_kbfile(args.output, args.checkpoint)
+    outkb.load()
 
-    print("SUMMARY:")
-    print(" {} Entries processed from component file".format(all_comps))
-    print(" {} Components Skipped".format(count_skipped))
-    print(" {} Components Not in KB".format(count_nokbmatch))
-    print(" {} Components Already Matched in KBLookup file (duplicate)".format(count_alreadymatched))
-    print(" {} Components Not Matched from KBLookup file".format(count_nokblookupmatch))
-    print(" {} Components with New Version Match".format(count_newvermatch))
-    print(" {} Components with No Version Match".format(count_novermatch))
-    print(" {} Components with New Match".format(count_newmatch))
-    logging.info("SUMMARY:")
-    logging.info(" {} Entries processed from component file".format(all_comps))
-    logging.info(" {} Components Skipped".format(count_skipped))
-    logging.info(" {} Components Not in KB".format(count_nokbmatch))
-    logging.info(" {} Components Already Matched in KBLookup file (duplicate)".format(count_alreadymatched))
-    logging.info(" {} Components Not Matched from KBLookup file".format(count_nokblookupmatch))
-    logging.info(" {} Components with New Version Match".format(count_newvermatch))
-    logging.info(" {} Components with No Version Match".format(count_novermatch))
-    logging.info(" {} Components with New Match".format(count_newmatch))
-
-    exit()
-
-if args.command == 'import':
-    logging.info("KBLOOKUP mode")
-    count_added = 0
-    count_skipped = 0
-    count_notinkb = 0
-    count_alreadyexists = 0
     if args.kbfile:
-        import_kbfile(args.kbfile, "")
+        logging.info("Input KB lookup file {} specified".format(args.kbfile))
+        if args.append:
+            logging.info("Append flag specified - will copy input KB file to {}".format(args.output))
+            import_kbfile(args.kbfile, outkb)
+        else:
+            import_kbfile(args.kbfile, None)
 
-    bdproject, bdversion = manage_project_version(args.project, args.version)
-    if not bdversion:
-        print("Cannot create version {}".format(args.version))
-        exit()
-    bdversion_url = bdversion['_meta']['href']
+    compfiles = find_batch_manifests(args.manifests)
+    if not compfiles:
+        print("ERROR: No build manifests found")
+        exit(1)
+    logging.info("Build manifests {}".format(", ".join(compfiles)))
+    print("")
+    print("Will write to output kbfile {}".format(args.output))
+    print("Processing {} build manifests ...".format(len(compfiles)))
+    #
+    # Read each image manifest - component/version entries shared between images are only looked up once
+    images = []
+    distinct = {}       # Dict of (component, version) with SKIP flag in first-seen order across all images
+    for compfile in compfiles:
+        reader = ManifestReader([compfile], reprules, args.input_format)
+        imageentries = [(package, version, skip) for package, version, skip, cfile in reader]
+        if reader.invalid > 0:
+            print("ERROR: Invalid input build manifest file format in {} - ignored".format(compfile))
+            logging.error("Invalid build manifest file format in {} - ignored".format(compfile))
+            continue
+        images.append((compfile, imageentries, reader.duplicates))
+        for package, version, skip in imageentries:
+            distinct.setdefault((package, version), skip)
 
-    print("Using component list file '{}'".format(args.component_file))
-    lines = read_compfile(args.component_file)
+    all_entries = sum(len(image[1]) for image in images)
+    print("{} entries from {} images - {} distinct component/versions ({} shared between images)".format(
+        all_entries, len(images), len(distinct), all_entries - len(distinct)))
+    logging.info("{} entries from {} images - {} distinct component/versions".format(all_entries, len(images), len(distinct)))
 
-    components = hub.get_version_components(bdversion)
-    print("Found {} existing components in project".format(components['totalCount']))
-    if args.delete:
-        count = 0
-        logging.debug("Looking through the components for project {}, version {}.".format(args.project, args.version))
-        for component in components['items']:
-            if component['matchTypes'][0] == 'MANUAL_BOM_COMPONENT':
-                manualcomplist[component['componentName'] + "/" + component['componentVersionName']] = component['_meta']['href']
-                count += 1
-        print("Found {} manual components".format(count))
+    lookups = [(package, version) for (package, version), skip in distinct.items() if needs_kb_lookup(package, version, skip)]
+    total, searches = plan_kb_searches([entry[0] for entry in lookups], reprules)
+    print("Search plan: {} candidate KB searches, {} distinct queries".format(total, len(searches)))
+    logging.info("Search plan: {} candidate KB searches, {} distinct queries".format(total, len(searches)))
+
+    results = {}
+    if lookups:
+        chunks = split_batch_entries(lookups, max(args.processes, 1))
+        print("{} components require KB lookup - using {} processes with {} workers each".format(
+            len(lookups), len(chunks), max(args.workers, 1)))
+        if len(chunks) > 1:
+            #
+            # Worker processes are forked so they inherit the KB lookup dicts, replacements and Hub connection;
+            # the persistent KB response cache directory is shared between them
+            with ProcessPoolExecutor(max_workers=len(chunks), mp_context=multiprocessing.get_context("fork"),
+                                     initializer=batch_worker_init) as pool:
+                chunkresults = []
+                for chunkresult, snapshot, profilefile in pool.map(resolve_batch_chunk_process, chunks, [args.workers] * len(chunks)):
+                    chunkresults.append(chunkresult)
+                    metrics.merge(snapshot)
+                    if profilefile:
+                        batchprofiles.append(profilefile)
+        else:
+            chunkresults = [resolve_batch_chunk(chunks[0], args.workers)]
+        for chunk, chunkresult in zip(chunks, chunkresults):
+            results.update(zip(chunk, chunkresult))
+
+    #
+    # Merge results into the output kbfile in first-seen order
+    statuses = {}
+    counts = {}
+    newmatches = []
+    for (package, version), skip in distinct.items():
+        lookup = (package, version) in results
+        status = apply_kblookup_entry(outkb, package, version, skip, lookup, results.get((package, version)), newmatches)
+        statuses[(package, version)] = status
+        counts[status] = counts.get(status, 0) + 1
+
+    for compname, version, compurl, verurl in newmatches:
+        record_kb_match(compname, version, compurl, verurl)
+    outkb.save()
+    if listfile:
+        listfile.close()
+    if resultswriter:
+        resultswriter.close()
+
+    for compfile, imageentries, duplicates in images:
+        imagecounts = {}
+        for package, version, skip in imageentries:
+            status = statuses[(package, version)]
+            imagecounts[status] = imagecounts.get(status, 0) + 1
+        print("")
+        print_kblookup_summary(len(imageentries), imagecounts, "SUMMARY for {}:".format(compfile))
+        if duplicates > 0:
+            print(" {} Duplicate component/version entries dropped".format(duplicates))
+
+    print("")
+    print_kblookup_summary(len(distinct), counts, "SUMMARY for all images:")
+
+    close_caches()
+
+def import_main(args):
+    logging.info("IMPORT mode")
+    open_kbcache(args)
+    open_throttle(args, args.max_inflight if args.use_async else max(args.workers, 1))
+    open_results(args)
+    importer = BOMImport(args.project, args.version, args.kbfile, args.workers, args.retries, args.backoff,
+                         args.use_async, args.max_inflight)
+
+    print("Using component list file(s) '{}'".format(", ".join(args.component_file)))
+    if not check_compfiles(args.component_file):
+        exit(1)
+    previous = None
+    if args.previous:
+        previous = load_previous_manifest(args.previous, 'import', state_options(args))
+
+    manifest = ManifestReader(args.component_file, reprules, args.input_format)
+    entries = [(package, version, compfile) for package, version, skip, compfile in manifest]
+    if manifest.duplicates > 0:
+        print("Dropped {} duplicate component/version entries".format(manifest.duplicates))
 
     print("")
     print("Processing component list ...")
-    for line in lines:
-        package, version, skip = process_compfile_line(line, skiplist)
+    kbverurls = importer.resolve(entries)
+    current = ManifestState('import', state_options(args),
+                            {(package, version): kbverurl for (package, version, compfile), kbverurl in zip(entries, kbverurls)})
+    removedurls = set()
+    if previous is not None:
+        entries, kbverurls, removedurls = import_manifest_delta(args, previous, current, entries, kbverurls)
+        if not entries and not (args.delete and removedurls):
+            print("No changes since previous manifest {} - project version not updated".format(args.previous))
+            if resultswriter:
+                resultswriter.close()
+            if args.save_state:
+                current.save(args.save_state)
+            close_caches()
+            exit()
 
-        print("Manifest component to add = '{}/{}'".format(package, version), end="")
+    try:
+        if not importer.open():
+            exit()
+    except RuntimeError as e:
+        print("ERROR: {}".format(e))
+        exit(1)
+    print("Found {} existing components in project".format(importer.bomsnapshot.count))
+    if args.delete and previous is not None:
+        #
+        # Only delete the manual components for entries removed from the manifest
+        manualcomplist.update((kbverurl, compurl) for kbverurl, compurl in importer.bomsnapshot.manual.items() if kbverurl in removedurls)
+        print("Found {} manual components removed from the manifest".format(len(manualcomplist)))
+    elif args.delete:
+        manualcomplist.update(importer.bomsnapshot.manual)
+        print("Found {} manual components".format(len(manualcomplist)))
 
-        logging.debug("Manifest component to add = '{}/{}'".format(package, version))
-        kbverlurl = ""
-        if package in kblookupdict:
-            #
-            # Check if package/version is in kbverdict
-            packstr = package + "/" + version
-            if packstr in kbverdict:
-                #
-                # Component version URL found in kbfile
-               logging.debug("Compver found in kbverdict packstr = {}, kbverdict[packstr] = {}".format(packstr, kbverdict[packstr]))
-               kbverurl = kbverdict[packstr]
-            else:
-                #
-                # No match of component version in kbfile version URLs
-                for kburl in kblookupdict[package]:
-                    #
-                    # Loop through component URLs from kbfile
-                    kbverurl, srcurl = find_compver_from_compurl(package, kburl, version)
-                    if kbverurl != "NO VERSION MATCH":
-                        break
-            if kbverurl != "NO VERSION MATCH":
-                #
-                # Component does not exist in project
-                logging.debug("Component found in project - packstr = {}".format(packstr))
-                if add_comp_to_bom(bdversion_url, kbverurl, args.component_file, package + "/" + version):
-                    count_added += 1
-                else:
-                    count_alreadyexists += 1
-                if package + "/" + version in manualcomplist:
-                    del manualcomplist[package + "/" + version]
-            else:
-                print(" - No component match from KB (NOT ADDED)")
-                count_notinkb += 1
+    #
+    # Manual components of the KB components for entries whose KB lookup failed are not deleted
+    failedcomps = set(kburl for (package, version, compfile), kbverurl in zip(entries, kbverurls)
+                      if kbverurl == KB_LOOKUP_FAILED for kburl in kblookupdict[package])
+    for kbverurl in [kbverurl for kbverurl in manualcomplist if kbverurl.rsplit("/versions/", 1)[0] in failedcomps]:
+        del manualcomplist[kbverurl]
 
-        else:
-            print (" - Does not exist in KBlookup file (SKIPPED)")
-            count_skipped += 1
+    records = importer.add(entries, kbverurls)
+    counts = {}
+    for record in records:
+        counts[record['outcome']] = counts.get(record['outcome'], 0) + 1
+        if record['kb_version_url']:
+            #
+            # Component is in the manifest so must not be deleted
+            manualcomplist.pop(record['kb_version_url'], None)
+        report_result(record, import_result_text(record))
+    if resultswriter:
+        resultswriter.close()
 
     print("SUMMARY:")
-    print(" {} Components Added".format(count_added))
-    print(" {} Components Skipped".format(count_skipped))
-    print(" {} Components Not in KB".format(count_notinkb))
-    print(" {} Components Already Exist".format(count_alreadyexists))
+    print(" {} Components Added".format(counts.get('added', 0)))
+    print(" {} Components Skipped".format(counts.get('notinkbfile', 0)))
+    print(" {} Components Not in KB".format(counts.get('nokbmatch', 0)))
+    print(" {} Components Already Exist".format(counts.get('exists', 0)))
+    print(" {} Components Failed to Add".format(counts.get('failed', 0)))
 
+    deleteops = []
     if args.delete:
         #print("Unused components not deleted - not available until version 2019.08 which supports the required API")
-        count = 0
         print("")
-        print("Deleting outdated components ...", end = "")
-        for compver in manualcomplist.values():
-            del_comp_from_bom(compver)
-            print(".", end = "", flush=True)
-            count += 1
+        print("Deleting outdated components ...", end = "", flush=True)
+        deleteops = importer.delete(manualcomplist)
+        count = 0
+        for operation in deleteops:
+            if operation.succeeded():
+                print(".", end = "")
+                count += 1
+            else:
+                print("x", end = "")
         print("")
-        print("Deleted {} existing manual components".format(count))
\ No newline at end of file
+        print("Deleted {} existing manual components".format(count))
+        if count < len(deleteops):
+            print("Failed to delete {} manual components (see log)".format(len(deleteops) - count))
+
+    if args.bom_report:
+        write_bom_report(args.bom_report, importer.operations)
+
+    if args.save_state:
+        #
+        # Entries which failed to add (or be deleted) are processed again in the next run
+        for record in records:
+            if record['outcome'] == 'failed':
+                current.entries.pop((record['package'], record['version']), None)
+        faileddeletes = set(operation.kbverurl for operation in deleteops if not operation.succeeded())
+        if previous is not None and faileddeletes:
+            for key, kbverurl in previous.entries.items():
+                if kbverurl in faileddeletes and key not in current.entries:
+                    current.entries[key] = kbverurl
+        current.save(args.save_state)
+
+    close_caches()
+
+def serve_main(args):
+    logging.info("SERVE mode")
+    try:
+        matcher = KBLookup(args.replace_file, args.kbfile, args.output, args.workers, checkpoint=args.checkpoint,
+                           pkgdata=args.pkgdata, cache_dir=args.cache_dir, cache_size=args.cache_size,
+                           no_cache=args.no_cache, max_rate=args.max_rate, kb_retries=args.kb_retries)
+    except ValueError as e:
+        print("ERROR: {}".format(e))
+        exit(1)
+    try:
+        server = LookupServer((args.host, args.port), matcher)
+    except OSError as e:
+        print("ERROR: Cannot listen on {}:{} - {}".format(args.host, args.port, e))
+        exit(1)
+    #
+    # Stop cleanly (saving the output KB Lookup File) on SIGTERM as well as Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    print("Serving KB lookups on http://{}:{}/ (Ctrl-C to stop)".format(args.host, server.server_address[1]))
+    logging.info("Serving KB lookups on {}:{}".format(args.host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print("")
+    print("Stopping - {} lookup requests served".format(server.served))
+    server.server_close()
+    matcher.close()
+
+MODES = {
+    'kblookup': kblookup_main,
+    'batch': batch_main,
+    'import': import_main,
+    'kbconvert': kbconvert_main,
+    'serve': serve_main,
+}
+
+def main(argv=None):
+    global explainrules, profiler
+    logging.basicConfig(filename='import_yocto_build_manifest.log',level=logging.INFO)
+    args = parser.parse_args(argv)
+
+    if not args.command:
+        parser.print_help()
+        return
+
+    explainrules = getattr(args, 'explain', False)
+
+    if getattr(args, 'profile', None):
+        profiler = Profiler(args.profile)
+    if getattr(args, 'metrics', None) or profiler:
+        atexit.register(write_run_reports, args)
+
+    if getattr(args, 'use_async', False) and aiohttp is None:
+        print("ERROR: --async requires the aiohttp package (pip3 install aiohttp)")
+        exit(1)
+
+    MODES[args.command](args)
+
+if __name__ == "__main__":
+    main()
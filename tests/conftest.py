@@ -0,0 +1,94 @@
+#
+# Test fixtures - each test runs the script against a local fake Black Duck server (benchmark/fake_hub.py)
+# started in a thread, with its own working directory holding .restconfig.json and the replacement file
+#
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+ROOTDIR = os.path.dirname(TESTDIR)
+SCRIPT = os.path.join(ROOTDIR, "import_yocto_build_manifest.py")
+sys.path.insert(0, os.path.join(ROOTDIR, "benchmark"))
+sys.path.insert(0, ROOTDIR)
+
+from fake_hub import FakeHub, FakeKB, make_handler     # noqa: E402
+
+KB_SIZE = 10        # Synthetic KB components pkg0 ... pkg9
+KB_VERSIONS = 5     # Versions of each component
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def fake_hub():
+    kb = FakeKB(KB_SIZE, KB_VERSIONS)
+    fake = FakeHub(kb)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(fake))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    fake.url = "http://127.0.0.1:{}".format(server.server_address[1])
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def workdir(tmp_path, fake_hub):
+    with open(tmp_path / ".restconfig.json", "w") as cfile:
+        json.dump({'baseurl': fake_hub.url, 'api_token': "test", 'insecure': True, 'debug': False}, cfile)
+    with open(tmp_path / "replace.txt", "w") as rfile:
+        rfile.write("kernel-module;SKIP\n")
+    return tmp_path
+
+
+def kb_versions(fake, name):
+    #
+    # Version names of a KB component in the fake server
+    for comp in fake.kb.components.values():
+        if comp['name'] == name:
+            return [version for vid, version in comp['versions']]
+    return []
+
+
+def write_manifest(filename, entries):
+    with open(filename, "w") as mfile:
+        for package, version in entries:
+            mfile.write("{} aarch64 {}\n".format(package, version))
+
+
+def run_script(workdir, *args):
+    # (KB response cache and bearer tokens are kept in the working directory)
+    if "--no-cache" not in args and args[0] != "kbconvert":
+        args += ("--cache-dir", str(workdir / "cache"))
+    process = subprocess.run([sys.executable, SCRIPT] + list(args), cwd=workdir, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, universal_newlines=True, timeout=300)
+    assert process.returncode == 0, process.stdout
+    return process.stdout
+
+
+def summary(output):
+    #
+    # Dict of SUMMARY counter description with count from the script output
+    counts = {}
+    for line in output[output.index("SUMMARY:"):].splitlines()[1:]:
+        m = re.match(r"^ (\d+) (.*)$", line)
+        if m:
+            counts[m.group(2)] = int(m.group(1))
+    return counts
+
+
+def kbfile_lines(filename):
+    with open(filename, "r") as kfile:
+        return [line.rstrip("\n") for line in kfile if line.strip()]
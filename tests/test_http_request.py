@@ -0,0 +1,78 @@
+#
+# http_request() retries - throttled responses and connection errors are retried (honouring Retry-After),
+# requests which cannot succeed when repeated fail at once
+#
+import pytest
+import requests
+
+import import_yocto_build_manifest as yocto
+
+
+class Response:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.content = b"{}"
+        self.headers = headers or {}
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    #
+    # Retry delays requested by http_request() (not slept) with a throttle allowing 3 retries
+    delays = []
+    monkeypatch.setattr(yocto, "hubthrottle", yocto.HubThrottle(retries=3, backoff=0.01))
+    monkeypatch.setattr(yocto, "metrics", yocto.Metrics())
+    monkeypatch.setattr(yocto.time, "sleep", delays.append)
+    return delays
+
+
+def request_func(*outcomes):
+    #
+    # Request function returning (or raising) the outcomes in turn - calls are counted in func.calls
+    def func(url):
+        func.calls += 1
+        outcome = outcomes[min(func.calls, len(outcomes)) - 1]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    func.calls = 0
+    return func
+
+
+def test_throttled_request_retried_after_retry_after(sleeps):
+    func = request_func(Response(429, {'Retry-After': "2"}), Response(503), Response(200))
+    response = yocto.http_request('server_version', func, "http://127.0.0.1/api/current-version")
+    assert response.status_code == 200
+    assert func.calls == 3
+    assert sleeps[0] >= 2
+    assert yocto.metrics.counters["request_retries"] == 2
+
+
+def test_connection_error_retried_until_retries_exhausted(sleeps):
+    func = request_func(requests.ConnectionError("refused"))
+    with pytest.raises(requests.ConnectionError):
+        yocto.http_request('auth', func, "http://127.0.0.1/api/tokens/authenticate")
+    assert func.calls == 4
+    assert len(sleeps) == 3
+
+
+def test_timeout_retried(sleeps):
+    func = request_func(requests.Timeout("timed out"), Response(200))
+    assert yocto.http_request('auth', func, "http://127.0.0.1/api/tokens/authenticate").status_code == 200
+    assert func.calls == 2
+
+
+@pytest.mark.parametrize("error", [requests.exceptions.InvalidURL("bad url"), requests.exceptions.MissingSchema("no schema"),
+                                   requests.exceptions.InvalidHeader("bad header")])
+def test_request_error_fails_at_once(sleeps, error):
+    func = request_func(error)
+    with pytest.raises(type(error)):
+        yocto.http_request('auth', func, "NO MATCH")
+    assert func.calls == 1
+    assert sleeps == []
+
+
+def test_not_found_not_retried(sleeps):
+    func = request_func(Response(404))
+    assert yocto.http_request('server_version', func, "http://127.0.0.1/api/current-version").status_code == 404
+    assert func.calls == 1
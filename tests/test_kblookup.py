@@ -0,0 +1,99 @@
+#
+# kblookup mode against the fake server - outcomes for several versions of the same package, reruns with the
+# KB Lookup File written by a run (-k) and resuming a run stopped by --budget
+#
+import time
+
+import pytest
+
+from conftest import kb_versions, kbfile_lines, run_script, summary, write_manifest
+
+MODES = [
+    pytest.param([], "kblookup.out", id="text"),
+    pytest.param(["--async"], "kblookup.out", id="async"),
+    pytest.param([], "kblookup.db", id="sqlite"),
+]
+
+
+def output_lines(workdir, output):
+    if output.endswith(".db"):
+        run_script(workdir, "kbconvert", "-i", output, "-o", "converted.out")
+        return kbfile_lines(workdir / "converted.out")
+    return kbfile_lines(workdir / output)
+
+
+@pytest.mark.parametrize("options, output", MODES)
+def test_versions_of_new_component(workdir, fake_hub, options, output):
+    if "--async" in options:
+        pytest.importorskip("aiohttp")
+    versions = kb_versions(fake_hub, "pkg1")
+    write_manifest(workdir / "image.manifest", [("pkg1", versions[0]), ("pkg1", versions[1]), ("pkg1", "9.9.9"),
+                                                ("unknown1", "1.0")])
+    result = run_script(workdir, "kblookup", "-c", "image.manifest", "-r", "replace.txt", "-o", output, "--no-cache", *options)
+
+    counts = summary(result)
+    assert counts["Components with New Match"] == 1
+    assert counts["Components with New Version Match"] == 1
+    assert counts["Components with No Version Match"] == 1
+    assert counts["Components Not in KB"] == 1
+    lines = output_lines(workdir, output)
+    pkg1 = [line for line in lines if line.startswith("pkg1;")]
+    assert len(pkg1) == 1
+    assert pkg1[0].split(";")[4::2] == [versions[0], versions[1], "9.9.9", ""]
+    assert pkg1[0].split(";")[9] == "NO VERSION MATCH"
+    assert [line for line in lines if line.startswith("unknown1;")] == ["unknown1;;;NO MATCH;1.0;NO VERSION MATCH;"]
+
+
+@pytest.mark.parametrize("kbfile", ["kblookup.out", "kblookup.db"])
+def test_rerun_with_kbfile(workdir, fake_hub, kbfile):
+    versions = kb_versions(fake_hub, "pkg2")
+    write_manifest(workdir / "first.manifest", [("pkg2", versions[0])])
+    run_script(workdir, "kblookup", "-c", "first.manifest", "-r", "replace.txt", "-o", "kblookup.out", "--no-cache")
+    #
+    # KB Lookup File with both a matched line and a NO MATCH line for the package
+    with open(workdir / "kblookup.out", "a") as kfile:
+        kfile.write("pkg2;;;NO MATCH;9.9.9;NO VERSION MATCH;\n")
+    if kbfile.endswith(".db"):
+        run_script(workdir, "kbconvert", "-i", "kblookup.out", "-o", kbfile)
+
+    write_manifest(workdir / "second.manifest", [("pkg2", versions[0]), ("pkg2", versions[1]), ("pkg2", "8.8.8")])
+    start = time.time()
+    result = run_script(workdir, "kblookup", "-c", "second.manifest", "-r", "replace.txt", "-k", kbfile,
+                        "-o", "second.out", "--no-cache")
+    assert "KB LOOKUP FAILED" not in result
+    assert time.time() - start < 5
+    counts = summary(result)
+    assert counts["Components Already Matched in KBLookup file (duplicate)"] == 1
+    assert counts["Components with New Version Match"] == 1
+    assert counts["Components with No Version Match"] == 1
+
+
+def test_resume_after_budget(workdir, fake_hub):
+    entries = []
+    for name in ("pkg3", "pkg4", "pkg5", "pkg6"):
+        versions = kb_versions(fake_hub, name)
+        entries += [(name, versions[0]), (name, versions[1])]
+    entries.insert(3, ("unknown2", "1.0"))
+    write_manifest(workdir / "image.manifest", entries)
+    lookup = ["kblookup", "-c", "image.manifest", "-r", "replace.txt", "--no-cache", "--checkpoint", "1"]
+
+    complete = run_script(workdir, *lookup, "-o", "complete.out")
+    stopped = run_script(workdir, *lookup, "-o", "resumed.out", "--budget", "5")
+    assert summary(stopped)["Entries processed from component file"] == 5
+    assert (workdir / "resumed.out.journal").exists()
+    resumed = run_script(workdir, *lookup, "-o", "resumed.out")
+
+    assert "Resuming from lookup journal" in resumed
+    assert summary(resumed) == summary(complete)
+    assert summary(complete)["Components with New Match"] == 4
+    assert kbfile_lines(workdir / "resumed.out") == kbfile_lines(workdir / "complete.out")
+    assert not (workdir / "resumed.out.journal").exists()
+
+
+def test_journal_ignored_for_different_input_format(workdir, fake_hub):
+    versions = kb_versions(fake_hub, "pkg7")
+    write_manifest(workdir / "image.manifest", [("pkg7", version) for version in versions])
+    lookup = ["kblookup", "-c", "image.manifest", "-r", "replace.txt", "-o", "kblookup.out", "--no-cache"]
+    run_script(workdir, *lookup, "--budget", "2")
+    result = run_script(workdir, *lookup, "--input-format", "manifest")
+    assert "Ignoring lookup journal" in result
@@ -0,0 +1,54 @@
+#
+# serve mode - consecutive /lookup requests share the lookup state of the server
+#
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+from conftest import SCRIPT, free_port, kb_versions, kbfile_lines
+
+
+def post_lookup(port, entries):
+    body = "".join("{} aarch64 {}\n".format(package, version) for package, version in entries).encode()
+    request = urllib.request.Request("http://127.0.0.1:{}/lookup".format(port), data=body, method="POST")
+    with urllib.request.urlopen(request, timeout=60) as response:
+        return [record['outcome'] for record in json.loads(response.read())['results']]
+
+
+def start_serve(workdir, port):
+    process = subprocess.Popen([sys.executable, SCRIPT, "serve", "-r", "replace.txt", "-o", "serve.out",
+                                "--port", str(port), "--no-cache"], cwd=workdir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    start = time.time()
+    while time.time() - start < 30:
+        try:
+            with urllib.request.urlopen("http://127.0.0.1:{}/health".format(port), timeout=5):
+                return process
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("serve mode failed to start")
+
+
+def test_consecutive_lookups(workdir, fake_hub):
+    versions = kb_versions(fake_hub, "pkg1")
+    port = free_port()
+    process = start_serve(workdir, port)
+    try:
+        assert post_lookup(port, [("pkg1", "9.9.9"), ("pkg1", versions[0])]) == ['nokbmatch', 'newmatch']
+        assert post_lookup(port, [("pkg1", versions[0]), ("pkg1", versions[1])]) == ['alreadymatched', 'newvermatch']
+        assert post_lookup(port, [("pkg1", versions[1]), ("pkg1", "8.8.8")]) == ['alreadymatched', 'novermatch']
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=30)
+
+    assert os.path.exists(workdir / "serve.out")
+    pkg1 = [line for line in kbfile_lines(workdir / "serve.out") if line.split(";")[3] != "NO MATCH"]
+    assert len(pkg1) == 1
+    assert pkg1[0].split(";")[4::2] == [versions[0], versions[1], "8.8.8", ""]